@@ -1,48 +1,31 @@
 '''
 Business: Регистрация и авторизация пользователей CPA платформы
-Args: event - dict с httpMethod, body (email, password, role)
+Args: event - dict с httpMethod, body (action, email, password, role, token)
       context - object с request_id
 Returns: HTTP response с токеном или ошибкой
 '''
 import json
-import os
-import secrets
-import hashlib
-from datetime import datetime, timedelta
 from typing import Dict, Any, Optional
-import psycopg2
 from psycopg2.extras import RealDictCursor
+from db import get_connection, get_pool
+from responses import http_handler, json_response, error_response
+from sessions import (issue_token, verify_token, revoke_token, listen_for_revocations,
+                      apply_revocations, session_sweeper)
+from passwords import hash_password, verify_password, verify_missing_user, needs_rehash
 
-def get_db_connection():
-    return psycopg2.connect(os.environ['DATABASE_URL'])
+PIXEL_CACHE_CHANNEL = 'pixel_cache'
 
-def hash_password(password: str) -> str:
-    return hashlib.sha256(password.encode()).hexdigest()
-
-def generate_token() -> str:
-    return secrets.token_urlsafe(32)
+get_pool().on_connect.append(listen_for_revocations)
 
+@http_handler(methods=('GET', 'POST'), allow_headers='Content-Type, X-Auth-Token')
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
-    method: str = event.get('httpMethod', 'GET')
+    session_sweeper.ensure_started()
     
-    if method == 'OPTIONS':
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, X-Auth-Token',
-                'Access-Control-Max-Age': '86400'
-            },
-            'body': ''
-        }
+    body_data = json.loads(event.get('body', '{}'))
+    action = body_data.get('action')
     
-    try:
-        body_data = json.loads(event.get('body', '{}'))
-        action = body_data.get('action')
-        
-        conn = get_db_connection()
-        cursor = conn.cursor(cursor_factory=RealDictCursor)
+    with get_connection() as conn, conn.cursor(cursor_factory=RealDictCursor) as cursor:
+        apply_revocations(conn)
         
         if action == 'register':
             email = body_data.get('email', '').strip()
@@ -50,26 +33,14 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             role = body_data.get('role', 'webmaster')
             
             if not email or not password:
-                return {
-                    'statusCode': 400,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'Email и пароль обязательны'})
-                }
+                return error_response(400, 'Email и пароль обязательны')
             
             if role not in ['advertiser', 'webmaster']:
-                return {
-                    'statusCode': 400,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'Неверная роль'})
-                }
+                return error_response(400, 'Неверная роль')
             
             cursor.execute("SELECT id FROM users WHERE email = %s", (email,))
             if cursor.fetchone():
-                return {
-                    'statusCode': 400,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'Email уже зарегистрирован'})
-                }
+                return error_response(400, 'Email уже зарегистрирован')
             
             password_hash = hash_password(password)
             cursor.execute(
@@ -77,126 +48,82 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 (email, password_hash, role)
             )
             user_id = cursor.fetchone()['id']
+            if role == 'webmaster':
+                cursor.execute("SELECT pg_notify(%s, %s)", (PIXEL_CACHE_CHANNEL, f'webmaster:{user_id}'))
             
-            token = generate_token()
-            expires_at = datetime.utcnow() + timedelta(days=30)
-            cursor.execute(
-                "INSERT INTO sessions (user_id, token, expires_at) VALUES (%s, %s, %s)",
-                (user_id, token, expires_at)
-            )
+            token = issue_token(cursor, {'id': user_id, 'email': email, 'role': role})
             
             conn.commit()
-            cursor.close()
-            conn.close()
-            
-            return {
-                'statusCode': 200,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({
-                    'success': True,
-                    'token': token,
-                    'user': {'id': user_id, 'email': email, 'role': role}
-                })
-            }
+            
+            return json_response({
+                'success': True,
+                'token': token,
+                'user': {'id': user_id, 'email': email, 'role': role}
+            })
         
         elif action == 'login':
             email = body_data.get('email', '').strip()
             password = body_data.get('password', '')
             
             if not email or not password:
-                return {
-                    'statusCode': 400,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'Email и пароль обязательны'})
-                }
+                return error_response(400, 'Email и пароль обязательны')
             
-            password_hash = hash_password(password)
             cursor.execute(
-                "SELECT id, email, role FROM users WHERE email = %s AND password_hash = %s",
-                (email, password_hash)
+                "SELECT id, email, role, password_hash FROM users WHERE email = %s",
+                (email,)
             )
             user = cursor.fetchone()
             
-            if not user:
-                return {
-                    'statusCode': 401,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'Неверный email или пароль'})
-                }
-            
-            token = generate_token()
-            expires_at = datetime.utcnow() + timedelta(days=30)
-            cursor.execute(
-                "INSERT INTO sessions (user_id, token, expires_at) VALUES (%s, %s, %s)",
-                (user['id'], token, expires_at)
-            )
+            if user:
+                valid = verify_password(password, user['password_hash'])
+            else:
+                valid = verify_missing_user(password)
+            
+            if not valid:
+                return error_response(401, 'Неверный email или пароль')
+            
+            if needs_rehash(user['password_hash']):
+                cursor.execute(
+                    "UPDATE users SET password_hash = %s WHERE id = %s",
+                    (hash_password(password), user['id'])
+                )
+            
+            token = issue_token(cursor, user)
             
             conn.commit()
-            cursor.close()
-            conn.close()
-            
-            return {
-                'statusCode': 200,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({
-                    'success': True,
-                    'token': token,
-                    'user': {'id': user['id'], 'email': user['email'], 'role': user['role']}
-                })
-            }
+            
+            return json_response({
+                'success': True,
+                'token': token,
+                'user': {'id': user['id'], 'email': user['email'], 'role': user['role']}
+            })
         
         elif action == 'verify':
             token = body_data.get('token', '')
             
             if not token:
-                return {
-                    'statusCode': 401,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'Токен не предоставлен'})
-                }
+                return error_response(401, 'Токен не предоставлен')
             
-            cursor.execute(
-                """
-                SELECT u.id, u.email, u.role 
-                FROM sessions s 
-                JOIN users u ON s.user_id = u.id 
-                WHERE s.token = %s AND s.expires_at > NOW()
-                """,
-                (token,)
-            )
-            user = cursor.fetchone()
-            
-            cursor.close()
-            conn.close()
+            user = verify_token(cursor, token)
             
             if not user:
-                return {
-                    'statusCode': 401,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'Недействительный токен'})
-                }
-            
-            return {
-                'statusCode': 200,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({
-                    'success': True,
-                    'user': {'id': user['id'], 'email': user['email'], 'role': user['role']}
-                })
-            }
+                return error_response(401, 'Недействительный токен')
+            
+            return json_response({
+                'success': True,
+                'user': {'id': user['id'], 'email': user['email'], 'role': user['role']}
+            })
+        
+        elif action == 'logout':
+            token = body_data.get('token', '')
+            
+            if not token:
+                return error_response(401, 'Токен не предоставлен')
+            
+            revoke_token(cursor, token)
+            conn.commit()
+            
+            return json_response({'success': True})
         
         else:
-            cursor.close()
-            conn.close()
-            return {
-                'statusCode': 400,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'error': 'Неизвестное действие'})
-            }
-    
-    except Exception as e:
-        return {
-            'statusCode': 500,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': f'Ошибка сервера: {str(e)}'})
-        }
+            return error_response(400, 'Неизвестное действие')
@@ -0,0 +1,119 @@
+'''
+Business: Хэширование паролей солёным KDF (scrypt или PBKDF2) в отдельном пуле потоков
+Args: PASSWORD_KDF (scrypt|pbkdf2), PASSWORD_SCRYPT_N, PASSWORD_SCRYPT_R, PASSWORD_SCRYPT_P,
+      PASSWORD_PBKDF2_ITERATIONS, PASSWORD_HASH_WORKERS, PASSWORD_HASH_TIMEOUT из окружения
+Returns: hash_password(), verify_password(), needs_rehash()
+'''
+import os
+import hmac
+import base64
+import hashlib
+import secrets
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any
+
+KDF = os.environ.get('PASSWORD_KDF', 'scrypt')
+SCRYPT_N = int(os.environ.get('PASSWORD_SCRYPT_N', '16384'))
+SCRYPT_R = int(os.environ.get('PASSWORD_SCRYPT_R', '8'))
+SCRYPT_P = int(os.environ.get('PASSWORD_SCRYPT_P', '1'))
+PBKDF2_ITERATIONS = int(os.environ.get('PASSWORD_PBKDF2_ITERATIONS', '600000'))
+HASH_TIMEOUT = float(os.environ.get('PASSWORD_HASH_TIMEOUT', '10'))
+
+SALT_SIZE = 16
+KEY_SIZE = 32
+
+# scrypt и pbkdf2_hmac отпускают GIL, поэтому ограниченный пул не даёт всплеску логинов
+# занять все ядра контейнера: лишние запросы ждут в очереди, а не конкурируют за CPU
+_executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get('PASSWORD_HASH_WORKERS', '2')),
+    thread_name_prefix='password-hash'
+)
+
+
+def _b64encode(raw: bytes) -> str:
+    return base64.b64encode(raw).decode('ascii').rstrip('=')
+
+
+def _b64decode(text: str) -> bytes:
+    return base64.b64decode(text + '=' * (-len(text) % 4))
+
+
+def current_params() -> Dict[str, Any]:
+    if KDF == 'pbkdf2':
+        return {'kdf': 'pbkdf2_sha256', 'iterations': PBKDF2_ITERATIONS}
+    return {'kdf': 'scrypt', 'n': SCRYPT_N, 'r': SCRYPT_R, 'p': SCRYPT_P}
+
+
+def _derive(password: str, salt: bytes, params: Dict[str, Any]) -> bytes:
+    if params['kdf'] == 'pbkdf2_sha256':
+        return hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), salt, params['iterations'], KEY_SIZE)
+    n, r, p = params['n'], params['r'], params['p']
+    return hashlib.scrypt(password.encode('utf-8'), salt=salt, n=n, r=r, p=p,
+                          maxmem=256 * n * r + 1024 * 1024, dklen=KEY_SIZE)
+
+
+def _encode(params: Dict[str, Any], salt: bytes, key: bytes) -> str:
+    if params['kdf'] == 'pbkdf2_sha256':
+        cost = str(params['iterations'])
+    else:
+        cost = f"{params['n']}${params['r']}${params['p']}"
+    return f"{params['kdf']}${cost}${_b64encode(salt)}${_b64encode(key)}"
+
+
+def _decode(password_hash: str) -> Dict[str, Any]:
+    parts = password_hash.split('$')
+    if parts[0] == 'pbkdf2_sha256' and len(parts) == 4:
+        return {'kdf': parts[0], 'iterations': int(parts[1]),
+                'salt': _b64decode(parts[2]), 'key': _b64decode(parts[3])}
+    if parts[0] == 'scrypt' and len(parts) == 6:
+        return {'kdf': parts[0], 'n': int(parts[1]), 'r': int(parts[2]), 'p': int(parts[3]),
+                'salt': _b64decode(parts[4]), 'key': _b64decode(parts[5])}
+    # Старый формат: SHA-256 hex без соли
+    return {'kdf': 'sha256', 'key': password_hash}
+
+
+def hash_password_sync(password: str, params: Dict[str, Any] = None) -> str:
+    params = params or current_params()
+    salt = secrets.token_bytes(SALT_SIZE)
+    return _encode(params, salt, _derive(password, salt, params))
+
+
+def verify_password_sync(password: str, password_hash: str) -> bool:
+    try:
+        stored = _decode(password_hash or '')
+        if stored['kdf'] == 'sha256':
+            legacy = hashlib.sha256(password.encode()).hexdigest()
+            return hmac.compare_digest(legacy, stored['key'])
+        return hmac.compare_digest(_derive(password, stored['salt'], stored), stored['key'])
+    except (ValueError, TypeError):
+        # Битый хэш в БД (не base64, не число, недопустимые параметры KDF) - неудачный вход,
+        # а не 500; KDF по фиктивному хэшу выравнивает время ответа
+        verify_password_sync(password, _dummy_hash())
+        return False
+
+
+def needs_rehash(password_hash: str) -> bool:
+    '''Старый SHA-256 или параметры стоимости, отличные от текущих'''
+    stored = _decode(password_hash or '')
+    params = current_params()
+    return any(stored.get(name) != value for name, value in params.items())
+
+
+def hash_password(password: str) -> str:
+    return _executor.submit(hash_password_sync, password).result(timeout=HASH_TIMEOUT)
+
+
+def verify_password(password: str, password_hash: str) -> bool:
+    return _executor.submit(verify_password_sync, password, password_hash).result(timeout=HASH_TIMEOUT)
+
+
+@lru_cache(maxsize=1)
+def _dummy_hash() -> str:
+    return hash_password_sync(secrets.token_urlsafe(16))
+
+
+def verify_missing_user(password: str) -> bool:
+    '''Тот же KDF для несуществующего email: время ответа не выдаёт, зарегистрирован ли адрес'''
+    verify_password(password, _dummy_hash())
+    return False
@@ -0,0 +1,283 @@
+'''
+Business: Быстрая проверка токенов - LRU-кэш сессий, подписанные токены без обращения к БД и очистка истёкших сессий
+Args: AUTH_TOKEN_MODE (session|signed), AUTH_TOKEN_SECRET, AUTH_SESSION_CACHE_SIZE, AUTH_SESSION_CACHE_TTL,
+      AUTH_SESSION_SWEEP_INTERVAL, AUTH_SESSION_SWEEP_BATCH из окружения
+Returns: issue_token(), verify_token(), revoke_token() и фоновый sweeper для таблицы sessions
+'''
+import os
+import hmac
+import json
+import time
+import base64
+import hashlib
+import logging
+import secrets
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Dict, Any, Optional, Tuple
+from psycopg2.extras import RealDictCursor
+from db import get_connection
+
+logger = logging.getLogger(__name__)
+
+SESSION_DAYS = 30
+TOKEN_MODE = os.environ.get('AUTH_TOKEN_MODE', 'session')
+REVOCATION_CHANNEL = 'auth_sessions'
+SWEEP_LOCK_ID = 7340003
+SWEEP_INTERVAL = float(os.environ.get('AUTH_SESSION_SWEEP_INTERVAL', '3600'))
+SWEEP_BATCH = int(os.environ.get('AUTH_SESSION_SWEEP_BATCH', '1000'))
+
+SIGNED_PREFIX = 'v1.'
+_SIGNATURE_SIZE = 16
+
+
+def _secret() -> Optional[bytes]:
+    # Ключ из DATABASE_URL угадывается по строке подключения, поэтому подписанные токены
+    # выдаются и принимаются только с явным секретом; в режиме signed без него функция не стартует
+    secret = os.environ.get('AUTH_TOKEN_SECRET')
+    if secret:
+        return secret.encode('utf-8')
+    if TOKEN_MODE == 'signed':
+        raise RuntimeError('AUTH_TOKEN_SECRET обязателен при AUTH_TOKEN_MODE=signed')
+    return None
+
+
+_SECRET = _secret()
+
+
+def token_key(token: str) -> str:
+    '''Кэш и уведомления работают с хэшем, сам токен в памяти и в NOTIFY не хранится'''
+    return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+
+class SessionCache:
+    '''LRU token -> (user, expires_at); запись живёт не дольше ttl и не дольше самой сессии'''
+
+    def __init__(self, max_size: int = 10000, ttl: float = 300.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'revoked_hits': 0, 'evictions': 0, 'revocations': 0}
+
+    def get(self, key: str) -> Tuple[Optional[Dict[str, Any]], bool]:
+        '''(user, revoked): user - кэшированный пользователь, revoked - токен отозван'''
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or item[1] <= time.time():
+                if item is not None:
+                    del self._data[key]
+                self._stats['misses'] += 1
+                return None, False
+            self._data.move_to_end(key)
+            if item[0] is None:
+                self._stats['revoked_hits'] += 1
+                return None, True
+            self._stats['hits'] += 1
+            return item[0], False
+
+    def _put(self, key: str, user: Optional[Dict[str, Any]], until: float) -> None:
+        self._data[key] = (user, until)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+            self._stats['evictions'] += 1
+
+    def set(self, key: str, user: Dict[str, Any], expires_at: float) -> None:
+        with self._lock:
+            self._put(key, user, min(time.time() + self.ttl, expires_at))
+
+    def revoke(self, key: str, expires_at: Optional[float] = None) -> None:
+        '''Отрицательная запись до истечения токена; без срока - на ttl кэша'''
+        with self._lock:
+            self._stats['revocations'] += 1
+            self._put(key, None, expires_at or time.time() + self.ttl)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return dict(self._stats, size=len(self._data), max_size=self.max_size)
+
+
+session_cache = SessionCache(
+    max_size=int(os.environ.get('AUTH_SESSION_CACHE_SIZE', '10000')),
+    ttl=float(os.environ.get('AUTH_SESSION_CACHE_TTL', '300')),
+)
+
+
+def _b64encode(raw: bytes) -> str:
+    return base64.urlsafe_b64encode(raw).rstrip(b'=').decode('ascii')
+
+
+def _b64decode(text: str) -> bytes:
+    return base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+
+
+def _sign(payload: str) -> str:
+    return _b64encode(hmac.new(_SECRET, payload.encode('ascii'), hashlib.sha256).digest()[:_SIGNATURE_SIZE])
+
+
+def issue_signed_token(user: Dict[str, Any], expires_at: datetime) -> str:
+    claims = {'id': user['id'], 'email': user['email'], 'role': user['role'],
+              'exp': int((expires_at - datetime(1970, 1, 1)).total_seconds())}
+    payload = _b64encode(json.dumps(claims, separators=(',', ':'), ensure_ascii=False).encode('utf-8'))
+    return f'{SIGNED_PREFIX}{payload}.{_sign(payload)}'
+
+
+def parse_signed_token(token: str) -> Optional[Dict[str, Any]]:
+    '''Проверка подписи и срока без БД; None, если токен не подписан нами или истёк'''
+    if _SECRET is None:
+        return None
+    payload, _, signature = token[len(SIGNED_PREFIX):].partition('.')
+    if not payload or not hmac.compare_digest(signature, _sign(payload)):
+        return None
+    try:
+        claims = json.loads(_b64decode(payload))
+    except ValueError:
+        return None
+    if claims.get('exp', 0) <= time.time():
+        return None
+    return claims
+
+
+def issue_token(cursor, user: Dict[str, Any]) -> str:
+    '''Новый токен: подписанный (AUTH_TOKEN_MODE=signed) или строка в sessions'''
+    expires_at = datetime.utcnow() + timedelta(days=SESSION_DAYS)
+    if TOKEN_MODE == 'signed':
+        return issue_signed_token(user, expires_at)
+    token = secrets.token_urlsafe(32)
+    cursor.execute(
+        "INSERT INTO sessions (user_id, token, expires_at) VALUES (%s, %s, %s)",
+        (user['id'], token, expires_at)
+    )
+    return token
+
+
+def verify_token(cursor, token: str) -> Optional[Dict[str, Any]]:
+    '''Пользователь по токену; None для пустого, чужого, истёкшего или не строкового токена'''
+    if not isinstance(token, str) or not token:
+        return None
+    key = token_key(token)
+    user, revoked = session_cache.get(key)
+    if revoked:
+        return None
+    if user:
+        return user
+
+    if token.startswith(SIGNED_PREFIX):
+        claims = parse_signed_token(token)
+        if not claims:
+            return None
+        user = {'id': claims['id'], 'email': claims['email'], 'role': claims['role']}
+        session_cache.set(key, user, claims['exp'])
+        return user
+
+    cursor.execute(
+        """
+        SELECT u.id, u.email, u.role, EXTRACT(EPOCH FROM s.expires_at) AS expires_at
+        FROM sessions s
+        JOIN users u ON s.user_id = u.id
+        WHERE s.token = %s AND s.expires_at > NOW()
+        """,
+        (token,)
+    )
+    row = cursor.fetchone()
+    if not row:
+        return None
+    user = {'id': row['id'], 'email': row['email'], 'role': row['role']}
+    session_cache.set(key, user, float(row['expires_at']))
+    return user
+
+
+def revoke_token(cursor, token: str) -> None:
+    '''Удаляет сессию и рассылает отзыв по контейнерам; подписанный токен отзывается до своего exp'''
+    if not isinstance(token, str) or not token:
+        return
+    key = token_key(token)
+    claims = parse_signed_token(token) if token.startswith(SIGNED_PREFIX) else None
+    expires_at = claims['exp'] if claims else None
+    if not token.startswith(SIGNED_PREFIX):
+        cursor.execute("DELETE FROM sessions WHERE token = %s", (token,))
+    cursor.execute(
+        "SELECT pg_notify(%s, %s)",
+        (REVOCATION_CHANNEL, f'{key}:{expires_at or ""}')
+    )
+    session_cache.revoke(key, expires_at)
+
+
+def listen_for_revocations(conn) -> None:
+    '''Хук пула: подписывает новое соединение на отзывы токенов из других контейнеров'''
+    with conn.cursor() as cursor:
+        cursor.execute(f'LISTEN {REVOCATION_CHANNEL}')
+    conn.commit()
+
+
+def apply_revocations(conn) -> None:
+    conn.poll()
+    while conn.notifies:
+        notify = conn.notifies.pop(0)
+        if notify.channel != REVOCATION_CHANNEL:
+            continue
+        key, _, expires_at = notify.payload.partition(':')
+        session_cache.revoke(key, float(expires_at) if expires_at else None)
+
+
+def sweep_expired_sessions(cursor, batch: int = SWEEP_BATCH) -> int:
+    '''Удаляет истёкшие сессии пачками по batch строк, каждая пачка - отдельная транзакция.
+    Блокировка берётся на транзакцию пачки: её снимает и commit, и откат после ошибки'''
+    conn = cursor.connection
+    deleted = 0
+    while True:
+        cursor.execute("SELECT pg_try_advisory_xact_lock(%s) AS locked", (SWEEP_LOCK_ID,))
+        if not cursor.fetchone()['locked']:
+            conn.rollback()
+            return deleted
+        cursor.execute(
+            """
+            DELETE FROM sessions WHERE id IN (
+                SELECT id FROM sessions WHERE expires_at < NOW() LIMIT %s
+            )
+            """,
+            (batch,)
+        )
+        count = cursor.rowcount
+        conn.commit()
+        deleted += count
+        if count < batch:
+            return deleted
+
+
+class SessionSweeper:
+    '''Фоновый поток контейнера auth: раз в interval секунд чистит истёкшие сессии'''
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def ensure_started(self) -> None:
+        if self.interval <= 0:
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='session-sweeper', daemon=True)
+                self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            time.sleep(self.interval)
+            try:
+                with get_connection() as conn, conn.cursor(cursor_factory=RealDictCursor) as cursor:
+                    deleted = sweep_expired_sessions(cursor)
+                if deleted:
+                    logger.info('session sweeper deleted %s expired sessions', deleted)
+            except Exception:
+                logger.exception('session sweep failed')
+
+
+session_sweeper = SessionSweeper(SWEEP_INTERVAL)
+
+
+if __name__ == '__main__':
+    with get_connection() as conn, conn.cursor(cursor_factory=RealDictCursor) as cursor:
+        print(f'sessions: deleted {sweep_expired_sessions(cursor)} expired rows')
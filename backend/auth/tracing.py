@@ -0,0 +1,193 @@
+'''
+Business: Трассировка запроса - время на соединение, каждый SQL, commit и сериализацию JSON
+Args: TRACE_SAMPLE_RATE, TRACE_SLOW_QUERY_MS, TRACE_SLOW_REQUEST_MS, TRACE_SERVER_TIMING из окружения
+Returns: start_trace()/finish_trace() для каркаса ответов, span() для этапов, TracedCursorMixin для курсоров -
+         заголовок Server-Timing и одна JSON-строка лога на запрос с ключом context.request_id
+'''
+import os
+import re
+import sys
+import json
+import time
+import random
+import hashlib
+import logging
+import functools
+import contextvars
+from typing import Dict, Any, List, Optional
+
+SAMPLE_RATE = float(os.environ.get('TRACE_SAMPLE_RATE', '1'))
+SLOW_QUERY_SECONDS = float(os.environ.get('TRACE_SLOW_QUERY_MS', '100')) / 1000
+SLOW_REQUEST_SECONDS = float(os.environ.get('TRACE_SLOW_REQUEST_MS', '1000')) / 1000
+SERVER_TIMING = os.environ.get('TRACE_SERVER_TIMING', '1') == '1'
+MAX_QUERIES = 50
+FINGERPRINT_PREFIX = 2000
+
+logger = logging.getLogger('trace')
+if not logger.handlers:
+    # Строки трассировки нужны в логе функции независимо от настройки корневого логгера
+    _handler = logging.StreamHandler(sys.stdout)
+    _handler.setFormatter(logging.Formatter('%(message)s'))
+    logger.addHandler(_handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+_current: contextvars.ContextVar = contextvars.ContextVar('trace', default=None)
+
+_LITERALS = re.compile(r"'(?:[^']|'')*'|%\(\w+\)s|%s|\b\d+(?:\.\d+)?\b")
+_VALUE_LISTS = re.compile(r'(VALUES \([^()]*\))(?:, ?\([^()]*\))+', re.IGNORECASE)
+_SPACES = re.compile(r'\s+')
+
+
+@functools.lru_cache(maxsize=512)
+def fingerprint(query: str) -> str:
+    '''Текст запроса без литералов и параметров: одинаковые запросы с разными значениями дают один отпечаток'''
+    normalized = _SPACES.sub(' ', _LITERALS.sub('?', query[:FINGERPRINT_PREFIX])).strip()
+    normalized = _VALUE_LISTS.sub(r'\1, ...', normalized)
+    return hashlib.blake2b(normalized.encode('utf-8'), digest_size=6).hexdigest() + ' ' + normalized[:120]
+
+
+class Trace:
+    __slots__ = ('request_id', 'function', 'started', 'spans', 'queries', 'query_count', 'db_seconds')
+
+    def __init__(self, request_id: Optional[str], function: str):
+        self.request_id = request_id
+        self.function = function
+        self.started = time.perf_counter()
+        self.spans: Dict[str, float] = {}
+        self.queries: List[Dict[str, Any]] = []
+        self.query_count = 0
+        self.db_seconds = 0.0
+
+
+class _Span:
+    __slots__ = ('trace', 'name', 'started')
+
+    def __init__(self, trace: Trace, name: str):
+        self.trace = trace
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        spans = self.trace.spans
+        spans[self.name] = spans.get(self.name, 0.0) + time.perf_counter() - self.started
+        return False
+
+
+class _NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NULL_SPAN = _NullSpan()
+
+
+def span(name: str):
+    '''Этап запроса (connect, commit, encode); без трассировки - пустой контекст без замеров'''
+    trace = _current.get()
+    return _Span(trace, name) if trace is not None else NULL_SPAN
+
+
+def record_query(query: Any, seconds: float, rows: int) -> None:
+    trace = _current.get()
+    if trace is None and seconds < SLOW_QUERY_SECONDS:
+        return
+    if isinstance(query, bytes):
+        query = query[:FINGERPRINT_PREFIX].decode('utf-8', 'replace')
+    elif not isinstance(query, str):
+        query = type(query).__name__
+    if trace is not None:
+        trace.query_count += 1
+        trace.db_seconds += seconds
+        if len(trace.queries) < MAX_QUERIES:
+            trace.queries.append({'fp': fingerprint(query), 'ms': round(seconds * 1000, 3), 'rows': rows})
+    if seconds >= SLOW_QUERY_SECONDS:
+        logger.warning(json.dumps({
+            'event': 'slow_query',
+            'request_id': trace.request_id if trace is not None else None,
+            'fp': fingerprint(query),
+            'ms': round(seconds * 1000, 3),
+            'rows': rows,
+        }, ensure_ascii=False))
+
+
+class TracedCursorMixin:
+    '''Подмешивается к любому классу курсора (см. db.PooledConnection.cursor): время, строки и отпечаток запроса'''
+
+    def execute(self, query, vars=None):
+        started = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            record_query(query, time.perf_counter() - started, self.rowcount)
+
+    def executemany(self, query, vars_list):
+        started = time.perf_counter()
+        try:
+            return super().executemany(query, vars_list)
+        finally:
+            record_query(query, time.perf_counter() - started, self.rowcount)
+
+
+_traced_classes: Dict[type, type] = {}
+
+
+def traced_cursor_class(base: type) -> type:
+    cls = _traced_classes.get(base)
+    if cls is None:
+        cls = _traced_classes[base] = type(f'Traced{base.__name__}', (TracedCursorMixin, base), {})
+    return cls
+
+
+def start_trace(context: Any, function: str) -> Optional[Trace]:
+    '''Трассировка запроса; при TRACE_SAMPLE_RATE < 1 остальные запросы проходят без замеров'''
+    if SAMPLE_RATE < 1 and random.random() >= SAMPLE_RATE:
+        _current.set(None)
+        return None
+    trace = Trace(getattr(context, 'request_id', None), function)
+    _current.set(trace)
+    return trace
+
+
+def finish_trace(trace: Optional[Trace], event: Dict[str, Any], response: Dict[str, Any],
+                 error: Optional[BaseException] = None) -> Dict[str, Any]:
+    '''Добавляет Server-Timing и пишет строку лога; сбрасывает текущую трассировку'''
+    if trace is None:
+        return response
+    _current.set(None)
+    total = time.perf_counter() - trace.started
+    spans = dict(trace.spans, db=trace.db_seconds)
+
+    if SERVER_TIMING:
+        parts = [f'{name};dur={seconds * 1000:.2f}' for name, seconds in spans.items() if name != 'db']
+        parts.append(f'db;dur={trace.db_seconds * 1000:.2f};desc="{trace.query_count} queries"')
+        parts.append(f'total;dur={total * 1000:.2f}')
+        headers = response.setdefault('headers', {})
+        headers['Server-Timing'] = ', '.join(parts)
+        headers['Timing-Allow-Origin'] = '*'
+
+    params = event.get('queryStringParameters') or {}
+    line = {
+        'event': 'request',
+        'request_id': trace.request_id,
+        'function': trace.function,
+        'method': event.get('httpMethod', 'GET'),
+        'action': params.get('action'),
+        'status': response.get('statusCode'),
+        'ms': round(total * 1000, 3),
+        'spans': {name: round(seconds * 1000, 3) for name, seconds in spans.items()},
+        'queries': trace.queries,
+    }
+    if error is not None:
+        line['error'] = f'{type(error).__name__}: {error}'
+    level = logging.WARNING if error is not None or total >= SLOW_REQUEST_SECONDS else logging.INFO
+    logger.log(level, json.dumps(line, ensure_ascii=False, default=str))
+    return response
@@ -4,92 +4,105 @@ Args: event - dict с httpMethod, body, queryStringParameters
       context - object с request_id
 Returns: HTTP response со списком офферов или результатом операции
 '''
-import json
 import os
+import json
 from typing import Dict, Any
-import psycopg2
 from psycopg2.extras import RealDictCursor
+from db import get_connection, get_pool
+from responses import http_handler, json_response, error_response, dumps, JsonRowCursor
+from listing import OFFER_COUNTS_JOIN, OFFER_COUNTS_COLUMNS, parse_list_params, fetch_offer_page
+from response_cache import ResponseCache
+from pixel_script import PIXEL_SCRIPT_URL
+
+PIXEL_CACHE_CHANNEL = 'pixel_cache'
+OFFERS_CHANGED_CHANNEL = 'offers_changed'
+
+# Ответы GET живут до OFFERS_CACHE_TTL (счётчики кликов) или до первого изменения офферов
+offers_cache = ResponseCache(
+    max_size=int(os.environ.get('OFFERS_CACHE_SIZE', '1000')),
+    ttl=float(os.environ.get('OFFERS_CACHE_TTL', '30')),
+)
+
+def notify_offer_changed(cursor, offer_id: Any) -> None:
+    cursor.execute("SELECT pg_notify(%s, %s)", (PIXEL_CACHE_CHANNEL, f'offer:{offer_id}'))
+
+def notify_offers_changed(cursor) -> None:
+    cursor.execute("SELECT pg_notify(%s, '')", (OFFERS_CHANGED_CHANNEL,))
+
+def listen_for_offer_changes(conn) -> None:
+    with conn.cursor() as cursor:
+        cursor.execute(f'LISTEN {OFFERS_CHANGED_CHANNEL}')
+    conn.commit()
+
+def apply_offer_changes(conn) -> None:
+    conn.poll()
+    changed = False
+    while conn.notifies:
+        changed = conn.notifies.pop(0).channel == OFFERS_CHANGED_CHANNEL or changed
+    if changed:
+        offers_cache.bump()
 
-def get_db_connection():
-    return psycopg2.connect(os.environ['DATABASE_URL'])
+get_pool().on_connect.append(listen_for_offer_changes)
 
+@http_handler(methods=('GET', 'POST', 'PUT'), allow_headers='Content-Type, X-Auth-Token, If-None-Match')
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     method: str = event.get('httpMethod', 'GET')
+    params = event.get('queryStringParameters', {}) or {}
+    cache_key = ResponseCache.key(params)
     
-    if method == 'OPTIONS':
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'GET, POST, PUT, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, X-Auth-Token',
-                'Access-Control-Max-Age': '86400'
-            },
-            'body': ''
-        }
+    # Попадание в кэш отдаётся без соединения с БД: сброс от других контейнеров - по NOTIFY,
+    # которые уже получили простаивающие соединения пула
+    if method == 'GET':
+        get_pool().poll_idle(apply_offer_changes)
+        cached = offers_cache.get(cache_key)
+        if cached:
+            return offers_cache.respond(cached, event)
     
-    try:
-        conn = get_db_connection()
-        cursor = conn.cursor(cursor_factory=RealDictCursor)
+    # GET только отдаёт строки в JSON - кортежи с готовым текстом денег и дат; запись - словарные строки
+    row_factory = JsonRowCursor if method == 'GET' else RealDictCursor
+    with get_connection() as conn, conn.cursor(cursor_factory=row_factory) as cursor:
+        apply_offer_changes(conn)
         
         if method == 'GET':
-            params = event.get('queryStringParameters', {}) or {}
             offer_id = params.get('id')
-            status = params.get('status', 'active')
+            version = offers_cache.version
             
             if offer_id:
                 cursor.execute(
-                    """
-                    SELECT o.*, u.email as advertiser_email,
-                           (SELECT COUNT(*) FROM clicks WHERE offer_id = o.id) as total_clicks,
-                           (SELECT COUNT(*) FROM conversions WHERE offer_id = o.id) as total_conversions
-                    FROM offers o
-                    JOIN users u ON o.advertiser_id = u.id
-                    WHERE o.id = %s
+                    f"""
+                    WITH page AS (
+                        SELECT o.*, u.email as advertiser_email
+                        FROM offers o
+                        JOIN users u ON o.advertiser_id = u.id
+                        WHERE o.id = %(id)s
+                    )
+                    SELECT page.*,
+                           {OFFER_COUNTS_COLUMNS['clicks']} as total_clicks,
+                           {OFFER_COUNTS_COLUMNS['conversions']} as total_conversions
+                    FROM page
+                    {OFFER_COUNTS_JOIN}
                     """,
-                    (offer_id,)
+                    {'id': offer_id}
                 )
                 offer = cursor.fetchone()
                 
                 if not offer:
-                    cursor.close()
-                    conn.close()
-                    return {
-                        'statusCode': 404,
-                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                        'body': json.dumps({'error': 'Оффер не найден'})
-                    }
-                
-                cursor.close()
-                conn.close()
+                    return error_response(404, 'Оффер не найден')
                 
-                return {
-                    'statusCode': 200,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps(dict(offer), default=str)
-                }
+                entry = offers_cache.put(cache_key, dumps(dict(zip(cursor.column_names(), offer))), version=version)
+                return offers_cache.respond(entry, event)
             else:
-                cursor.execute(
-                    """
-                    SELECT o.id, o.name, o.description, o.payout, o.category, o.status,
-                           (SELECT COUNT(*) FROM clicks WHERE offer_id = o.id) as clicks,
-                           (SELECT COUNT(*) FROM conversions WHERE offer_id = o.id) as conversions
-                    FROM offers o
-                    WHERE o.status = %s
-                    ORDER BY o.created_at DESC
-                    """,
-                    (status,)
-                )
-                offers = cursor.fetchall()
+                try:
+                    query = parse_list_params(params)
+                except ValueError as e:
+                    return error_response(400, str(e))
                 
-                cursor.close()
-                conn.close()
+                offers, next_after = fetch_offer_page(cursor, query)
                 
-                return {
-                    'statusCode': 200,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps([dict(o) for o in offers], default=str)
-                }
+                # Тело - прежний массив; курсор следующей страницы - в заголовке
+                headers = {'X-Next-After': str(next_after)} if next_after is not None else {}
+                entry = offers_cache.put(cache_key, dumps(offers), headers, version=version)
+                return offers_cache.respond(entry, event)
         
         elif method == 'POST':
             body_data = json.loads(event.get('body', '{}'))
@@ -101,13 +114,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             advertiser_id = body_data.get('advertiser_id')
             
             if not name or not advertiser_id or payout < 500:
-                cursor.close()
-                conn.close()
-                return {
-                    'statusCode': 400,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'Неверные данные. Минимальная ставка 500₽'})
-                }
+                return error_response(400, 'Неверные данные. Минимальная ставка 500₽')
             
             prepayment_amount = payout * 20
             
@@ -122,27 +129,23 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             )
             offer_id = cursor.fetchone()['id']
             
-            pixel_code = f'<script src="https://cpasibo.pro/pixel.js" data-offer-id="{offer_id}"></script>'
+            pixel_code = f'<script src="{PIXEL_SCRIPT_URL}" data-offer-id="{offer_id}"></script>'
             
             cursor.execute(
                 "UPDATE offers SET pixel_code = %s WHERE id = %s",
                 (pixel_code, offer_id)
             )
+            notify_offers_changed(cursor)
             
             conn.commit()
-            cursor.close()
-            conn.close()
+            offers_cache.bump()
             
-            return {
-                'statusCode': 200,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({
-                    'success': True,
-                    'offer_id': offer_id,
-                    'pixel_code': pixel_code,
-                    'prepayment_amount': float(prepayment_amount)
-                })
-            }
+            return json_response({
+                'success': True,
+                'offer_id': offer_id,
+                'pixel_code': pixel_code,
+                'prepayment_amount': float(prepayment_amount)
+            })
         
         elif method == 'PUT':
             body_data = json.loads(event.get('body', '{}'))
@@ -150,64 +153,40 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             action = body_data.get('action')
             
             if not offer_id:
-                cursor.close()
-                conn.close()
-                return {
-                    'statusCode': 400,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'offer_id обязателен'})
-                }
+                return error_response(400, 'offer_id обязателен')
             
             if action == 'activate':
                 cursor.execute(
                     "UPDATE offers SET status = 'active' WHERE id = %s AND test_lead_completed = true AND prepayment_paid = true",
                     (offer_id,)
                 )
+                activated = cursor.rowcount
+                if activated:
+                    notify_offer_changed(cursor, offer_id)
+                    notify_offers_changed(cursor)
                 conn.commit()
+                if activated:
+                    offers_cache.bump()
                 
-                if cursor.rowcount == 0:
-                    cursor.close()
-                    conn.close()
-                    return {
-                        'statusCode': 400,
-                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                        'body': json.dumps({'error': 'Не выполнены условия активации'})
-                    }
+                if activated == 0:
+                    return error_response(400, 'Не выполнены условия активации')
             
             elif action == 'test_lead':
                 cursor.execute(
                     "UPDATE offers SET test_lead_completed = true WHERE id = %s",
                     (offer_id,)
                 )
+                notify_offers_changed(cursor)
                 conn.commit()
+                offers_cache.bump()
             
             elif action == 'prepayment':
                 cursor.execute(
                     "UPDATE offers SET prepayment_paid = true WHERE id = %s",
                     (offer_id,)
                 )
+                notify_offers_changed(cursor)
                 conn.commit()
+                offers_cache.bump()
             
-            cursor.close()
-            conn.close()
-            
-            return {
-                'statusCode': 200,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'success': True})
-            }
-        
-        cursor.close()
-        conn.close()
-        return {
-            'statusCode': 405,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Метод не поддерживается'})
-        }
-    
-    except Exception as e:
-        return {
-            'statusCode': 500,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': f'Ошибка сервера: {str(e)}'})
-        }
+            return json_response({'success': True})
@@ -0,0 +1,115 @@
+'''
+Business: Список офферов с keyset-пагинацией, выбором полей и счётчиками кликов/конверсий без COUNT(*) на оффер
+Args: queryStringParameters (status, category, min_payout, max_payout, fields, after, limit)
+Returns: parse_list_params() - проверенные параметры, fetch_offer_page() - страница офферов и курсор следующей
+'''
+from typing import Dict, Any, List, Optional, Tuple
+
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 500
+
+# Поле ответа -> выражение в CTE page; clicks/conversions считаются только если их запросили
+LIST_FIELDS = {
+    'id': 'o.id',
+    'name': 'o.name',
+    'description': 'o.description',
+    'payout': 'o.payout',
+    'category': 'o.category',
+    'status': 'o.status',
+    'created_at': 'o.created_at',
+}
+COUNTER_FIELDS = ('clicks', 'conversions')
+DEFAULT_FIELDS = ['id', 'name', 'description', 'payout', 'category', 'status', 'clicks', 'conversions']
+
+# Счётчики до отметки почасовых агрегатов + сырые события после неё (обычно меньше часа);
+# LATERAL по каждому офферу страницы идёт коротким диапазоном индекса (offer_id, время)
+WATERMARK_SQL = "(SELECT rolled_until FROM rollup_watermarks WHERE name = 'stats_hourly')"
+OFFER_COUNTS_JOIN = f'''
+    LEFT JOIN offer_counters oc ON oc.offer_id = page.id
+    LEFT JOIN LATERAL (
+        SELECT COUNT(*) AS clicks FROM clicks
+        WHERE offer_id = page.id AND clicked_at >= {WATERMARK_SQL}
+    ) rc ON true
+    LEFT JOIN LATERAL (
+        SELECT COUNT(*) AS conversions FROM conversions
+        WHERE offer_id = page.id AND converted_at >= {WATERMARK_SQL}
+    ) rv ON true
+'''
+OFFER_COUNTS_COLUMNS = {
+    'clicks': 'COALESCE(oc.clicks, 0) + rc.clicks',
+    'conversions': 'COALESCE(oc.conversions, 0) + rv.conversions',
+}
+
+
+def parse_list_params(params: Dict[str, Any]) -> Dict[str, Any]:
+    '''ValueError с текстом для ответа 400 при неверных параметрах'''
+    # Повтор поля (fields=name,name) дал бы в запросе две колонки с одним именем
+    fields = list(dict.fromkeys(name.strip() for name in params.get('fields', '').split(',') if name.strip())) \
+        or DEFAULT_FIELDS
+    unknown = [name for name in fields if name not in LIST_FIELDS and name not in COUNTER_FIELDS]
+    if unknown:
+        raise ValueError(f"Неизвестные поля: {', '.join(unknown)}")
+
+    try:
+        limit = int(params.get('limit', DEFAULT_LIMIT))
+        after = int(params['after']) if params.get('after') else None
+        min_payout = float(params['min_payout']) if params.get('min_payout') else None
+        max_payout = float(params['max_payout']) if params.get('max_payout') else None
+    except ValueError:
+        raise ValueError('Неверные параметры limit, after или payout')
+    if limit < 1 or limit > MAX_LIMIT:
+        raise ValueError(f'limit должен быть от 1 до {MAX_LIMIT}')
+
+    return {
+        'fields': fields,
+        'status': params.get('status', 'active'),
+        'category': params.get('category') or None,
+        'min_payout': min_payout,
+        'max_payout': max_payout,
+        'after': after,
+        'limit': limit,
+    }
+
+
+def build_list_query(query: Dict[str, Any]) -> str:
+    fields = query['fields']
+    page_columns = ['id', 'created_at'] + [name for name in fields if name in LIST_FIELDS and name not in ('id', 'created_at')]
+    conditions = ['o.status = %(status)s']
+    if query['category'] is not None:
+        conditions.append('o.category = %(category)s')
+    if query['min_payout'] is not None:
+        conditions.append('o.payout >= %(min_payout)s')
+    if query['max_payout'] is not None:
+        conditions.append('o.payout <= %(max_payout)s')
+    if query['after'] is not None:
+        conditions.append('(o.created_at, o.id) < (SELECT created_at, id FROM offers WHERE id = %(after)s)')
+
+    with_counts = any(name in COUNTER_FIELDS for name in fields)
+    select = ', '.join(
+        f'{OFFER_COUNTS_COLUMNS[name]} AS {name}' if name in COUNTER_FIELDS else f'page.{name}'
+        for name in ['id', 'created_at'] + [name for name in fields if name not in ('id', 'created_at')]
+    )
+    # Лишняя строка сверх limit показывает, что есть следующая страница
+    return f'''
+        WITH page AS (
+            SELECT {', '.join(f'{LIST_FIELDS[name]} AS {name}' for name in page_columns)}
+            FROM offers o
+            WHERE {' AND '.join(conditions)}
+            ORDER BY o.created_at DESC, o.id DESC
+            LIMIT %(limit)s + 1
+        )
+        SELECT {select}
+        FROM page
+        {OFFER_COUNTS_JOIN if with_counts else ''}
+        ORDER BY page.created_at DESC, page.id DESC
+    '''
+
+
+def fetch_offer_page(cursor, query: Dict[str, Any]) -> Tuple[List[Dict[str, Any]], Optional[int]]:
+    '''cursor - JsonRowCursor: строки-кортежи, первая колонка - id'''
+    cursor.execute(build_list_query(query), query)
+    rows = cursor.fetchall()
+    next_after = rows[query['limit'] - 1][0] if len(rows) > query['limit'] else None
+    positions = {name: index for index, name in enumerate(cursor.column_names())}
+    picks = [(name, positions[name]) for name in query['fields']]
+    return [{name: row[index] for name, index in picks} for row in rows[:query['limit']]], next_after
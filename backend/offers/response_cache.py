@@ -0,0 +1,94 @@
+'''
+Business: Кэш готовых JSON-ответов с сильным ETag и ответом 304 Not Modified
+Args: ключ - нормализованные параметры запроса; TTL и версия данных задаются владельцем кэша
+Returns: ResponseCache - get()/put() готовых тел и respond() с учётом If-None-Match
+'''
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Dict, Any, Optional, Tuple
+
+
+def make_etag(body: str) -> str:
+    return '"' + hashlib.sha256(body.encode('utf-8')).hexdigest()[:32] + '"'
+
+
+def request_etags(event: Dict[str, Any]) -> Tuple[str, ...]:
+    '''Значения If-None-Match (заголовки приходят в любом регистре)'''
+    for name, value in (event.get('headers') or {}).items():
+        if name.lower() == 'if-none-match' and value:
+            return tuple(tag.strip() for tag in value.split(','))
+    return ()
+
+
+class ResponseCache:
+    '''LRU готовых ответов; запись действительна до ttl и пока не сменилась версия данных'''
+
+    def __init__(self, max_size: int = 1000, ttl: float = 15.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.version = 0
+        self._data: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'not_modified': 0, 'invalidations': 0}
+
+    @staticmethod
+    def key(params: Dict[str, Any], ignore: Tuple[str, ...] = ()) -> Tuple:
+        return tuple(sorted((name, str(value)) for name, value in params.items()
+                            if value not in (None, '') and name not in ignore))
+
+    def get(self, key: Tuple) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry['version'] != self.version or entry['expires_at'] <= time.monotonic():
+                if entry is not None:
+                    del self._data[key]
+                self._stats['misses'] += 1
+                return None
+            self._data.move_to_end(key)
+            self._stats['hits'] += 1
+            return entry
+
+    def put(self, key: Tuple, body: str, headers: Optional[Dict[str, str]] = None,
+            version: Optional[int] = None) -> Dict[str, Any]:
+        '''version - версия данных на момент чтения из БД; по умолчанию текущая'''
+        entry = {
+            'body': body,
+            'etag': make_etag(body),
+            'headers': dict(headers or {}),
+            'version': self.version if version is None else version,
+            'expires_at': time.monotonic() + self.ttl,
+        }
+        with self._lock:
+            self._data[key] = entry
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+        return entry
+
+    def bump(self) -> None:
+        '''Данные изменились: все записи с прежней версией больше не отдаются'''
+        with self._lock:
+            self.version += 1
+            self._stats['invalidations'] += 1
+
+    def respond(self, entry: Dict[str, Any], event: Dict[str, Any]) -> Dict[str, Any]:
+        headers = {
+            'Content-Type': 'application/json',
+            'Access-Control-Allow-Origin': '*',
+            'Access-Control-Expose-Headers': ', '.join(['ETag'] + list(entry['headers'])),
+            'Cache-Control': 'no-cache',
+            'ETag': entry['etag'],
+        }
+        headers.update(entry['headers'])
+        tags = request_etags(event)
+        if entry['etag'] in tags or '*' in tags:
+            with self._lock:
+                self._stats['not_modified'] += 1
+            return {'statusCode': 304, 'headers': headers, 'body': ''}
+        return {'statusCode': 200, 'headers': headers, 'body': entry['body']}
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return dict(self._stats, size=len(self._data), max_size=self.max_size, version=self.version)
@@ -0,0 +1,115 @@
+'''
+Business: Общий каркас HTTP-функций - preflight, 405 и 500 в одном месте, готовые наборы заголовков и быстрый JSON
+Args: http_handler(methods, allow_headers) - декоратор handler; строки БД из JsonRowCursor для горячих чтений
+Returns: json_response(), error_response(), gif_response(), dumps() и JsonRowCursor - кортежи с JSON-готовыми значениями
+'''
+import os
+import json
+import functools
+from types import MappingProxyType
+from typing import Dict, Any, Callable, Iterable, Mapping, Optional
+import psycopg2.extensions
+from tracing import span, start_trace, finish_trace
+
+# Наборы заголовков собираются один раз при импорте; снаружи они только для чтения,
+# в ответ уходит копия (dict.copy() дешевле, чем каждый раз собирать литерал)
+_JSON_HEADERS = {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'}
+_GIF_HEADERS = {'Content-Type': 'image/gif', 'Access-Control-Allow-Origin': '*'}
+JSON_HEADERS = MappingProxyType(_JSON_HEADERS)
+GIF_HEADERS = MappingProxyType(_GIF_HEADERS)
+
+PIXEL_GIF = 'R0lGODlhAQABAIAAAAAAAP///yH5BAEAAAAALAAAAAABAAEAAAIBRAA7'
+
+# json.dumps с любым аргументом собирает новый JSONEncoder на каждый вызов; эти собраны заранее.
+# default=str остаётся только страховкой для строк RealDictCursor - JsonRowCursor до него не доходит
+_encoder = json.JSONEncoder(default=str)
+_compact_encoder = json.JSONEncoder(default=str, separators=(',', ':'))
+
+
+def dumps(data: Any, compact: bool = False) -> str:
+    with span('encode'):
+        return (_compact_encoder if compact else _encoder).encode(data)
+
+
+def json_response(data: Any, status: int = 200, headers: Optional[Mapping[str, str]] = None,
+                  compact: bool = False) -> Dict[str, Any]:
+    return {
+        'statusCode': status,
+        'headers': {**_JSON_HEADERS, **headers} if headers else _JSON_HEADERS.copy(),
+        'body': dumps(data, compact)
+    }
+
+
+def error_response(status: int, message: str) -> Dict[str, Any]:
+    return {'statusCode': status, 'headers': _JSON_HEADERS.copy(), 'body': _encoder.encode({'error': message})}
+
+
+def gif_response(status: int = 200, headers: Optional[Mapping[str, str]] = None) -> Dict[str, Any]:
+    '''Прозрачный GIF 1x1 для 200, пустое тело для ошибок пикселя'''
+    response_headers = {**_GIF_HEADERS, **headers} if headers else _GIF_HEADERS.copy()
+    if status == 200:
+        return {'statusCode': 200, 'headers': response_headers, 'body': PIXEL_GIF, 'isBase64Encoded': True}
+    return {'statusCode': status, 'headers': response_headers, 'body': '', 'isBase64Encoded': False}
+
+
+def http_handler(methods: Iterable[str], allow_headers: str = 'Content-Type') -> Callable:
+    '''
+    Обёртка handler: OPTIONS отвечает готовыми CORS-заголовками, метод вне methods - 405,
+    необработанное исключение - 500 с текстом ошибки. Сам handler разбирает только свои действия.
+    Каждый запрос трассируется (tracing.py): Server-Timing в ответе и строка лога с request_id.
+    '''
+    methods = tuple(methods)
+    allowed = frozenset(methods)
+    preflight_headers = MappingProxyType({
+        'Access-Control-Allow-Origin': '*',
+        'Access-Control-Allow-Methods': ', '.join(methods + ('OPTIONS',)),
+        'Access-Control-Allow-Headers': allow_headers,
+        'Access-Control-Max-Age': '86400'
+    })
+
+    def decorate(handler: Callable[[Dict[str, Any], Any], Dict[str, Any]]) -> Callable:
+        function = os.path.basename(os.path.dirname(os.path.abspath(handler.__code__.co_filename)))
+
+        @functools.wraps(handler)
+        def wrapper(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+            method = event.get('httpMethod', 'GET')
+            if method == 'OPTIONS':
+                return {'statusCode': 200, 'headers': preflight_headers.copy(), 'body': ''}
+            if method not in allowed:
+                return error_response(405, 'Метод не поддерживается')
+            trace = start_trace(context, function)
+            try:
+                return finish_trace(trace, event, handler(event, context))
+            except Exception as e:
+                return finish_trace(trace, event, error_response(500, f'Ошибка сервера: {str(e)}'), e)
+        return wrapper
+    return decorate
+
+
+def _timestamp_text(value: Optional[str], cursor: Any) -> Optional[str]:
+    # PostgreSQL отбрасывает хвостовые нули микросекунд, str(datetime) - нет; ответ не должен зависеть от курсора
+    if value is None:
+        return None
+    head, dot, fraction = value.partition('.')
+    return f'{head}.{fraction:0<6}' if dot else value
+
+
+NUMERIC_AS_TEXT = psycopg2.extensions.new_type((1700,), 'NUMERIC_AS_TEXT', lambda value, cursor: value)
+TIMESTAMP_AS_TEXT = psycopg2.extensions.new_type((1114,), 'TIMESTAMP_AS_TEXT', _timestamp_text)
+DATE_AS_TEXT = psycopg2.extensions.new_type((1082,), 'DATE_AS_TEXT', lambda value, cursor: value)
+
+
+class JsonRowCursor(psycopg2.extensions.cursor):
+    '''
+    Строки - кортежи, а NUMERIC, TIMESTAMP и DATE приходят текстом, совпадающим с str(Decimal) и
+    str(datetime): без Decimal/datetime на каждое значение и без default при сериализации.
+    Для чтений, которые сразу уходят в JSON; считать деньги по таким строкам нельзя.
+    '''
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        for caster in (NUMERIC_AS_TEXT, TIMESTAMP_AS_TEXT, DATE_AS_TEXT):
+            psycopg2.extensions.register_type(caster, self)
+
+    def column_names(self):
+        return [column.name for column in self.description]
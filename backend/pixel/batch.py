@@ -0,0 +1,237 @@
+'''
+Business: Пакетный приём кликов и конверсий одним POST - navigator.sendBeacon и S2S-партнёры
+Args: тело - NDJSON или JSON-массив событий {"type": "click"|"convert", "offer_id", "wm_id",
+      "click_id", "referrer", "ip", "user_agent", "event_id"}; ip и user_agent учитываются только
+      в пачке S2S-партнёра с заголовком X-Partner-Token; PIXEL_BATCH_MAX, PIXEL_PARTNER_TOKENS из окружения
+Returns: parse_events() - список событий, process_batch() - результат по каждому событию в порядке пачки,
+         queue_batch() - то же для режима очереди (PIXEL_INGEST_MODE=queue)
+'''
+import os
+import hmac
+import json
+from typing import Dict, Any, List, Optional, Tuple
+from psycopg2.extras import execute_values
+from cache import validation_cache, offer_key, webmaster_key, get_active_offers, find_webmasters, is_known_valid
+from click_filter import click_filter
+from unique_clicks import is_unique_click
+from click_ids import mint_click_id, parse_click_id
+from event_queue import QueueFull
+from ingest import BufferFull
+
+MAX_EVENTS = int(os.environ.get('PIXEL_BATCH_MAX', '5000'))
+# Только пачки с одним из этих токенов передают ip и user_agent конечного пользователя
+PARTNER_TOKENS = [token.strip().encode('utf-8')
+                  for token in os.environ.get('PIXEL_PARTNER_TOKENS', '').split(',') if token.strip()]
+
+# id клика выдаётся в CTE, чтобы вернуть его вместе с номером события в пачке:
+# RETURNING у INSERT не сохраняет порядок VALUES
+INSERT_CLICKS_SQL = '''
+    WITH v AS (
+        SELECT nextval('clicks_id_seq') AS id, v.*
+        FROM (VALUES %s) AS v(n, offer_id, webmaster_id, ip_address, user_agent, referrer, is_unique)
+    ), inserted AS (
+        INSERT INTO clicks (id, offer_id, webmaster_id, ip_address, user_agent, referrer,
+                            utm_source, utm_medium, clicked_at, is_unique)
+        SELECT id, offer_id, webmaster_id, ip_address, user_agent, referrer, 'cpasibo_pro', 'cpl',
+               LOCALTIMESTAMP, is_unique
+        FROM v
+    )
+    SELECT n, id, LOCALTIMESTAMP AS clicked_at FROM v
+'''
+INSERT_CLICKS_TEMPLATE = '(%s::int, %s::int, %s::int, %s, %s, %s, %s::boolean)'
+
+# Без подписанного click_id - последний клик пары (offer_id, wm_id), как в одиночном convert
+INSERT_CONVERSIONS_SQL = '''
+    WITH v AS (
+        SELECT v.offer_id, v.webmaster_id, v.payout, v.commission, v.ip_address,
+               COALESCE(v.click_id, (
+                   SELECT id FROM clicks
+                   WHERE offer_id = v.offer_id AND webmaster_id = v.webmaster_id
+                   ORDER BY clicked_at DESC LIMIT 1
+               )) AS click_id
+        FROM (VALUES %s) AS v(offer_id, webmaster_id, click_id, payout, commission, ip_address)
+    ), conversion AS (
+        INSERT INTO conversions (offer_id, webmaster_id, click_id, payout, commission, ip_address, status)
+        SELECT offer_id, webmaster_id, click_id, payout, commission, ip_address, 'approved' FROM v
+        RETURNING id, webmaster_id, payout
+    )
+    INSERT INTO balance_ledger (user_id, amount, reason, conversion_id)
+    SELECT webmaster_id, payout, 'conversion', id FROM conversion
+'''
+INSERT_CONVERSIONS_TEMPLATE = '(%s::int, %s::int, %s::bigint, %s::numeric, %s::numeric, %s)'
+
+
+def parse_events(body: str) -> List[Dict[str, Any]]:
+    '''ValueError с текстом для ответа 400 при неверном формате'''
+    text = (body or '').strip()
+    try:
+        if text.startswith('['):
+            events = json.loads(text)
+        else:
+            events = [json.loads(line) for line in text.splitlines() if line.strip()]
+    except json.JSONDecodeError:
+        raise ValueError('Тело должно быть NDJSON или JSON-массивом событий')
+    if not events:
+        raise ValueError('Пачка пуста')
+    if len(events) > MAX_EVENTS:
+        raise ValueError(f'Не больше {MAX_EVENTS} событий в пачке')
+    if not all(isinstance(event, dict) for event in events):
+        raise ValueError('Каждое событие должно быть JSON-объектом')
+    return events
+
+
+def is_partner_request(event: Dict[str, Any]) -> bool:
+    '''Заголовок X-Partner-Token совпадает с одним из PIXEL_PARTNER_TOKENS. Трекеры рекламодателей
+    шлют GET-постбэк по шаблону адреса без своих заголовков, поэтому токен принимается и в partner_token'''
+    token = str((event.get('queryStringParameters') or {}).get('partner_token') or '').strip()
+    for name, value in (event.get('headers') or {}).items():
+        if name.lower() == 'x-partner-token' and isinstance(value, str):
+            token = value.strip()
+    return bool(token) and any(hmac.compare_digest(token.encode('utf-8'), partner_token)
+                               for partner_token in PARTNER_TOKENS)
+
+
+def event_client(event: Dict[str, Any], ip_address: str, user_agent: str, partner: bool) -> Tuple[str, str]:
+    '''IP и User-Agent, по которым событие фильтруется и записывается. Пачка из браузера (sendBeacon)
+    пришла с соединения самого пользователя, а ip/user_agent в теле ничем не подтверждены;
+    партнёр же шлёт пачку со своего сервера и передаёт их за пользователя'''
+    if partner:
+        return (event.get('ip') or ip_address or '')[:45], event.get('user_agent') or ''
+    return (ip_address or '')[:45], user_agent or ''
+
+
+def parse_id(value: Any) -> Optional[str]:
+    '''Числовой id из события или None; не длиннее 9 цифр, чтобы влезать в INTEGER'''
+    text = str(value) if value is not None else ''
+    return text if text.isdigit() and len(text) <= 9 else None
+
+
+# Необязательные поля события и допустимые типы; null равносилен отсутствию поля
+FIELD_TYPES = {'ip': (str,), 'user_agent': (str,), 'referrer': (str,), 'click_id': (str,),
+               'event_id': (str, int)}
+
+
+def has_valid_fields(event: Dict[str, Any], field_types: Dict[str, tuple] = FIELD_TYPES) -> bool:
+    '''Число или объект вместо строки - отказ [400] одному событию, а не ошибка всей пачки'''
+    return all(event.get(name) is None or
+               (isinstance(event[name], types) and not isinstance(event[name], bool))
+               for name, types in field_types.items())
+
+
+def classify_events(events: List[Dict[str, Any]], ip_address: str, user_agent: str,
+                    results: List[Optional[list]], partner: bool = False) -> Tuple[list, list]:
+    '''Клики и конверсии пачки как (n, offer_id, wm_id, signed_click, event); отказы сразу пишутся в results'''
+    clicks, converts = [], []
+    for n, event in enumerate(events):
+        offer_id, wm_id = parse_id(event.get('offer_id')), parse_id(event.get('wm_id'))
+        if not has_valid_fields(event):
+            results[n] = [400]
+            continue
+        if event.get('type') == 'convert':
+            signed_click = parse_click_id(event.get('click_id'))
+            if signed_click and str(signed_click['offer_id']) == offer_id and \
+                    (not wm_id or str(signed_click['webmaster_id']) == wm_id):
+                wm_id = str(signed_click['webmaster_id'])
+            else:
+                signed_click = None
+            if offer_id and wm_id:
+                converts.append((n, offer_id, wm_id, signed_click, event))
+                continue
+        elif event.get('type') == 'click' and offer_id and wm_id:
+            if click_filter.check(*event_client(event, ip_address, user_agent, partner), offer_id, partner=partner):
+                results[n] = [403]
+            else:
+                clicks.append((n, offer_id, wm_id, None, event))
+            continue
+        results[n] = [400]
+    return clicks, converts
+
+
+def process_batch(cursor, events: List[Dict[str, Any]], ip_address: str, user_agent: str,
+                  click_buffer=None, partner: bool = False) -> List[list]:
+    '''Результат события: [200, click_id] для клика, [200] для конверсии, [400] или [404] при отказе,
+    [403] для клика, отсеянного фильтром ботов, [503] для клика сверх переполненного буфера (ingest.BufferFull)'''
+    results: List[Optional[list]] = [None] * len(events)
+    clicks, converts = classify_events(events, ip_address, user_agent, results, partner)
+
+    # Офферы и вебмастера всей пачки - по одному запросу на промахи кэша
+    offers = get_active_offers(cursor, [item[1] for item in clicks + converts])
+    webmasters = find_webmasters(cursor, [item[2] for item in clicks + converts])
+    for item in clicks + converts:
+        if item[1] not in offers or item[2] not in webmasters:
+            results[item[0]] = [404]
+    clicks = [item for item in clicks if results[item[0]] is None]
+    converts = [item for item in converts if results[item[0]] is None]
+
+    click_rows = []
+    for n, offer_id, wm_id, _, event in clicks:
+        ip, agent = event_client(event, ip_address, user_agent, partner)
+        click_rows.append((n, offer_id, wm_id, ip, agent, event.get('referrer', ''),
+                           is_unique_click(ip, agent, offer_id, wm_id)))
+    if click_rows and click_buffer is not None:
+        for n, offer_id, wm_id, ip, agent, referrer, is_unique in click_rows:
+            try:
+                click_id, clicked_at = click_buffer.add(offer_id, wm_id, ip, agent, referrer, is_unique=is_unique)
+            except BufferFull:
+                results[n] = [503]
+                continue
+            signed = mint_click_id(click_id, offer_id, wm_id, clicked_at)
+            results[n] = [200, signed] if signed else [200]
+    elif click_rows:
+        inserted = execute_values(cursor, INSERT_CLICKS_SQL, click_rows, template=INSERT_CLICKS_TEMPLATE,
+                                  page_size=len(click_rows), fetch=True)
+        rows_by_n = {row[0]: row for row in click_rows}
+        for row in inserted:
+            _, offer_id, wm_id = rows_by_n[row['n']][:3]
+            signed = mint_click_id(row['id'], offer_id, wm_id, row['clicked_at'])
+            results[row['n']] = [200, signed] if signed else [200]
+
+    if converts:
+        conversion_rows = []
+        for n, offer_id, wm_id, signed_click, event in converts:
+            payout = float(offers[offer_id]['payout'])
+            commission = payout * 0.20
+            conversion_rows.append((offer_id, wm_id, signed_click['click_id'] if signed_click else None,
+                                    payout - commission, commission,
+                                    event_client(event, ip_address, user_agent, partner)[0]))
+            results[n] = [200]
+        execute_values(cursor, INSERT_CONVERSIONS_SQL, conversion_rows,
+                       template=INSERT_CONVERSIONS_TEMPLATE, page_size=len(conversion_rows))
+
+    return results
+
+
+def queue_batch(events: List[Dict[str, Any]], ip_address: str, user_agent: str, event_queue,
+                partner: bool = False) -> List[list]:
+    '''Пачка в очередь событий без обращения к БД: [202, click_id] для клика, [202] для конверсии.
+    Оффер и вебмастер проверяются только по кэшу, остальное проверит воркер; click_id выдаётся
+    только для пары, которую кэш знает как действующую.
+    После переполнения очереди оставшиеся события получают [503] и повторяются клиентом'''
+    results: List[Optional[list]] = [None] * len(events)
+    clicks, converts = classify_events(events, ip_address, user_agent, results, partner)
+    for n, offer_id, wm_id, signed_click, event in sorted(clicks + converts, key=lambda item: item[0]):
+        event_id = str(event.get('event_id') or '')
+        if len(event_id) > 128:
+            results[n] = [400]
+        elif validation_cache.is_known_missing(offer_key(offer_id)) or \
+                validation_cache.is_known_missing(webmaster_key(wm_id)):
+            results[n] = [404]
+        elif event.get('type') == 'click':
+            ip, agent = event_client(event, ip_address, user_agent, partner)
+            try:
+                click_id, clicked_at = event_queue.add(offer_id, wm_id, ip, agent, event.get('referrer', ''),
+                                                       is_unique=is_unique_click(ip, agent, offer_id, wm_id))
+            except QueueFull:
+                results[n] = [503]
+                continue
+            signed = mint_click_id(click_id, offer_id, wm_id, clicked_at) if is_known_valid(offer_id, wm_id) else None
+            results[n] = [202, signed] if signed else [202]
+        else:
+            try:
+                event_queue.add_conversion(offer_id, wm_id, signed_click['click_id'] if signed_click else None,
+                                           event_client(event, ip_address, user_agent, partner)[0], event_id or None)
+            except QueueFull:
+                results[n] = [503]
+                continue
+            results[n] = [202]
+    return results
@@ -0,0 +1,80 @@
+'''
+Business: Фильтр Блума для «недавно видели этот ключ» без хранения самих ключей
+Args: capacity - ожидаемое число ключей в поколении, error_rate - доля ложноположительных ответов,
+      window - предельный возраст поколения в секундах
+Returns: BloomFilter и RotatingBloomFilter - add() / in; отрицательный ответ всегда точен
+'''
+import math
+import time
+import hashlib
+import threading
+from typing import Dict, Any, Optional
+
+
+class BloomFilter:
+    def __init__(self, capacity: int, error_rate: float = 0.01):
+        self.capacity = capacity
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.count = 0
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, key: str):
+        # Двойное хэширование: k позиций из двух 64-битных половин одного blake2b
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+        first, second = int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:], 'little') | 1
+        return [(first + i * second) % self.size for i in range(self.hashes)]
+
+    def add(self, key: str) -> None:
+        for position in self._positions(key):
+            self._bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, key: str) -> bool:
+        return all(self._bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+
+class RotatingBloomFilter:
+    '''Два поколения: заполненное (или прожившее window секунд) текущее становится прежним,
+    самое старое выбрасывается. Ключ помнится, пока не наберётся capacity последующих добавлений
+    или не пройдёт window секунд - что наступит раньше, - и не дольше двух поколений. При потоке
+    больше capacity ключей за window окно «недавно» короче window'''
+
+    def __init__(self, capacity: int, error_rate: float = 0.01, window: Optional[float] = None):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.window = window
+        self._current = BloomFilter(capacity, error_rate)
+        self._previous = BloomFilter(capacity, error_rate)
+        self._started_at = time.monotonic()
+        self._lock = threading.Lock()
+        self._stats = {'checks': 0, 'positives': 0, 'rotations': 0}
+
+    def _rotate_if_needed(self) -> None:
+        now = time.monotonic()
+        if self._current.count >= self.capacity or (self.window and now - self._started_at >= self.window):
+            self._previous, self._current = self._current, BloomFilter(self.capacity, self.error_rate)
+            self._started_at = now
+            self._stats['rotations'] += 1
+
+    def add(self, key: str) -> bool:
+        '''Добавляет ключ; True, если его (вероятно) не было - проверка и запись под одной блокировкой'''
+        with self._lock:
+            self._rotate_if_needed()
+            new = key not in self._current and key not in self._previous
+            self._current.add(key)
+            self._stats['checks'] += 1
+            self._stats['positives'] += not new
+            return new
+
+    def __contains__(self, key: str) -> bool:
+        with self._lock:
+            found = key in self._current or key in self._previous
+            self._stats['checks'] += 1
+            self._stats['positives'] += found
+            return found
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return dict(self._stats, capacity=self.capacity, size=self._current.count + self._previous.count,
+                        bytes=len(self._current._bits) * 2)
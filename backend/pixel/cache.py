@@ -0,0 +1,182 @@
+'''
+Business: Кэш проверки офферов и вебмастеров для пикселя с TTL, LRU-вытеснением и отрицательным кэшированием
+Args: PIXEL_CACHE_SIZE, PIXEL_CACHE_TTL, PIXEL_CACHE_NEGATIVE_TTL из окружения
+Returns: validation_cache и функции get_active_offer / is_webmaster (и пакетные get_active_offers / find_webmasters),
+         is_known_valid() - проверка пары оффер/вебмастер только по кэшу
+'''
+import os
+import time
+import threading
+from collections import OrderedDict
+from typing import Dict, Any, Optional, Set, Tuple
+from db import get_pool
+
+INVALIDATION_CHANNEL = 'pixel_cache'
+
+_MISSING = object()
+
+
+class TTLCache:
+    '''LRU-кэш ограниченного размера; None хранится как отрицательный результат с отдельным TTL'''
+
+    def __init__(self, max_size: int = 10000, ttl: float = 60.0, negative_ttl: float = 30.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._data: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'negative_hits': 0, 'misses': 0, 'evictions': 0,
+                       'expirations': 0, 'invalidations': 0}
+
+    def get(self, key: Tuple) -> Any:
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self._stats['misses'] += 1
+                return _MISSING
+            value, expires_at = item
+            if expires_at <= time.monotonic():
+                del self._data[key]
+                self._stats['expirations'] += 1
+                self._stats['misses'] += 1
+                return _MISSING
+            self._data.move_to_end(key)
+            self._stats['negative_hits' if value is None else 'hits'] += 1
+            return value
+
+    def set(self, key: Tuple, value: Any) -> None:
+        ttl = self.negative_ttl if value is None else self.ttl
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+                self._stats['evictions'] += 1
+
+    def is_known_missing(self, key: Tuple) -> bool:
+        with self._lock:
+            item = self._data.get(key)
+            return item is not None and item[0] is None and item[1] > time.monotonic()
+
+    def is_known_present(self, key: Tuple) -> bool:
+        with self._lock:
+            item = self._data.get(key)
+            return item is not None and item[0] is not None and item[1] > time.monotonic()
+
+    def invalidate(self, key: Tuple) -> None:
+        with self._lock:
+            if self._data.pop(key, None) is not None:
+                self._stats['invalidations'] += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._stats['invalidations'] += len(self._data)
+            self._data.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return dict(self._stats, size=len(self._data), max_size=self.max_size)
+
+
+validation_cache = TTLCache(
+    max_size=int(os.environ.get('PIXEL_CACHE_SIZE', '10000')),
+    ttl=float(os.environ.get('PIXEL_CACHE_TTL', '60')),
+    negative_ttl=float(os.environ.get('PIXEL_CACHE_NEGATIVE_TTL', '30')),
+)
+
+
+def offer_key(offer_id: Any) -> Tuple:
+    return ('offer', str(offer_id))
+
+
+def webmaster_key(wm_id: Any) -> Tuple:
+    return ('webmaster', str(wm_id))
+
+
+def is_known_valid(offer_id: Any, wm_id: Any) -> bool:
+    '''Оффер активен и вебмастер существует по кэшу, без БД; промах - False'''
+    return validation_cache.is_known_present(offer_key(offer_id)) and \
+        validation_cache.is_known_present(webmaster_key(wm_id))
+
+
+def get_active_offer(cursor, offer_id: str) -> Optional[Dict[str, Any]]:
+    key = offer_key(offer_id)
+    offer = validation_cache.get(key)
+    if offer is _MISSING:
+        cursor.execute("SELECT id, payout FROM offers WHERE id = %s AND status = 'active'", (offer_id,))
+        row = cursor.fetchone()
+        offer = dict(row) if row else None
+        validation_cache.set(key, offer)
+    return offer
+
+
+def is_webmaster(cursor, wm_id: str) -> bool:
+    key = webmaster_key(wm_id)
+    found = validation_cache.get(key)
+    if found is _MISSING:
+        cursor.execute("SELECT id FROM users WHERE id = %s AND role = 'webmaster'", (wm_id,))
+        found = True if cursor.fetchone() else None
+        validation_cache.set(key, found)
+    return bool(found)
+
+
+def get_active_offers(cursor, offer_ids) -> Dict[str, Dict[str, Any]]:
+    '''Пакетный get_active_offer: промахи кэша проверяются одним запросом'''
+    offers, unknown = {}, []
+    for offer_id in set(map(str, offer_ids)):
+        offer = validation_cache.get(offer_key(offer_id))
+        if offer is _MISSING:
+            unknown.append(offer_id)
+        elif offer:
+            offers[offer_id] = offer
+    if unknown:
+        cursor.execute("SELECT id, payout FROM offers WHERE id = ANY(%s::int[]) AND status = 'active'", (unknown,))
+        found = {str(row['id']): dict(row) for row in cursor.fetchall()}
+        for offer_id in unknown:
+            validation_cache.set(offer_key(offer_id), found.get(offer_id))
+        offers.update(found)
+    return offers
+
+
+def find_webmasters(cursor, wm_ids) -> Set[str]:
+    '''Пакетный is_webmaster: множество существующих id вебмастеров'''
+    webmasters, unknown = set(), []
+    for wm_id in set(map(str, wm_ids)):
+        found = validation_cache.get(webmaster_key(wm_id))
+        if found is _MISSING:
+            unknown.append(wm_id)
+        elif found:
+            webmasters.add(wm_id)
+    if unknown:
+        cursor.execute("SELECT id FROM users WHERE id = ANY(%s::int[]) AND role = 'webmaster'", (unknown,))
+        found = {str(row['id']) for row in cursor.fetchall()}
+        for wm_id in unknown:
+            validation_cache.set(webmaster_key(wm_id), True if wm_id in found else None)
+        webmasters |= found
+    return webmasters
+
+
+def listen_for_invalidations(conn) -> None:
+    '''Хук пула: подписывает новое соединение на NOTIFY от offers и auth'''
+    with conn.cursor() as cursor:
+        cursor.execute(f'LISTEN {INVALIDATION_CHANNEL}')
+    conn.commit()
+
+
+def apply_invalidations(conn) -> None:
+    '''Разбирает накопившиеся уведомления без обращения к БД; payload вида "offer:5" или "webmaster:7"'''
+    conn.poll()
+    while conn.notifies:
+        notify = conn.notifies.pop(0)
+        if notify.channel != INVALIDATION_CHANNEL:
+            continue
+        if notify.payload == '*':
+            validation_cache.clear()
+            continue
+        kind, _, ident = notify.payload.partition(':')
+        validation_cache.invalidate((kind, ident))
+
+
+# Хук ставится при импорте кэша, до фоновых потоков буфера и воркера очереди,
+# которые берут первые соединения пула ещё при импорте index
+get_pool().on_connect.append(listen_for_invalidations)
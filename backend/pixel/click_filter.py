@@ -0,0 +1,173 @@
+'''
+Business: Отсев ботов до записи клика - блок-лист, User-Agent и частота кликов с IP за скользящее окно
+Args: CLICK_FILTER_MODE (enforce|monitor|off), CLICK_FILTER_WINDOW, CLICK_FILTER_IP_LIMIT,
+      CLICK_FILTER_IP_OFFER_LIMIT, CLICK_FILTER_BLOCKLIST, CLICK_FILTER_BLOCKLIST_PATH,
+      CLICK_FILTER_UA_PATTERNS из окружения
+Returns: click_filter - check() возвращает причину отказа или None; отказы только считаются, в clicks не пишутся
+'''
+import os
+import re
+import time
+import socket
+import hashlib
+import ipaddress
+import threading
+from array import array
+from functools import lru_cache
+from typing import Dict, Any, List, Optional
+
+# Автоматические клиенты, которые не показывают рекламу человеку
+BOT_USER_AGENTS = (
+    r'bot\b|crawl|spider|slurp|archiver|facebookexternalhit|preview|'
+    r'curl/|wget/|python-requests|python-urllib|aiohttp|httpx|go-http-client|java/|libwww|'
+    r'okhttp/\d|apache-httpclient|scrapy|headless|phantomjs|selenium|puppeteer|playwright'
+)
+
+
+class SlidingCountMin:
+    '''Count-min sketch по кольцу из buckets подокон: оценка частоты ключа за последние window секунд.
+    Память постоянна ((buckets + 1) * depth * width счётчиков), оценка может только завышать'''
+
+    def __init__(self, window: float = 60.0, buckets: int = 6, width: int = 4096, depth: int = 4):
+        self.span = window / buckets
+        self.buckets = buckets
+        self.width = width
+        self.depth = depth
+        self._tables = [array('I', bytes(4 * width * depth)) for _ in range(buckets)]
+        self._epochs = [-1] * buckets
+        # Сумма живых подокон: оценка - один проход по depth счётчикам вместо суммы по кольцу
+        self._total = array('I', bytes(4 * width * depth))
+        self._lock = threading.Lock()
+
+    def _indexes(self, key: str) -> List[int]:
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+        first, second = int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:], 'little') | 1
+        return [row * self.width + (first + row * second) % self.width for row in range(self.depth)]
+
+    def _expire(self, epoch: int) -> None:
+        for slot, slot_epoch in enumerate(self._epochs):
+            if slot_epoch != -1 and epoch - slot_epoch >= self.buckets:
+                table, total = self._tables[slot], self._total
+                for index, count in enumerate(table):
+                    if count:
+                        total[index] -= count
+                self._tables[slot] = array('I', bytes(4 * self.width * self.depth))
+                self._epochs[slot] = -1
+
+    def add(self, key: str, now: float) -> int:
+        '''Учитывает событие и возвращает оценку числа событий ключа в окне, включая это'''
+        indexes = self._indexes(key)
+        epoch = int(now // self.span)
+        slot = epoch % self.buckets
+        with self._lock:
+            if self._epochs[slot] != epoch:
+                self._expire(epoch)
+                self._epochs[slot] = epoch
+            table, total = self._tables[slot], self._total
+            for index in indexes:
+                table[index] += 1
+                total[index] += 1
+            return min(total[index] for index in indexes)
+
+
+class Blocklist:
+    '''Отдельные адреса - множеством, подсети - диапазонами целых чисел (их обычно единицы)'''
+
+    def __init__(self, entries: List[str]):
+        self.addresses = set()
+        self.networks = []
+        for entry in (entry.strip() for entry in entries):
+            if not entry or entry.startswith('#'):
+                continue
+            if '/' in entry:
+                network = ipaddress.ip_network(entry, strict=False)
+                self.networks.append((network.version, int(network.network_address), int(network.broadcast_address)))
+            else:
+                self.addresses.add(str(ipaddress.ip_address(entry)))
+
+    def __contains__(self, ip: str) -> bool:
+        if ip in self.addresses:
+            return True
+        if not self.networks:
+            return False
+        try:
+            version, value = (4, int.from_bytes(socket.inet_aton(ip), 'big')) if ':' not in ip else \
+                (6, int.from_bytes(socket.inet_pton(socket.AF_INET6, ip), 'big'))
+        except OSError:
+            return False
+        return any(version == net_version and first <= value <= last for net_version, first, last in self.networks)
+
+    def __len__(self) -> int:
+        return len(self.addresses) + len(self.networks)
+
+
+class ClickFilter:
+    def __init__(self, mode: str = 'enforce', window: float = 60.0, ip_limit: int = 300,
+                 ip_offer_limit: int = 30, blocklist: Optional[Blocklist] = None, ua_patterns: str = ''):
+        self.mode = mode
+        self.ip_limit = ip_limit
+        self.ip_offer_limit = ip_offer_limit
+        self.blocklist = blocklist or Blocklist([])
+        self.bot_agents = re.compile('|'.join(filter(None, [BOT_USER_AGENTS, ua_patterns])), re.IGNORECASE)
+        # Разных User-Agent в трафике немного, а поиск по длинной строке - самый дорогой этап
+        self.is_bot_agent = lru_cache(maxsize=4096)(lambda user_agent: bool(self.bot_agents.search(user_agent)))
+        self.ip_counts = SlidingCountMin(window)
+        self.ip_offer_counts = SlidingCountMin(window)
+        self._lock = threading.Lock()
+        self._stats = {'checked': 0, 'rejected': 0, 'blocklist': 0, 'user_agent': 0,
+                       'ip_rate': 0, 'ip_offer_rate': 0}
+
+    def classify(self, ip: str, user_agent: str, offer_id: Any, now: Optional[float] = None,
+                 partner: bool = False) -> Optional[str]:
+        '''Причина отказа или None; счётчики частоты учитывают и отклонённые клики.
+        Клики S2S-партнёра идут с одного сервера: лимиты частоты по IP к ним не применяются,
+        а User-Agent проверяется, только если партнёр его передал'''
+        if ip in self.blocklist:
+            return 'blocklist'
+        if self.is_bot_agent(user_agent) if user_agent else not partner:
+            return 'user_agent'
+        if partner:
+            return None
+        now = time.time() if now is None else now
+        ip_count = self.ip_counts.add(ip, now)
+        ip_offer_count = self.ip_offer_counts.add(f'{ip}|{offer_id}', now)
+        if ip_count > self.ip_limit:
+            return 'ip_rate'
+        if ip_offer_count > self.ip_offer_limit:
+            return 'ip_offer_rate'
+        return None
+
+    def check(self, ip: str, user_agent: str, offer_id: Any, partner: bool = False) -> Optional[str]:
+        '''Как classify(), но со статистикой; в режиме monitor отказ только считается'''
+        if self.mode == 'off':
+            return None
+        reason = self.classify(ip, user_agent, offer_id, partner=partner)
+        with self._lock:
+            self._stats['checked'] += 1
+            if reason:
+                self._stats['rejected'] += 1
+                self._stats[reason] += 1
+        return reason if self.mode == 'enforce' else None
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return dict(self._stats, mode=self.mode, blocklist_size=len(self.blocklist))
+
+
+def _load_blocklist() -> Blocklist:
+    entries = os.environ.get('CLICK_FILTER_BLOCKLIST', '').split(',')
+    path = os.environ.get('CLICK_FILTER_BLOCKLIST_PATH')
+    if path and os.path.exists(path):
+        with open(path) as blocklist_file:
+            entries += blocklist_file.read().splitlines()
+    return Blocklist(entries)
+
+
+click_filter = ClickFilter(
+    mode=os.environ.get('CLICK_FILTER_MODE', 'enforce'),
+    window=float(os.environ.get('CLICK_FILTER_WINDOW', '60')),
+    ip_limit=int(os.environ.get('CLICK_FILTER_IP_LIMIT', '300')),
+    ip_offer_limit=int(os.environ.get('CLICK_FILTER_IP_OFFER_LIMIT', '30')),
+    blocklist=_load_blocklist(),
+    ua_patterns=os.environ.get('CLICK_FILTER_UA_PATTERNS', ''),
+)
@@ -0,0 +1,265 @@
+'''
+Business: Долговечная локальная очередь событий пикселя - клики и конверсии пишутся в сегментные файлы
+          на диске контейнера, а в PostgreSQL их переносит воркер pipeline.py
+Args: PIXEL_INGEST_MODE (sync|queue), EVENT_QUEUE_DIR, EVENT_QUEUE_DURABILITY (spool|fsync), EVENT_SEGMENT_BYTES,
+      EVENT_SEGMENT_SECONDS, EVENT_QUEUE_MAX_BYTES, CLICK_ID_BLOCK из окружения
+Returns: event_queue - общая для контейнера очередь (None в режиме sync), QueueFull - очередь переполнена
+'''
+import os
+import json
+import time
+import uuid
+import fcntl
+import atexit
+import logging
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Dict, Any, List, Iterator, Optional, Tuple
+from ingest import ClickIdBlock
+
+logger = logging.getLogger(__name__)
+
+# Открытый сегмент создаётся под временным именем и получает .open только под flock:
+# сегмент .open без блокировки остался от упавшего процесса, и его можно запечатать
+OPEN_SUFFIX, SEALED_SUFFIX = '.open', '.seg'
+
+
+class QueueFull(Exception):
+    '''Неразобранных событий больше EVENT_QUEUE_MAX_BYTES - пиксель отвечает 503, пока воркер не догонит'''
+
+
+def _segment_started(name: str) -> float:
+    '''Время создания сегмента из имени <time_ns>-<pid>-<tag>'''
+    return int(name.split('-', 1)[0]) / 1e9
+
+
+class EventQueue:
+    '''
+    Каждый процесс дописывает события NDJSON в свой открытый сегмент и запечатывает его по размеру
+    или возрасту. Разборщик (pipeline.py) под drain.lock читает запечатанные сегменты по порядку имён
+    и удаляет сегмент только после коммита всех его событий, поэтому после сбоя сегмент
+    разбирается заново - повторы отсекают id событий.
+    '''
+
+    def __init__(self, directory: str, durability: str = 'spool', segment_bytes: int = 1 << 20,
+                 segment_seconds: float = 1.0, max_bytes: int = 256 << 20, id_block: int = 1000):
+        self.directory = directory
+        self.durability = durability
+        self.segment_bytes = segment_bytes
+        self.segment_seconds = segment_seconds
+        self.max_bytes = max_bytes
+        self.dead_letter_dir = os.path.join(directory, 'dead')
+        os.makedirs(self.dead_letter_dir, exist_ok=True)
+        self._ids = ClickIdBlock(id_block)
+        self._lock = threading.Lock()
+        self._segment = None
+        self._segment_path: Optional[str] = None
+        self._segment_size = 0
+        self._segment_opened = 0.0
+        self._backlog_bytes = 0
+        self._backlog_checked = 0.0
+        self._stats = {'appended': 0, 'refused': 0, 'sealed': 0, 'recovered': 0, 'acked': 0,
+                       'torn': 0, 'dead_lettered': 0}
+
+    def add(self, offer_id: str, webmaster_id: str, ip_address: str, user_agent: str,
+            referrer: str, utm_source: str = 'cpasibo_pro', utm_medium: str = 'cpl',
+            is_unique: bool = True) -> Tuple[Optional[int], datetime]:
+        '''Клик в очередь, как ClickBuffer.add: id из блока clicks_id_seq служит и id события.
+        При пустом блоке id клика выдаст БД при разборе, а событию - случайный id'''
+        click_id, clicked_at = self._ids.next(), datetime.utcnow()
+        self.append({
+            'id': f'click:{click_id if click_id is not None else uuid.uuid4().hex}', 'type': 'click',
+            'click_id': click_id,
+            'offer_id': int(offer_id), 'wm_id': int(webmaster_id), 'at': clicked_at.isoformat(),
+            'ip': ip_address, 'user_agent': user_agent, 'referrer': referrer,
+            'utm_source': utm_source, 'utm_medium': utm_medium, 'is_unique': is_unique,
+        })
+        return click_id, clicked_at
+
+    def add_conversion(self, offer_id: str, webmaster_id: str, click_id: Optional[int],
+                       ip_address: str, event_id: Optional[str] = None) -> str:
+        '''Конверсия в очередь; event_id клиента делает повтор запроса идемпотентным в пределах оффера'''
+        event_id = f'convert:{offer_id}:{event_id}' if event_id else f'convert:{uuid.uuid4().hex}'
+        self.append({
+            'id': event_id, 'type': 'convert', 'offer_id': int(offer_id), 'wm_id': int(webmaster_id),
+            'click_id': click_id, 'at': datetime.utcnow().isoformat(), 'ip': (ip_address or '')[:45],
+        })
+        return event_id
+
+    def reserve_ids(self) -> None:
+        '''Добирает блок id кликов заранее, чтобы клик не ждал БД на границе блока'''
+        self._ids.reserve()
+
+    def append(self, event: Dict[str, Any]) -> None:
+        line = (json.dumps(event, ensure_ascii=False, separators=(',', ':')) + '\n').encode('utf-8')
+        with self._lock:
+            self._check_backlog(len(line))
+            if self._segment is None:
+                self._open_segment()
+            self._segment.write(line)
+            self._segment.flush()
+            if self.durability == 'fsync':
+                os.fsync(self._segment.fileno())
+            self._segment_size += len(line)
+            self._backlog_bytes += len(line)
+            self._stats['appended'] += 1
+            if self._segment_size >= self.segment_bytes or \
+                    time.monotonic() - self._segment_opened >= self.segment_seconds:
+                self._seal()
+
+    def _check_backlog(self, size: int) -> None:
+        # Размер каталога пересчитывается не чаще раза в секунду: разбирать может другой процесс
+        now = time.monotonic()
+        if now - self._backlog_checked >= 1.0:
+            self._backlog_bytes = sum(size for _, _, size in self._scan())
+            self._backlog_checked = now
+        if self._backlog_bytes + size > self.max_bytes:
+            self._stats['refused'] += 1
+            raise QueueFull(f'Очередь событий больше {self.max_bytes} байт')
+
+    def _open_segment(self) -> None:
+        name = f'{time.time_ns():020d}-{os.getpid()}-{uuid.uuid4().hex[:8]}'
+        temp_path = os.path.join(self.directory, name + '.tmp')
+        segment = open(temp_path, 'xb')
+        fcntl.flock(segment.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        self._segment_path = os.path.join(self.directory, name + OPEN_SUFFIX)
+        os.replace(temp_path, self._segment_path)
+        self._segment, self._segment_size, self._segment_opened = segment, 0, time.monotonic()
+
+    def _seal(self) -> None:
+        # Переименование под flock, закрытие файла снимает блокировку
+        os.replace(self._segment_path, self._segment_path[:-len(OPEN_SUFFIX)] + SEALED_SUFFIX)
+        self._segment.close()
+        self._segment, self._segment_path = None, None
+        self._stats['sealed'] += 1
+
+    def seal_if_due(self) -> None:
+        '''Запечатывает свой сегмент по возрасту - без этого события простаивающего контейнера ждали бы следующего'''
+        with self._lock:
+            if self._segment is not None and time.monotonic() - self._segment_opened >= self.segment_seconds:
+                self._seal()
+
+    def close(self) -> None:
+        with self._lock:
+            if self._segment is not None:
+                self._seal()
+
+    def _scan(self) -> List[Tuple[str, str, int]]:
+        '''(имя, суффикс, размер) сегментов каталога'''
+        segments = []
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                base, suffix = os.path.splitext(entry.name)
+                if suffix in (OPEN_SUFFIX, SEALED_SUFFIX):
+                    try:
+                        segments.append((base, suffix, entry.stat().st_size))
+                    except FileNotFoundError:
+                        continue
+        return segments
+
+    def _recover_open_segments(self) -> None:
+        '''Запечатывает сегменты .open упавших процессов: их flock снят вместе с процессом'''
+        for base, suffix, _ in self._scan():
+            if suffix != OPEN_SUFFIX:
+                continue
+            path = os.path.join(self.directory, base + OPEN_SUFFIX)
+            try:
+                segment = open(path, 'rb')
+            except FileNotFoundError:
+                continue
+            with segment:
+                try:
+                    fcntl.flock(segment.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue
+                if os.path.exists(path):
+                    os.replace(path, os.path.join(self.directory, base + SEALED_SUFFIX))
+                    self._stats['recovered'] += 1
+
+    def sealed_segments(self) -> List[str]:
+        '''Пути запечатанных сегментов от старых к новым'''
+        self._recover_open_segments()
+        names = sorted(base for base, suffix, _ in self._scan() if suffix == SEALED_SUFFIX)
+        return [os.path.join(self.directory, base + SEALED_SUFFIX) for base in names]
+
+    def read_segment(self, path: str) -> Tuple[List[Dict[str, Any]], List[str]]:
+        '''События сегмента и строки, которые не разбираются как JSON. Строка без перевода строки
+        оборвана падением процесса до ответа клиенту и пропускается'''
+        events, bad = [], []
+        with open(path, 'rb') as segment:
+            for raw in segment:
+                if not raw.endswith(b'\n'):
+                    self._stats['torn'] += 1
+                    continue
+                try:
+                    event = json.loads(raw)
+                except ValueError:
+                    bad.append(raw.decode('utf-8', 'replace').rstrip('\n'))
+                    continue
+                if isinstance(event, dict):
+                    events.append(event)
+                else:
+                    bad.append(raw.decode('utf-8', 'replace').rstrip('\n'))
+        return events, bad
+
+    def ack(self, path: str) -> None:
+        '''Сегмент разобран целиком и закоммичен'''
+        os.remove(path)
+        self._stats['acked'] += 1
+
+    def dead_letter(self, events: List[Any], error: str) -> None:
+        '''События, которые не удалось записать, - в dead/<дата>.ndjson с причиной для ручного разбора'''
+        path = os.path.join(self.dead_letter_dir, datetime.utcnow().strftime('%Y-%m-%d') + '.ndjson')
+        with open(path, 'a', encoding='utf-8') as f:
+            for event in events:
+                f.write(json.dumps({'error': error, 'event': event}, ensure_ascii=False) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self._stats['dead_lettered'] += len(events)
+        logger.error('%s events dead-lettered: %s', len(events), error)
+
+    @contextmanager
+    def drain_lock(self) -> Iterator[bool]:
+        '''Один разборщик на каталог; True, если блокировка взята'''
+        with open(os.path.join(self.directory, 'drain.lock'), 'a') as lock:
+            try:
+                fcntl.flock(lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                yield False
+                return
+            yield True
+
+    def stats(self) -> Dict[str, Any]:
+        segments = self._scan()
+        backlog = sum(size for _, _, size in segments)
+        oldest = min((base for base, _, _ in segments), default=None)
+        with self._lock:
+            return dict(self._stats,
+                        backlog_bytes=backlog,
+                        backlog_segments=len(segments),
+                        oldest_seconds=round(time.time() - _segment_started(oldest), 3) if oldest else 0,
+                        accepting=backlog < self.max_bytes,
+                        reserved_ids=len(self._ids))
+
+
+def queue_from_env() -> EventQueue:
+    return EventQueue(
+        directory=os.environ.get('EVENT_QUEUE_DIR', '/tmp/cpasibo-events'),
+        durability=os.environ.get('EVENT_QUEUE_DURABILITY', 'spool'),
+        segment_bytes=int(os.environ.get('EVENT_SEGMENT_BYTES', str(1 << 20))),
+        segment_seconds=float(os.environ.get('EVENT_SEGMENT_SECONDS', '1.0')),
+        max_bytes=int(os.environ.get('EVENT_QUEUE_MAX_BYTES', str(256 << 20))),
+        id_block=int(os.environ.get('CLICK_ID_BLOCK', '1000')),
+    )
+
+
+def _create_event_queue() -> Optional[EventQueue]:
+    if os.environ.get('PIXEL_INGEST_MODE', 'sync') != 'queue':
+        return None
+    queue = queue_from_env()
+    atexit.register(queue.close)
+    return queue
+
+
+event_queue = _create_event_queue()
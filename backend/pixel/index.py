@@ -1,228 +1,276 @@
 '''
 Business: Отслеживание кликов и конверсий через пиксель
-Args: event - dict с httpMethod, queryStringParameters (offer_id, wm_id, action)
+Args: event - dict с httpMethod, queryStringParameters (offer_id, wm_id, action, click_id, transaction_id, event_id, format),
+      body - пачка событий для POST action=batch или постбэков для POST action=postback
       context - object с request_id
 Returns: HTTP response с результатом отслеживания или пиксель-скриптом
 '''
-import json
-import os
-from typing import Dict, Any
+import base64
+from typing import Dict, Any, List, Optional
 from datetime import datetime
-import psycopg2
 from psycopg2.extras import RealDictCursor
+from db import get_connection, get_pool
+from responses import http_handler, json_response, error_response, gif_response
+from ingest import click_buffer, BufferFull
+from event_queue import event_queue, QueueFull
+from pipeline import pipeline_worker
+from cache import (validation_cache, offer_key, webmaster_key, get_active_offer, is_webmaster,
+                   is_known_valid, apply_invalidations)
+from click_ids import mint_click_id, parse_click_id
+from pixel_script import pixel_response
+from batch import parse_events, process_batch, queue_batch, is_partner_request
+from postbacks import recent_postbacks, process_postbacks
+from click_filter import click_filter
+from unique_clicks import is_unique_click, unique_click_stats
 
-def get_db_connection():
-    return psycopg2.connect(os.environ['DATABASE_URL'])
+# В режиме очереди клик пишется в сегмент на диске, иначе - в буфер (если включён)
+click_sink = event_queue if event_queue is not None else click_buffer
 
+# Ответ на переполненную очередь: клиент повторяет запрос, а не теряет событие молча
+RETRY_AFTER = {'Retry-After': '1'}
+
+def click_response(click_id: Optional[str], params: Dict[str, Any]) -> Dict[str, Any]:
+    '''Пиксель-скрипт запрашивает format=json и сохраняет click_id; обычный img получает GIF.
+    Отсеянный фильтром клик получает тот же ответ без click_id, чтобы бот не отличал отказ'''
+    if params.get('format') == 'json':
+        return json_response({'click_id': click_id})
+    if click_id:
+        return gif_response(headers={'Access-Control-Expose-Headers': 'X-Click-Id', 'X-Click-Id': click_id})
+    return gif_response()
+
+def batch_response(results: List[list]) -> Dict[str, Any]:
+    return json_response({
+        'accepted': sum(1 for result in results if result[0] in (200, 202)),
+        'duplicates': sum(1 for result in results if result[0] == 409),
+        'results': results
+    }, compact=True)
+
+def request_body(event: Dict[str, Any]) -> str:
+    body = event.get('body') or ''
+    if event.get('isBase64Encoded'):
+        body = base64.b64decode(body).decode('utf-8')
+    return body
+
+@http_handler(methods=('GET', 'POST'))
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     method: str = event.get('httpMethod', 'GET')
     
-    if method == 'OPTIONS':
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type',
-                'Access-Control-Max-Age': '86400'
-            },
-            'body': ''
-        }
+    params = event.get('queryStringParameters', {}) or {}
+    request_ctx = event.get('requestContext', {})
+    identity = request_ctx.get('identity', {})
+    
+    ip_address = identity.get('sourceIp', '')
+    user_agent = identity.get('userAgent', '')
+    
+    # Боты отсеиваются до кэша, буфера и БД
+    if method == 'GET' and params.get('action') == 'click' and \
+            click_filter.check(ip_address, user_agent, params.get('offer_id', '')):
+        return click_response(None, params)
     
-    try:
-        params = event.get('queryStringParameters', {}) or {}
-        request_ctx = event.get('requestContext', {})
-        identity = request_ctx.get('identity', {})
+    # Быстрые пути очереди и буфера не берут соединение, поэтому NOTIFY pixel_cache, уже полученные
+    # простаивающими соединениями пула, разбираются здесь - иначе активированный оффер получал бы 404
+    # до конца PIXEL_CACHE_NEGATIVE_TTL
+    if click_sink is not None:
+        get_pool().poll_idle(apply_invalidations)
+    
+    if method == 'GET' and params.get('action') == 'click' and click_sink is not None:
+        offer_id = params.get('offer_id', '')
+        wm_id = params.get('wm_id', '')
         
-        ip_address = identity.get('sourceIp', '')
-        user_agent = identity.get('userAgent', '')
+        if not offer_id.isdigit() or not wm_id.isdigit():
+            return gif_response(400)
         
-        conn = get_db_connection()
-        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        if validation_cache.is_known_missing(offer_key(offer_id)) or \
+                validation_cache.is_known_missing(webmaster_key(wm_id)):
+            return gif_response(404)
         
-        if method == 'GET':
-            action = params.get('action', 'pixel')
-            
-            if action == 'pixel':
-                pixel_script = '''
-(function() {
-    var offerId = document.currentScript.getAttribute('data-offer-id');
-    if (!offerId) return;
+        try:
+            click_id, clicked_at = click_sink.add(offer_id, wm_id, ip_address, user_agent,
+                                                  params.get('referrer', ''),
+                                                  is_unique=is_unique_click(ip_address, user_agent, offer_id, wm_id))
+        except (QueueFull, BufferFull):
+            return gif_response(503, headers=RETRY_AFTER)
+        
+        # Подписанный id - только для пары, уже проверенной по БД; иначе клик проверит сброс или воркер,
+        # а конверсия найдёт его поиском по clicks
+        signed = mint_click_id(click_id, offer_id, wm_id, clicked_at) if is_known_valid(offer_id, wm_id) else None
+        return click_response(signed, params)
     
-    var urlParams = new URLSearchParams(window.location.search);
-    var wmId = urlParams.get('wm_id');
-    var utmSource = urlParams.get('utm_source');
-    var utmMedium = urlParams.get('utm_medium');
+    # Конверсия в очередь: подпись click_id и отрицательный кэш проверяются здесь, оффер с выплатой - воркером
+    if method == 'GET' and params.get('action') == 'convert' and event_queue is not None:
+        offer_id = params.get('offer_id', '')
+        wm_id = params.get('wm_id', '')
+        event_id = params.get('event_id', '')
+        signed_click = parse_click_id(params.get('click_id'))
+        
+        if signed_click and str(signed_click['offer_id']) == offer_id and \
+                (not wm_id or str(signed_click['webmaster_id']) == wm_id):
+            wm_id = str(signed_click['webmaster_id'])
+        else:
+            signed_click = None
+        
+        if not offer_id.isdigit() or not wm_id.isdigit() or len(event_id) > 128:
+            return gif_response(400)
+        
+        if validation_cache.is_known_missing(offer_key(offer_id)) or \
+                validation_cache.is_known_missing(webmaster_key(wm_id)):
+            return gif_response(404)
+        
+        try:
+            event_queue.add_conversion(offer_id, wm_id, signed_click['click_id'] if signed_click else None,
+                                       ip_address, event_id or None)
+        except QueueFull:
+            return gif_response(503, headers=RETRY_AFTER)
+        
+        return gif_response()
     
-    if (wmId && utmSource === 'cpasibo_pro' && utmMedium === 'cpl') {
-        var img = new Image();
-        img.src = window.location.protocol + '//' + window.location.host + 
-                  '/api/pixel?action=click&offer_id=' + offerId + 
-                  '&wm_id=' + wmId + 
-                  '&referrer=' + encodeURIComponent(document.referrer);
-    }
+    # Статичный скрипт: без соединения с БД, готовые сжатые тела собраны при импорте
+    if method == 'GET' and params.get('action', 'pixel') == 'pixel':
+        return pixel_response(event, params.get('v'))
     
-    window.cpasibo = {
-        trackConversion: function() {
-            if (wmId && offerId) {
-                var img = new Image();
-                img.src = window.location.protocol + '//' + window.location.host + 
-                          '/api/pixel?action=convert&offer_id=' + offerId + '&wm_id=' + wmId;
-            }
-        }
-    };
-})();
-'''
-                cursor.close()
-                conn.close()
-                
-                return {
-                    'statusCode': 200,
-                    'headers': {
-                        'Content-Type': 'application/javascript',
-                        'Access-Control-Allow-Origin': '*',
-                        'Cache-Control': 'public, max-age=3600'
-                    },
-                    'body': pixel_script
-                }
+    if method == 'GET' and params.get('action') == 'metrics':
+        return json_response({
+            'db_pool': get_pool().stats(),
+            'validation_cache': validation_cache.stats(),
+            'click_buffer': click_buffer.stats() if click_buffer is not None else None,
+            'event_queue': event_queue.stats() if event_queue is not None else None,
+            'event_pipeline': pipeline_worker.stats() if pipeline_worker is not None else None,
+            'postback_filter': recent_postbacks.stats(),
+            'click_filter': click_filter.stats(),
+            'unique_clicks': unique_click_stats()
+        })
+    
+    if method == 'POST' and params.get('action', 'batch') == 'batch' and event_queue is not None:
+        try:
+            events = parse_events(request_body(event))
+        except ValueError as e:
+            return error_response(400, str(e))
+        
+        results = queue_batch(events, ip_address, user_agent, event_queue, is_partner_request(event))
+        if results and all(result[0] == 503 for result in results):
+            return json_response({'error': 'Очередь событий переполнена, повторите позже'}, 503, headers=RETRY_AFTER)
+        
+        return batch_response(results)
+    
+    # Постбэк начисляет выплату, поэтому принимается только от партнёра с токеном - до обращения к БД
+    partner = is_partner_request(event)
+    if params.get('action') == 'postback' and method in ('GET', 'POST') and not partner:
+        return error_response(401, 'Постбэк требует токен партнёра: заголовок X-Partner-Token или параметр partner_token')
+    
+    with get_connection() as conn, conn.cursor(cursor_factory=RealDictCursor) as cursor:
+        apply_invalidations(conn)
+        
+        if method == 'GET':
+            action = params.get('action', 'pixel')
             
-            elif action == 'click':
+            if action == 'click':
                 offer_id = params.get('offer_id')
                 wm_id = params.get('wm_id')
                 referrer = params.get('referrer', '')
                 
                 if not offer_id or not wm_id:
-                    cursor.close()
-                    conn.close()
-                    return {
-                        'statusCode': 400,
-                        'headers': {'Content-Type': 'image/gif', 'Access-Control-Allow-Origin': '*'},
-                        'body': '',
-                        'isBase64Encoded': False
-                    }
+                    return gif_response(400)
                 
-                cursor.execute("SELECT id FROM offers WHERE id = %s AND status = 'active'", (offer_id,))
-                if not cursor.fetchone():
-                    cursor.close()
-                    conn.close()
-                    return {
-                        'statusCode': 404,
-                        'headers': {'Content-Type': 'image/gif', 'Access-Control-Allow-Origin': '*'},
-                        'body': '',
-                        'isBase64Encoded': False
-                    }
+                if not get_active_offer(cursor, offer_id):
+                    return gif_response(404)
                 
-                cursor.execute("SELECT id FROM users WHERE id = %s AND role = 'webmaster'", (wm_id,))
-                if not cursor.fetchone():
-                    cursor.close()
-                    conn.close()
-                    return {
-                        'statusCode': 404,
-                        'headers': {'Content-Type': 'image/gif', 'Access-Control-Allow-Origin': '*'},
-                        'body': '',
-                        'isBase64Encoded': False
-                    }
+                if not is_webmaster(cursor, wm_id):
+                    return gif_response(404)
                 
                 cursor.execute(
                     """
                     INSERT INTO clicks (offer_id, webmaster_id, ip_address, user_agent, referrer, 
-                                       utm_source, utm_medium) 
-                    VALUES (%s, %s, %s, %s, %s, %s, %s)
+                                       utm_source, utm_medium, is_unique) 
+                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+                    RETURNING id, clicked_at
                     """,
-                    (offer_id, wm_id, ip_address, user_agent, referrer, 'cpasibo_pro', 'cpl')
+                    (offer_id, wm_id, ip_address, user_agent, referrer, 'cpasibo_pro', 'cpl',
+                     is_unique_click(ip_address, user_agent, offer_id, wm_id))
                 )
+                click = cursor.fetchone()
+                conn.commit()
+                
+                return click_response(mint_click_id(click['id'], offer_id, wm_id, click['clicked_at']), params)
+            
+            elif action == 'postback':
+                results = process_postbacks(cursor, [params], ip_address, partner)
                 conn.commit()
-                cursor.close()
-                conn.close()
                 
-                return {
-                    'statusCode': 200,
-                    'headers': {'Content-Type': 'image/gif', 'Access-Control-Allow-Origin': '*'},
-                    'body': 'R0lGODlhAQABAIAAAAAAAP///yH5BAEAAAAALAAAAAABAAEAAAIBRAA7',
-                    'isBase64Encoded': True
-                }
+                return batch_response(results)
             
             elif action == 'convert':
                 offer_id = params.get('offer_id')
                 wm_id = params.get('wm_id')
+                signed_click = parse_click_id(params.get('click_id'))
+                
+                # Подписанный click_id сам несёт клик и вебмастера; чужой оффер или вебмастер - в legacy-поиск
+                if signed_click and str(signed_click['offer_id']) == str(offer_id) and \
+                        (not wm_id or str(signed_click['webmaster_id']) == str(wm_id)):
+                    wm_id = str(signed_click['webmaster_id'])
+                else:
+                    signed_click = None
                 
                 if not offer_id or not wm_id:
-                    cursor.close()
-                    conn.close()
-                    return {
-                        'statusCode': 400,
-                        'headers': {'Content-Type': 'image/gif', 'Access-Control-Allow-Origin': '*'},
-                        'body': '',
-                        'isBase64Encoded': False
-                    }
+                    return gif_response(400)
                 
-                cursor.execute(
-                    "SELECT id, payout FROM offers WHERE id = %s AND status = 'active'",
-                    (offer_id,)
-                )
-                offer = cursor.fetchone()
+                offer = get_active_offer(cursor, offer_id)
                 
                 if not offer:
-                    cursor.close()
-                    conn.close()
-                    return {
-                        'statusCode': 404,
-                        'headers': {'Content-Type': 'image/gif', 'Access-Control-Allow-Origin': '*'},
-                        'body': '',
-                        'isBase64Encoded': False
-                    }
+                    return gif_response(404)
                 
-                cursor.execute(
-                    """
-                    SELECT id FROM clicks 
-                    WHERE offer_id = %s AND webmaster_id = %s 
-                    ORDER BY clicked_at DESC LIMIT 1
-                    """,
-                    (offer_id, wm_id)
-                )
-                click = cursor.fetchone()
+                if signed_click:
+                    click = {'id': signed_click['click_id']}
+                else:
+                    cursor.execute(
+                        """
+                        SELECT id FROM clicks 
+                        WHERE offer_id = %s AND webmaster_id = %s 
+                        ORDER BY clicked_at DESC LIMIT 1
+                        """,
+                        (offer_id, wm_id)
+                    )
+                    click = cursor.fetchone()
                 
                 payout = float(offer['payout'])
                 commission = payout * 0.20
                 webmaster_payout = payout - commission
                 
+                # Начисление вебмастеру - строка журнала в том же запросе, без блокировки users;
+                # в users.balance её переносит свёртка (backend/stats/ledger.py)
                 cursor.execute(
                     """
-                    INSERT INTO conversions (offer_id, webmaster_id, click_id, payout, 
-                                            commission, ip_address, status) 
-                    VALUES (%s, %s, %s, %s, %s, %s, %s)
+                    WITH conversion AS (
+                        INSERT INTO conversions (offer_id, webmaster_id, click_id, payout, 
+                                                commission, ip_address, status) 
+                        VALUES (%s, %s, %s, %s, %s, %s, %s)
+                        RETURNING id, webmaster_id, payout
+                    )
+                    INSERT INTO balance_ledger (user_id, amount, reason, conversion_id)
+                    SELECT webmaster_id, payout, 'conversion', id FROM conversion
                     """,
                     (offer_id, wm_id, click['id'] if click else None, 
                      webmaster_payout, commission, ip_address, 'approved')
                 )
                 
-                cursor.execute(
-                    "UPDATE users SET balance = balance + %s WHERE id = %s",
-                    (webmaster_payout, wm_id)
-                )
-                
                 conn.commit()
-                cursor.close()
-                conn.close()
                 
-                return {
-                    'statusCode': 200,
-                    'headers': {'Content-Type': 'image/gif', 'Access-Control-Allow-Origin': '*'},
-                    'body': 'R0lGODlhAQABAIAAAAAAAP///yH5BAEAAAAALAAAAAABAAEAAAIBRAA7',
-                    'isBase64Encoded': True
-                }
+                return gif_response()
         
-        cursor.close()
-        conn.close()
-        return {
-            'statusCode': 405,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Метод не поддерживается'})
-        }
-    
-    except Exception as e:
-        return {
-            'statusCode': 500,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': f'Ошибка сервера: {str(e)}'})
-        }
+        elif method == 'POST' and params.get('action', 'batch') in ('batch', 'postback'):
+            try:
+                events = parse_events(request_body(event))
+            except ValueError as e:
+                return error_response(400, str(e))
+            
+            if params.get('action') == 'postback':
+                results = process_postbacks(cursor, events, ip_address, partner)
+            else:
+                results = process_batch(cursor, events, ip_address, user_agent, click_buffer, partner)
+            conn.commit()
+            
+            if results and all(result[0] == 503 for result in results):
+                return json_response({'error': 'Буфер кликов переполнен, повторите позже'}, 503, headers=RETRY_AFTER)
+            
+            return batch_response(results)
+        
+        return error_response(405, 'Метод не поддерживается')
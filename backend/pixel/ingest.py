@@ -0,0 +1,276 @@
+'''
+Business: Буферизованная запись кликов пачками вместо INSERT + COMMIT на каждый клик
+Args: CLICK_INGEST_MODE (sync|buffered), CLICK_FLUSH_SIZE, CLICK_FLUSH_INTERVAL,
+      CLICK_DURABILITY (memory|spool|fsync), CLICK_SPOOL_PATH, CLICK_BUFFER_MAX, CLICK_ID_BLOCK из окружения
+Returns: click_buffer - общий для контейнера буфер кликов с фоновым сбросом в PostgreSQL,
+         BufferFull - буфер spool/fsync переполнен
+'''
+import os
+import glob
+import json
+import uuid
+import fcntl
+import atexit
+import logging
+import threading
+from collections import deque
+from datetime import datetime
+from typing import Dict, Any, List, Optional, Tuple
+from psycopg2.extras import execute_values, RealDictCursor
+from db import get_connection
+from cache import get_active_offers, find_webmasters
+
+logger = logging.getLogger(__name__)
+
+# Проверка оффера и вебмастера выполняется одним JOIN на всю пачку.
+# id заранее выделен из последовательности (см. reserve_ids), поэтому повтор пачки после сбоя
+# не создаёт дублей; у строк из старого spool и кликов, пришедших при пустом блоке id, id нет.
+INSERT_CLICKS_SQL = '''
+    INSERT INTO clicks (id, offer_id, webmaster_id, ip_address, user_agent, referrer,
+                        utm_source, utm_medium, clicked_at, is_unique)
+    SELECT COALESCE(v.id, nextval('clicks_id_seq')), v.offer_id, v.webmaster_id, v.ip_address,
+           v.user_agent, v.referrer, v.utm_source, v.utm_medium, v.clicked_at, v.is_unique
+    FROM (VALUES %s) AS v(offer_id, webmaster_id, ip_address, user_agent, referrer,
+                          utm_source, utm_medium, clicked_at, id, is_unique)
+    JOIN offers o ON o.id = v.offer_id AND o.status = 'active'
+    JOIN users u ON u.id = v.webmaster_id AND u.role = 'webmaster'
+    ON CONFLICT DO NOTHING
+'''
+INSERT_CLICKS_TEMPLATE = '(%s::int, %s::int, %s, %s, %s, %s, %s, %s::timestamp, %s::bigint, %s::boolean)'
+RESERVE_IDS_SQL = "SELECT nextval('clicks_id_seq') AS id FROM generate_series(1, %s)"
+
+# Клики старше отметки почасовых агрегатов (сброс после сбоя БД или дольше grace-периода) откатывают
+# отметку к своему часу - следующий запрос статистики пересчитает эти часы, как rebuild_rollups
+REWIND_ROLLUPS_SQL = '''
+    UPDATE rollup_watermarks SET rolled_until = date_trunc('hour', %(oldest)s::timestamp), updated_at = LOCALTIMESTAMP
+    WHERE name = 'stats_hourly' AND rolled_until > %(oldest)s::timestamp
+'''
+
+
+class BufferFull(Exception):
+    '''Буфер spool/fsync достиг CLICK_BUFFER_MAX - пиксель отвечает 503, пока сброс не догонит'''
+
+
+class ClickIdBlock:
+    '''Блок id из clicks_id_seq, чтобы выдавать подписанный click_id до записи клика в БД'''
+
+    def __init__(self, size: int = 1000):
+        self.size = size
+        self._ids: deque = deque()
+        self._lock = threading.Lock()
+
+    def reserve(self) -> None:
+        '''Добирает блок, когда осталось меньше половины'''
+        with self._lock:
+            if len(self._ids) >= self.size // 2:
+                return
+            with get_connection() as conn, conn.cursor() as cursor:
+                cursor.execute(RESERVE_IDS_SQL, (self.size,))
+                ids = [row[0] for row in cursor.fetchall()]
+                conn.commit()
+            self._ids.extend(ids)
+
+    def next(self) -> Optional[int]:
+        '''Без обращения к БД: при пустом блоке None - клик пишется с id из последовательности
+        при сбросе, а ответ уходит без подписанного click_id'''
+        try:
+            return self._ids.popleft()
+        except IndexError:
+            return None
+
+    def running_low(self) -> bool:
+        return len(self._ids) < self.size // 2
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+
+class ClickBuffer:
+    '''
+    Копит клики в памяти (и, при необходимости, в spool-файле) и пишет их пачками.
+    Файлы процесса называются <spool_path>.<pid>-<метка>.*, и процесс держит flock на своём .lock
+    всё время работы: при старте забираются только файлы владельцев, чей flock снят вместе с процессом.
+    '''
+
+    def __init__(self, flush_size: int = 500, flush_interval: float = 1.0,
+                 durability: str = 'memory', spool_path: str = '/tmp/cpasibo-clicks.spool',
+                 max_buffered: int = 50000, id_block: int = 1000):
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.durability = durability
+        self.spool_path = spool_path
+        self.max_buffered = max_buffered
+        self._rows: deque = deque()
+        self._ids = ClickIdBlock(id_block)
+        self._segments: List[str] = []
+        self._spool = None
+        self._segment_seq = 0
+        self._owner_lock = None
+        self._prefix = f'{spool_path}.{os.getpid()}-{uuid.uuid4().hex[:8]}'
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._stats = {'buffered': 0, 'flushed': 0, 'rejected': 0, 'dropped': 0, 'refused': 0,
+                       'flushes': 0, 'flush_errors': 0}
+        if self.durability != 'memory':
+            # .lock появляется только уже под flock, иначе соседний процесс принял бы его за брошенный
+            self._owner_lock = open(self._prefix + '.tmp', 'w')
+            fcntl.flock(self._owner_lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            os.replace(self._prefix + '.tmp', self._prefix + '.lock')
+            self._recover_spool()
+        # Поток сразу резервирует блок id, чтобы первые клики не остались без подписанного click_id
+        self._ensure_thread()
+
+    def _recover_spool(self) -> None:
+        for lock_path in glob.glob(self.spool_path + '.*.lock'):
+            if lock_path == self._prefix + '.lock':
+                continue
+            with open(lock_path, 'a') as lock:
+                try:
+                    fcntl.flock(lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue
+                owner = lock_path[:-len('.lock')]
+                for path in sorted(glob.glob(owner + '.*')):
+                    if path != lock_path:
+                        self._adopt_segment(path)
+                os.remove(lock_path)
+
+    def _adopt_segment(self, path: str) -> None:
+        '''Файл упавшего владельца переименовывается в свои сегменты и сбрасывается вместе с ними'''
+        self._segment_seq += 1
+        segment = f'{self._prefix}.{self._segment_seq}'
+        os.replace(path, segment)
+        with open(segment, encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    # Строки старых форматов: без id (8 полей) и без is_unique (9 полей)
+                    row = tuple(json.loads(line))
+                    self._rows.append(row + (None, True)[len(row) - 8:])
+        self._segments.append(segment)
+
+    def _append_spool(self, row: tuple) -> None:
+        if self._spool is None:
+            self._spool = open(self._prefix + '.live', 'a', encoding='utf-8')
+        self._spool.write(json.dumps(row, ensure_ascii=False) + '\n')
+        self._spool.flush()
+        if self.durability == 'fsync':
+            os.fsync(self._spool.fileno())
+
+    def _rotate_spool(self) -> None:
+        if self._spool is None:
+            return
+        self._spool.close()
+        self._spool = None
+        self._segment_seq += 1
+        segment = f'{self._prefix}.{self._segment_seq}'
+        os.replace(self._prefix + '.live', segment)
+        self._segments.append(segment)
+
+    def reserve_ids(self) -> None:
+        self._ids.reserve()
+
+    def add(self, offer_id: str, webmaster_id: str, ip_address: str, user_agent: str,
+            referrer: str, utm_source: str = 'cpasibo_pro', utm_medium: str = 'cpl',
+            is_unique: bool = True) -> Tuple[Optional[int], datetime]:
+        '''id клика или None, если блок id пуст (см. ClickIdBlock.next).
+        Переполненный буфер в памяти теряет старейший клик; в режимах spool и fsync клик уже обещан
+        долговечным, поэтому новый отклоняется BufferFull, а клиент повторит его позже'''
+        with self._lock:
+            if len(self._rows) >= self.max_buffered and self.durability != 'memory':
+                self._stats['refused'] += 1
+                raise BufferFull(f'В буфере кликов больше {self.max_buffered} строк')
+        click_id, clicked_at = self._ids.next(), datetime.utcnow()
+        row = (offer_id, webmaster_id, ip_address, user_agent, referrer, utm_source,
+               utm_medium, clicked_at.isoformat(), click_id, is_unique)
+        with self._lock:
+            if len(self._rows) >= self.max_buffered:
+                self._rows.popleft()
+                self._stats['dropped'] += 1
+            self._rows.append(row)
+            self._stats['buffered'] += 1
+            if self.durability != 'memory':
+                self._append_spool(row)
+            full = len(self._rows) >= self.flush_size
+        self._ensure_thread()
+        if full or self._ids.running_low():
+            self._wakeup.set()
+        return click_id, clicked_at
+
+    def _ensure_thread(self) -> None:
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name='click-flusher', daemon=True)
+            self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            try:
+                self.reserve_ids()
+                self.flush()
+            except Exception:
+                logger.exception('click flush failed')
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+
+    def flush(self) -> int:
+        with self._flush_lock:
+            with self._lock:
+                if not self._rows:
+                    return 0
+                rows = list(self._rows)
+                self._rows.clear()
+                self._rotate_spool()
+                segments = list(self._segments)
+            try:
+                with get_connection() as conn, conn.cursor(cursor_factory=RealDictCursor) as cursor:
+                    # Запись всё равно проверяет оффер и вебмастера JOIN-ом; промахи кэша проверяются здесь,
+                    # чтобы следующие клики этих пар получали подписанный click_id (см. cache.is_known_valid)
+                    get_active_offers(cursor, {row[0] for row in rows})
+                    find_webmasters(cursor, {row[1] for row in rows})
+                    cursor.execute(REWIND_ROLLUPS_SQL, {'oldest': min(row[7] for row in rows)})
+                    execute_values(cursor, INSERT_CLICKS_SQL, rows,
+                                   template=INSERT_CLICKS_TEMPLATE, page_size=len(rows))
+                    inserted = cursor.rowcount
+                    conn.commit()
+            except Exception:
+                with self._lock:
+                    self._rows.extendleft(reversed(rows))
+                    self._stats['flush_errors'] += 1
+                raise
+            with self._lock:
+                for segment in segments:
+                    self._segments.remove(segment)
+                    os.remove(segment)
+                self._stats['flushes'] += 1
+                self._stats['flushed'] += inserted
+                self._stats['rejected'] += len(rows) - inserted
+            return inserted
+
+    def shutdown(self) -> None:
+        try:
+            self.flush()
+        except Exception:
+            logger.exception('click flush on shutdown failed, rows kept in spool')
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return dict(self._stats, pending=len(self._rows), reserved_ids=len(self._ids))
+
+
+def _create_click_buffer() -> Optional[ClickBuffer]:
+    if os.environ.get('CLICK_INGEST_MODE', 'sync') != 'buffered':
+        return None
+    buffer = ClickBuffer(
+        flush_size=int(os.environ.get('CLICK_FLUSH_SIZE', '500')),
+        flush_interval=float(os.environ.get('CLICK_FLUSH_INTERVAL', '1.0')),
+        durability=os.environ.get('CLICK_DURABILITY', 'memory'),
+        spool_path=os.environ.get('CLICK_SPOOL_PATH', '/tmp/cpasibo-clicks.spool'),
+        max_buffered=int(os.environ.get('CLICK_BUFFER_MAX', '50000')),
+        id_block=int(os.environ.get('CLICK_ID_BLOCK', '1000')),
+    )
+    atexit.register(buffer.shutdown)
+    return buffer
+
+
+click_buffer = _create_click_buffer()
@@ -0,0 +1,333 @@
+'''
+Business: Асинхронный разбор очереди событий пикселя в PostgreSQL - проверка офферов и вебмастеров,
+          атрибуция конверсий и начисления на баланс пачками, ровно один раз по id события
+Args: EVENT_PIPELINE_WORKER (inline|off), EVENT_BATCH_SIZE, EVENT_DRAIN_INTERVAL, EVENT_MAX_ATTEMPTS,
+      EVENT_RETRY_MAX_SECONDS, EVENT_DEDUP_DAYS из окружения; отдельным процессом - python backend/pixel/pipeline.py
+Returns: pipeline_worker - воркер контейнера в фоновом потоке со своим циклом asyncio (None без очереди)
+'''
+import os
+import sys
+import time
+import atexit
+import asyncio
+import logging
+import argparse
+import threading
+from datetime import datetime, timezone
+from typing import Dict, Any, List, Optional
+import psycopg2
+from psycopg2.extras import RealDictCursor, execute_values
+from db import get_connection, PoolTimeout
+from cache import get_active_offers, find_webmasters, apply_invalidations
+from ingest import INSERT_CLICKS_SQL, INSERT_CLICKS_TEMPLATE, REWIND_ROLLUPS_SQL
+from event_queue import EventQueue, event_queue, queue_from_env
+
+logger = logging.getLogger(__name__)
+
+# Сбой соединения не связан с событиями: пачка повторяется, пока БД не вернётся, и в dead-letter не уходит.
+# В dead-letter попадают события, на которых падает сам запрос (psycopg2.DatabaseError, кроме этих) или разбор
+# пачки в коде (поле повреждённой строки неверного типа), - иначе сегмент с таким событием не разобрался бы никогда
+TRANSIENT_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError, PoolTimeout)
+
+# Ключ события занимается в том же запросе, что и конверсия с начислением: конверсия пишется
+# только для ключей, которые вставились в pixel_events. Без подписанного click_id - последний
+# клик пары не позже самой конверсии: пока событие ждало в очереди, могли прийти новые клики
+INSERT_CONVERSIONS_SQL = '''
+    WITH v AS (
+        SELECT v.event_id, v.offer_id, v.webmaster_id, v.payout, v.commission, v.ip_address, v.converted_at,
+               COALESCE(v.click_id, (
+                   SELECT id FROM clicks
+                   WHERE offer_id = v.offer_id AND webmaster_id = v.webmaster_id AND clicked_at <= v.converted_at
+                   ORDER BY clicked_at DESC LIMIT 1
+               )) AS click_id
+        FROM (VALUES %s) AS v(event_id, offer_id, webmaster_id, click_id, payout, commission, ip_address, converted_at)
+    ), claimed AS (
+        INSERT INTO pixel_events (event_id)
+        SELECT event_id FROM v
+        ON CONFLICT DO NOTHING
+        RETURNING event_id
+    ), conversion AS (
+        INSERT INTO conversions (offer_id, webmaster_id, click_id, payout, commission, ip_address,
+                                 status, converted_at)
+        SELECT v.offer_id, v.webmaster_id, v.click_id, v.payout, v.commission, v.ip_address, 'approved', v.converted_at
+        FROM v JOIN claimed USING (event_id)
+        RETURNING id, webmaster_id, payout
+    ), ledger AS (
+        INSERT INTO balance_ledger (user_id, amount, reason, conversion_id)
+        SELECT webmaster_id, payout, 'conversion', id FROM conversion
+    )
+    SELECT COUNT(*) AS claimed FROM claimed
+'''
+INSERT_CONVERSIONS_TEMPLATE = '(%s, %s::int, %s::int, %s::bigint, %s::numeric, %s::numeric, %s, %s::timestamp)'
+
+# Клик без заранее выданного id (блок id был пуст) не отсекается первичным ключом clicks,
+# поэтому его событие занимает ключ в pixel_events, как конверсия
+CLAIM_EVENTS_SQL = '''
+    INSERT INTO pixel_events (event_id) SELECT unnest(%s::text[])
+    ON CONFLICT DO NOTHING
+    RETURNING event_id
+'''
+
+PRUNE_EVENTS_SQL = "DELETE FROM pixel_events WHERE processed_at < LOCALTIMESTAMP - %s * interval '1 day'"
+
+
+def _parse_event(event: Dict[str, Any]) -> tuple:
+    '''Строка для INSERT; KeyError/ValueError/TypeError для повреждённого события'''
+    at = datetime.fromisoformat(event['at'])
+    if at.tzinfo is not None:
+        # Очередь пишет время UTC без зоны; с зоной оно не сравнивалось бы с остальными событиями пачки
+        at = at.astimezone(timezone.utc).replace(tzinfo=None)
+    if event['type'] == 'click':
+        return (int(event['offer_id']), int(event['wm_id']), event.get('ip') or '', event.get('user_agent') or '',
+                event.get('referrer') or '', event.get('utm_source', 'cpasibo_pro'), event.get('utm_medium', 'cpl'),
+                at, int(event['click_id']) if event.get('click_id') is not None else None,
+                bool(event.get('is_unique', True)), str(event['id']))
+    if event['type'] == 'convert':
+        click_id = event.get('click_id')
+        return (str(event['id']), int(event['offer_id']), int(event['wm_id']),
+                int(click_id) if click_id is not None else None, event.get('ip') or '', at)
+    raise ValueError(f"неизвестный тип события {event['type']!r}")
+
+
+class PipelineWorker:
+    '''
+    Разбирает запечатанные сегменты очереди пачками по EVENT_BATCH_SIZE, каждая пачка - одна транзакция.
+    Цикл asyncio живёт в своём потоке (или процессе), поэтому вызовы psycopg2 выполняются в нём напрямую:
+    пул потоков для них не нужен, а после начала остановки интерпретатора он уже и не принимает задачи.
+    '''
+
+    def __init__(self, queue: EventQueue, batch_size: int = 1000, interval: float = 0.5,
+                 max_attempts: int = 5, retry_max: float = 30.0, dedup_days: int = 7):
+        self.queue = queue
+        self.batch_size = batch_size
+        self.interval = interval
+        self.max_attempts = max_attempts
+        self.retry_max = retry_max
+        self.dedup_days = dedup_days
+        self._stopping = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._pruned_at = 0.0
+        self._stats = {'batches': 0, 'applied': 0, 'duplicates': 0, 'rejected': 0, 'retries': 0,
+                       'transient_errors': 0, 'dead_lettered': 0, 'last_batch_ms': 0.0, 'lag_seconds': 0.0}
+
+    def _apply(self, items: List[tuple]) -> None:
+        '''Одна транзакция на пачку (событие, строка): клики, затем конверсии - чтобы атрибуция
+        видела клики этой же пачки'''
+        clicks = [row for event, row in items if event['type'] == 'click']
+        conversions = [row for event, row in items if event['type'] == 'convert']
+        started = time.perf_counter()
+        with get_connection() as conn, conn.cursor(cursor_factory=RealDictCursor) as cursor:
+            apply_invalidations(conn)
+            offer_ids = [row[0] for row in clicks] + [row[1] for row in conversions]
+            wm_ids = [row[1] for row in clicks] + [row[2] for row in conversions]
+            offers = get_active_offers(cursor, offer_ids)
+            webmasters = find_webmasters(cursor, wm_ids)
+
+            click_rows = [row for row in clicks if str(row[0]) in offers and str(row[1]) in webmasters]
+            unnumbered = [row[10] for row in click_rows if row[8] is None]
+            if unnumbered:
+                cursor.execute(CLAIM_EVENTS_SQL, (unnumbered,))
+                fresh = {row['event_id'] for row in cursor.fetchall()}
+                skipped = len(unnumbered) - len(fresh)
+                click_rows = [row for row in click_rows if row[8] is not None or row[10] in fresh]
+            else:
+                skipped = 0
+            conversion_rows = []
+            for event_id, offer_id, wm_id, click_id, ip_address, converted_at in conversions:
+                if str(offer_id) not in offers or str(wm_id) not in webmasters:
+                    continue
+                payout = float(offers[str(offer_id)]['payout'])
+                commission = payout * 0.20
+                conversion_rows.append((event_id, offer_id, wm_id, click_id, payout - commission, commission,
+                                        ip_address, converted_at))
+            rejected = len(clicks) + len(conversions) - len(click_rows) - len(conversion_rows) - skipped
+
+            times = [row[7] for row in click_rows] + [row[7] for row in conversion_rows]
+            if times:
+                cursor.execute(REWIND_ROLLUPS_SQL, {'oldest': min(times)})
+            inserted = claimed = 0
+            if click_rows:
+                execute_values(cursor, INSERT_CLICKS_SQL, [row[:10] for row in click_rows],
+                               template=INSERT_CLICKS_TEMPLATE, page_size=len(click_rows))
+                inserted = cursor.rowcount
+            if conversion_rows:
+                claimed = execute_values(cursor, INSERT_CONVERSIONS_SQL, conversion_rows,
+                                         template=INSERT_CONVERSIONS_TEMPLATE, page_size=len(conversion_rows),
+                                         fetch=True)[0]['claimed']
+            conn.commit()
+
+        self._stats['batches'] += 1
+        self._stats['applied'] += inserted + claimed
+        self._stats['duplicates'] += len(click_rows) + len(conversion_rows) - inserted - claimed + skipped
+        self._stats['rejected'] += rejected
+        self._stats['last_batch_ms'] = round(1000 * (time.perf_counter() - started), 3)
+        if times:
+            self._stats['lag_seconds'] = round((datetime.utcnow() - min(times)).total_seconds(), 3)
+
+    async def _apply_with_retry(self, items: List[tuple], attempts: int) -> None:
+        '''Недоступная БД - повтор с растущей паузой без счёта попыток. Ошибка запроса - attempts повторов,
+        прочее исключение - без повторов; затем пачка делится пополам, пока не останется одно событие,
+        и оно уходит в dead-letter'''
+        delay = 0.5
+        while True:
+            try:
+                self._apply(items)
+                return
+            except TRANSIENT_ERRORS as e:
+                self._stats['transient_errors'] += 1
+                if self._stopping.is_set():
+                    raise
+                logger.warning('event batch postponed, database unavailable: %s', e)
+            except Exception as e:
+                attempts = attempts - 1 if isinstance(e, psycopg2.DatabaseError) else 0
+                if attempts > 0:
+                    self._stats['retries'] += 1
+                elif len(items) > 1:
+                    middle = len(items) // 2
+                    await self._apply_with_retry(items[:middle], 1)
+                    await self._apply_with_retry(items[middle:], 1)
+                    return
+                else:
+                    logger.exception('event dead-lettered')
+                    self.queue.dead_letter([event for event, _ in items], f'{type(e).__name__}: {e}')
+                    self._stats['dead_lettered'] += 1
+                    return
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.retry_max)
+
+    def _parse(self, events: List[Dict[str, Any]], bad: List[str]) -> List[tuple]:
+        '''Пары (событие, строка) сегмента без повторов id; повреждённые события - сразу в dead-letter'''
+        items, seen = [], set()
+        for event in events:
+            try:
+                row = _parse_event(event)
+            except (KeyError, ValueError, TypeError):
+                bad.append(event)
+                continue
+            key = str(event['id'])
+            if key in seen:
+                self._stats['duplicates'] += 1
+                continue
+            seen.add(key)
+            items.append((event, row))
+        if bad:
+            self.queue.dead_letter(bad, 'событие не разбирается или без обязательных полей')
+            self._stats['dead_lettered'] += len(bad)
+        return items
+
+    async def drain(self) -> int:
+        '''Разбирает все запечатанные сегменты; число прочитанных событий'''
+        self.queue.seal_if_due()
+        with self.queue.drain_lock() as locked:
+            if not locked:
+                return 0
+            drained = 0
+            for path in self.queue.sealed_segments():
+                events, bad = self.queue.read_segment(path)
+                items = self._parse(events, bad)
+                for start in range(0, len(items), self.batch_size):
+                    await self._apply_with_retry(items[start:start + self.batch_size], self.max_attempts)
+                self.queue.ack(path)
+                drained += len(events)
+            if not drained:
+                self._prune()
+            return drained
+
+    def drain_now(self) -> int:
+        '''Синхронный разбор без повторов для остановки процесса (после atexit потоков уже не запустить):
+        первая же ошибка оставляет сегмент на диске до следующего разборщика'''
+        with self.queue.drain_lock() as locked:
+            if not locked:
+                return 0
+            drained = 0
+            for path in self.queue.sealed_segments():
+                events, bad = self.queue.read_segment(path)
+                items = self._parse(events, bad)
+                for start in range(0, len(items), self.batch_size):
+                    self._apply(items[start:start + self.batch_size])
+                self.queue.ack(path)
+                drained += len(events)
+            return drained
+
+    def _prune(self) -> None:
+        '''Раз в час удаляет ключи старше EVENT_DEDUP_DAYS - это и есть окно, в котором повтор распознаётся'''
+        if time.monotonic() - self._pruned_at < 3600:
+            return
+        with get_connection() as conn, conn.cursor() as cursor:
+            cursor.execute(PRUNE_EVENTS_SQL, (self.dedup_days,))
+            conn.commit()
+        self._pruned_at = time.monotonic()
+
+    async def run(self) -> None:
+        while not self._stopping.is_set():
+            try:
+                if self._thread is not None:
+                    self.queue.reserve_ids()
+                drained = await self.drain()
+            except Exception:
+                logger.exception('event drain failed')
+                drained = 0
+            if not drained:
+                await asyncio.sleep(self.interval)
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=asyncio.run, args=(self.run(),), name='event-pipeline', daemon=True)
+        self._thread.start()
+
+    def shutdown(self) -> None:
+        '''Останавливает цикл и разбирает остаток; при недоступной БД события остаются в сегментах'''
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.retry_max)
+        self.queue.close()
+        try:
+            self.drain_now()
+        except Exception:
+            logger.exception('event drain on shutdown failed, events kept in queue')
+
+    def stats(self) -> Dict[str, Any]:
+        return dict(self._stats, running=self._thread is not None and self._thread.is_alive())
+
+
+def worker_from_env(queue: EventQueue) -> PipelineWorker:
+    return PipelineWorker(
+        queue,
+        batch_size=int(os.environ.get('EVENT_BATCH_SIZE', '1000')),
+        interval=float(os.environ.get('EVENT_DRAIN_INTERVAL', '0.5')),
+        max_attempts=int(os.environ.get('EVENT_MAX_ATTEMPTS', '5')),
+        retry_max=float(os.environ.get('EVENT_RETRY_MAX_SECONDS', '30')),
+        dedup_days=int(os.environ.get('EVENT_DEDUP_DAYS', '7')),
+    )
+
+
+def _start_worker() -> Optional[PipelineWorker]:
+    if event_queue is None or os.environ.get('EVENT_PIPELINE_WORKER', 'inline') != 'inline':
+        return None
+    worker = worker_from_env(event_queue)
+    worker.start()
+    atexit.register(worker.shutdown)
+    return worker
+
+
+pipeline_worker = _start_worker()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Разбор очереди событий пикселя (EVENT_QUEUE_DIR) в PostgreSQL')
+    parser.add_argument('--once', action='store_true', help='разобрать накопленное и выйти')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    worker = worker_from_env(queue_from_env())
+    if args.once:
+        print(f'drained {asyncio.run(worker.drain())} events')
+        print(worker.stats())
+        return
+    try:
+        asyncio.run(worker.run())
+    except KeyboardInterrupt:
+        sys.exit(0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+'''
+Business: Пиксель-скрипт для сайтов рекламодателей - минифицируется и сжимается один раз при импорте
+Args: PIXEL_SCRIPT_URL из окружения - публичный адрес скрипта без версии
+Returns: PIXEL_VERSION, PIXEL_SCRIPT_URL (адрес с версией), pixel_response() - ответ с подходящим сжатием
+'''
+import os
+import gzip
+import base64
+import hashlib
+from typing import Dict, Any
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+PIXEL_SOURCE = '''
+(function() {
+    var offerId = document.currentScript.getAttribute('data-offer-id');
+    if (!offerId) return;
+
+    var urlParams = new URLSearchParams(window.location.search);
+    var wmId = urlParams.get('wm_id');
+    var utmSource = urlParams.get('utm_source');
+    var utmMedium = urlParams.get('utm_medium');
+    var storageKey = 'cpasibo_click_' + offerId;
+    var apiUrl = window.location.protocol + '//' + window.location.host + '/api/pixel';
+
+    function loadClick() {
+        try {
+            return JSON.parse(window.localStorage.getItem(storageKey)) || {};
+        } catch (e) {
+            return {};
+        }
+    }
+
+    function saveClick(clickId) {
+        try {
+            window.localStorage.setItem(storageKey, JSON.stringify({id: clickId, wm: wmId}));
+        } catch (e) {}
+    }
+
+    if (wmId && utmSource === 'cpasibo_pro' && utmMedium === 'cpl') {
+        var clickUrl = apiUrl + '?action=click&offer_id=' + offerId +
+                       '&wm_id=' + wmId +
+                       '&referrer=' + encodeURIComponent(document.referrer);
+        if (window.fetch) {
+            fetch(clickUrl + '&format=json', {credentials: 'omit'})
+                .then(function(r) { return r.json(); })
+                .then(function(data) { if (data.click_id) saveClick(data.click_id); })
+                .catch(function() {});
+        } else {
+            var img = new Image();
+            img.src = clickUrl;
+        }
+    }
+
+    window.cpasibo = {
+        trackConversion: function() {
+            var click = loadClick();
+            var convertWm = wmId || click.wm;
+            if (!convertWm || !offerId) return;
+            // sendBeacon доставляет событие и при уходе со страницы; без него - прежний GET через img
+            var event = {type: 'convert', offer_id: offerId, wm_id: convertWm, click_id: click.id};
+            if (navigator.sendBeacon && navigator.sendBeacon(apiUrl + '?action=batch', JSON.stringify([event]))) return;
+            var img = new Image();
+            img.src = apiUrl + '?action=convert&offer_id=' + offerId + '&wm_id=' + convertWm +
+                      (click.id ? '&click_id=' + encodeURIComponent(click.id) : '');
+        }
+    };
+})();
+'''
+
+
+def _is_word(char: str) -> bool:
+    return char.isalnum() or char in '_$'
+
+
+def minify_js(source: str) -> str:
+    '''Убирает пробелы и переводы строк вне строковых литералов; пробел остаётся только между словами.
+    Рассчитан на скрипт без регулярных выражений и без опоры на автоподстановку точки с запятой'''
+    out = []
+    quote = None
+    pending_space = False
+    i = 0
+    while i < len(source):
+        char = source[i]
+        if quote:
+            out.append(char)
+            if char == '\\':
+                out.append(source[i + 1])
+                i += 1
+            elif char == quote:
+                quote = None
+        elif char.isspace():
+            pending_space = True
+        elif char == '/' and source[i + 1:i + 2] == '/':
+            while i < len(source) and source[i] != '\n':
+                i += 1
+            pending_space = True
+            continue
+        else:
+            if pending_space and out and _is_word(out[-1][-1]) and _is_word(char):
+                out.append(' ')
+            pending_space = False
+            if char in '\'"':
+                quote = char
+            out.append(char)
+        i += 1
+    return ''.join(out)
+
+
+PIXEL_JS = minify_js(PIXEL_SOURCE).encode('utf-8')
+PIXEL_VERSION = hashlib.sha256(PIXEL_JS).hexdigest()[:16]
+PIXEL_ETAG = f'"{PIXEL_VERSION}"'
+PIXEL_SCRIPT_URL = f"{os.environ.get('PIXEL_SCRIPT_URL', 'https://cpasibo.pro/pixel.js')}?v={PIXEL_VERSION}"
+
+# mtime=0 - одинаковые байты gzip в каждом контейнере
+PIXEL_BODIES = {'gzip': base64.b64encode(gzip.compress(PIXEL_JS, compresslevel=9, mtime=0)).decode('ascii')}
+if brotli is not None:
+    PIXEL_BODIES['br'] = base64.b64encode(brotli.compress(PIXEL_JS, quality=11)).decode('ascii')
+
+# Адрес с текущей версией не меняет содержимое никогда; старые встраивания без версии
+# (или с прошлой версией) получают короткий кэш, чтобы подхватить новый скрипт
+IMMUTABLE_CACHE = 'public, max-age=31536000, immutable'
+UNVERSIONED_CACHE = 'public, max-age=300'
+
+
+def _header(event: Dict[str, Any], name: str) -> str:
+    for key, value in (event.get('headers') or {}).items():
+        if key.lower() == name:
+            return value or ''
+    return ''
+
+
+def pixel_response(event: Dict[str, Any], version: str = None) -> Dict[str, Any]:
+    headers = {
+        'Content-Type': 'application/javascript; charset=utf-8',
+        'Access-Control-Allow-Origin': '*',
+        'Cache-Control': IMMUTABLE_CACHE if version == PIXEL_VERSION else UNVERSIONED_CACHE,
+        'ETag': PIXEL_ETAG,
+        'Vary': 'Accept-Encoding',
+    }
+    if PIXEL_ETAG in [tag.strip() for tag in _header(event, 'if-none-match').split(',')]:
+        return {'statusCode': 304, 'headers': headers, 'body': ''}
+
+    accepted = [part.split(';')[0].strip() for part in _header(event, 'accept-encoding').lower().split(',')]
+    for encoding in ('br', 'gzip'):
+        if encoding in accepted and encoding in PIXEL_BODIES:
+            headers['Content-Encoding'] = encoding
+            return {'statusCode': 200, 'headers': headers, 'body': PIXEL_BODIES[encoding], 'isBase64Encoded': True}
+    return {'statusCode': 200, 'headers': headers, 'body': PIXEL_JS.decode('utf-8')}
@@ -0,0 +1,130 @@
+'''
+Business: S2S-постбэки конверсий от рекламодателя с идемпотентностью по transaction_id
+Args: постбэк {"offer_id", "transaction_id", "click_id" или "wm_id", "ip"} от партнёра с токеном
+      (batch.is_partner_request); POSTBACK_FILTER_SIZE, POSTBACK_FILTER_ERROR_RATE из окружения
+Returns: process_postbacks() - результат по каждому постбэку: [200] записан, [409] повтор, [400]/[404] отказ
+'''
+import os
+from typing import Dict, Any, List, Optional, Tuple
+from psycopg2.extras import execute_values
+from batch import parse_id, has_valid_fields, event_client, FIELD_TYPES
+from bloom import RotatingBloomFilter
+from cache import get_active_offers, find_webmasters
+from click_ids import parse_click_id
+
+# Недавние ключи контейнера. Положительный ответ фильтра только повод проверить ключ чтением
+# из conversion_postbacks: повтор отсекается без записи, а ложное срабатывание ничего не теряет.
+# Отрицательный ответ точен, но уникальность всё равно держит первичный ключ таблицы.
+recent_postbacks = RotatingBloomFilter(
+    capacity=int(os.environ.get('POSTBACK_FILTER_SIZE', '100000')),
+    error_rate=float(os.environ.get('POSTBACK_FILTER_ERROR_RATE', '0.01')),
+)
+
+POSTBACK_FIELD_TYPES = dict(FIELD_TYPES, transaction_id=(str, int))
+
+SEEN_POSTBACKS_SQL = '''
+    SELECT p.offer_id, p.transaction_id
+    FROM conversion_postbacks p
+    JOIN unnest(%s::int[], %s::text[]) AS k(offer_id, transaction_id)
+      ON p.offer_id = k.offer_id AND p.transaction_id = k.transaction_id
+'''
+
+# Ключ занимается в том же запросе, что и конверсия с начислением: конверсия пишется
+# только для ключей, которые вставились в conversion_postbacks
+INSERT_POSTBACKS_SQL = '''
+    WITH v AS (
+        SELECT v.offer_id, v.transaction_id, v.webmaster_id, v.payout, v.commission, v.ip_address,
+               COALESCE(v.click_id, (
+                   SELECT id FROM clicks
+                   WHERE offer_id = v.offer_id AND webmaster_id = v.webmaster_id
+                   ORDER BY clicked_at DESC LIMIT 1
+               )) AS click_id
+        FROM (VALUES %s) AS v(offer_id, transaction_id, webmaster_id, click_id, payout, commission, ip_address)
+    ), claimed AS (
+        INSERT INTO conversion_postbacks (offer_id, transaction_id)
+        SELECT offer_id, transaction_id FROM v
+        ON CONFLICT DO NOTHING
+        RETURNING offer_id, transaction_id
+    ), conversion AS (
+        INSERT INTO conversions (offer_id, webmaster_id, click_id, payout, commission, ip_address,
+                                 status, transaction_id)
+        SELECT v.offer_id, v.webmaster_id, v.click_id, v.payout, v.commission, v.ip_address, 'approved', v.transaction_id
+        FROM v JOIN claimed USING (offer_id, transaction_id)
+        RETURNING id, webmaster_id, payout
+    ), ledger AS (
+        INSERT INTO balance_ledger (user_id, amount, reason, conversion_id)
+        SELECT webmaster_id, payout, 'conversion', id FROM conversion
+    )
+    SELECT offer_id, transaction_id FROM claimed
+'''
+INSERT_POSTBACKS_TEMPLATE = '(%s::int, %s, %s::int, %s::bigint, %s::numeric, %s::numeric, %s)'
+
+
+def filter_key(offer_id: str, transaction_id: str) -> str:
+    return f'{offer_id}:{transaction_id}'
+
+
+def _seen_postbacks(cursor, keys: List[Tuple[str, str]]) -> set:
+    cursor.execute(SEEN_POSTBACKS_SQL, ([int(offer_id) for offer_id, _ in keys], [txn for _, txn in keys]))
+    return {(str(row['offer_id']), row['transaction_id']) for row in cursor.fetchall()}
+
+
+def process_postbacks(cursor, postbacks: List[Dict[str, Any]], ip_address: str, partner: bool = False) -> List[list]:
+    '''Повторы внутри пачки и уже записанные ключи получают [409] без записи в БД;
+    ip из постбэка учитывается только для партнёра, иначе - адрес соединения'''
+    results: List[Optional[list]] = [None] * len(postbacks)
+    pending, batch_keys = [], set()
+
+    for n, postback in enumerate(postbacks):
+        if not has_valid_fields(postback, POSTBACK_FIELD_TYPES):
+            results[n] = [400]
+            continue
+        offer_id, wm_id = parse_id(postback.get('offer_id')), parse_id(postback.get('wm_id'))
+        transaction_id = str(postback.get('transaction_id') or '').strip()
+        signed_click = parse_click_id(postback.get('click_id'))
+        if signed_click and str(signed_click['offer_id']) == offer_id and \
+                (not wm_id or str(signed_click['webmaster_id']) == wm_id):
+            wm_id = str(signed_click['webmaster_id'])
+        else:
+            signed_click = None
+        if not offer_id or not wm_id or not transaction_id or len(transaction_id) > 128:
+            results[n] = [400]
+        elif (offer_id, transaction_id) in batch_keys:
+            results[n] = [409]
+        else:
+            batch_keys.add((offer_id, transaction_id))
+            pending.append((n, offer_id, wm_id, transaction_id, signed_click, postback))
+
+    maybe_seen = [(item[1], item[3]) for item in pending if filter_key(item[1], item[3]) in recent_postbacks]
+    if maybe_seen:
+        seen = _seen_postbacks(cursor, maybe_seen)
+        for item in pending:
+            if (item[1], item[3]) in seen:
+                results[item[0]] = [409]
+        pending = [item for item in pending if results[item[0]] is None]
+    if not pending:
+        return results
+
+    offers = get_active_offers(cursor, [item[1] for item in pending])
+    webmasters = find_webmasters(cursor, [item[2] for item in pending])
+    rows = []
+    for n, offer_id, wm_id, transaction_id, signed_click, postback in pending:
+        if offer_id not in offers or wm_id not in webmasters:
+            results[n] = [404]
+            continue
+        payout = float(offers[offer_id]['payout'])
+        commission = payout * 0.20
+        rows.append((offer_id, transaction_id, wm_id, signed_click['click_id'] if signed_click else None,
+                     payout - commission, commission, event_client(postback, ip_address, '', partner)[0]))
+    if not rows:
+        return results
+
+    claimed = execute_values(cursor, INSERT_POSTBACKS_SQL, rows, template=INSERT_POSTBACKS_TEMPLATE,
+                             page_size=len(rows), fetch=True)
+    claimed = {(str(row['offer_id']), row['transaction_id']) for row in claimed}
+    for n, offer_id, wm_id, transaction_id, _, _ in pending:
+        if results[n] is None:
+            # Не занятый ключ - повтор, который фильтр этого контейнера ещё не видел
+            results[n] = [200] if (offer_id, transaction_id) in claimed else [409]
+            recent_postbacks.add(filter_key(offer_id, transaction_id))
+    return results
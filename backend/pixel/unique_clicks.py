@@ -0,0 +1,25 @@
+'''
+Business: Уникальность клика при приёме - повтор (ip, user_agent, offer_id, wm_id) в пределах окна не уникален
+Args: UNIQUE_CLICK_WINDOW, UNIQUE_CLICK_CAPACITY, UNIQUE_CLICK_ERROR_RATE из окружения
+Returns: is_unique_click() - значение clicks.is_unique для нового клика, unique_click_stats() - для метрик
+'''
+import os
+from typing import Dict, Any
+from bloom import RotatingBloomFilter
+
+# Память ограничена двумя поколениями фильтра Блума. Ложное срабатывание (доля error_rate)
+# помечает новый клик повтором; каждый контейнер помнит только свои клики. Поколение сменяется
+# и по заполнению, поэтому при потоке больше capacity кликов за window окно уникальности короче
+recent_clicks = RotatingBloomFilter(
+    capacity=int(os.environ.get('UNIQUE_CLICK_CAPACITY', '200000')),
+    error_rate=float(os.environ.get('UNIQUE_CLICK_ERROR_RATE', '0.001')),
+    window=float(os.environ.get('UNIQUE_CLICK_WINDOW', '86400')),
+)
+
+
+def is_unique_click(ip_address: str, user_agent: str, offer_id: Any, webmaster_id: Any) -> bool:
+    return recent_clicks.add(f'{ip_address}|{user_agent}|{offer_id}|{webmaster_id}')
+
+
+def unique_click_stats() -> Dict[str, Any]:
+    return dict(recent_clicks.stats(), window=recent_clicks.window)
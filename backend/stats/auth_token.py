@@ -0,0 +1,65 @@
+'''
+Business: Пользователь запроса статистики по X-Auth-Token - та же проверка, что action=verify функции auth
+Args: event с заголовком X-Auth-Token; AUTH_TOKEN_SECRET из окружения для подписанных токенов
+Returns: request_token() - токен из заголовков, token_user() - {'id', 'email', 'role'} или None
+'''
+import os
+import hmac
+import json
+import time
+import base64
+import hashlib
+from typing import Dict, Any, Optional
+
+# Формат подписанного токена - как в backend/auth/sessions.py; без секрета такие токены не принимаются
+SIGNED_PREFIX = 'v1.'
+_SIGNATURE_SIZE = 16
+_SECRET = os.environ.get('AUTH_TOKEN_SECRET', '').encode('utf-8') or None
+
+
+def request_token(event: Dict[str, Any]) -> str:
+    for name, value in (event.get('headers') or {}).items():
+        if name.lower() == 'x-auth-token' and isinstance(value, str):
+            return value.strip()
+    return ''
+
+
+def _b64decode(text: str) -> bytes:
+    return base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+
+
+def _signed_user(token: str) -> Optional[Dict[str, Any]]:
+    if _SECRET is None:
+        return None
+    payload, _, signature = token[len(SIGNED_PREFIX):].partition('.')
+    expected = base64.urlsafe_b64encode(
+        hmac.new(_SECRET, payload.encode('ascii', 'replace'), hashlib.sha256).digest()[:_SIGNATURE_SIZE]
+    ).rstrip(b'=').decode('ascii')
+    if not payload or not hmac.compare_digest(signature.encode('ascii', 'replace'), expected.encode('ascii')):
+        return None
+    try:
+        claims = json.loads(_b64decode(payload))
+    except ValueError:
+        return None
+    if claims.get('exp', 0) <= time.time():
+        return None
+    return {'id': claims['id'], 'email': claims['email'], 'role': claims['role']}
+
+
+def token_user(cursor, token: str) -> Optional[Dict[str, Any]]:
+    '''Пользователь действующей сессии или подписанного токена; None для пустого, чужого или истёкшего'''
+    if not token:
+        return None
+    if token.startswith(SIGNED_PREFIX):
+        return _signed_user(token)
+    cursor.execute(
+        """
+        SELECT u.id, u.email, u.role
+        FROM sessions s
+        JOIN users u ON s.user_id = u.id
+        WHERE s.token = %s AND s.expires_at > NOW()
+        """,
+        (token,)
+    )
+    row = cursor.fetchone()
+    return dict(row) if row else None
@@ -0,0 +1,86 @@
+'''
+Business: Дневные ряды для графиков дашборда - клики, конверсии и деньги роли по каждому дню периода, без пропусков
+Args: STATS_SERIES_MAX_DAYS из окружения; scope роли (planner.ROLE_SCOPES) и границы ряда series_from/series_to
+Returns: parse_series_days() - период из запроса, series_params() - границы ряда,
+         daily_series_cte()/series_json() - фрагменты SQL для планировщика
+'''
+import os
+from datetime import date, timedelta
+from typing import Dict, Any
+from rollup import ROLLUP_NAME
+
+SERIES_MAX_DAYS = int(os.environ.get('STATS_SERIES_MAX_DAYS', '366'))
+
+# Деньги в ряду - та же сумма, что в итогах роли; отдаются строкой, как остальные денежные поля
+SERIES_MONEY = {
+    'webmaster': ('earnings', 'payout'),
+    'advertiser': ('spent', 'payout + commission'),
+    'admin': ('commission', 'commission'),
+}
+
+
+def parse_series_days(params: Dict[str, Any]) -> int:
+    '''Период ряда из параметров запроса; ошибка - ValueError с текстом для ответа 400'''
+    period = params.get('period', '30')
+    if not str(period).isdigit() or not 1 <= int(period) <= SERIES_MAX_DAYS:
+        raise ValueError(f'period должен быть от 1 до {SERIES_MAX_DAYS} дней')
+    return int(period)
+
+
+def series_params(days: int, today: date) -> Dict[str, Any]:
+    '''Ряд из days календарных дней, последний - сегодняшний'''
+    return {'series_from': today - timedelta(days=days - 1), 'series_to': today}
+
+
+def daily_series_cte(name: str, scope: str) -> str:
+    '''
+    CTE name(day, clicks, unique_clicks, conversions, payout, commission) - строка на каждый день
+    [series_from, series_to], дни без событий - нулями. Дни до отметки читаются одним диапазоном
+    по stats_daily, события после отметки - по сырым таблицам индексом по времени.
+    '''
+    since = f"GREATEST(%(series_from)s::timestamp, (SELECT rolled_until FROM rollup_watermarks WHERE name = '{ROLLUP_NAME}'))"
+    return f'''
+    {name} AS (
+        SELECT d::date AS day,
+               COALESCE(SUM(f.clicks), 0) AS clicks,
+               COALESCE(SUM(f.unique_clicks), 0) AS unique_clicks,
+               COALESCE(SUM(f.conversions), 0) AS conversions,
+               COALESCE(SUM(f.payout), 0) AS payout,
+               COALESCE(SUM(f.commission), 0) AS commission
+        FROM generate_series(%(series_from)s::date, %(series_to)s::date, interval '1 day') d
+        LEFT JOIN (
+            SELECT day, clicks, unique_clicks, conversions, payout, commission
+            FROM stats_daily
+            WHERE day >= %(series_from)s AND day <= %(series_to)s AND {scope}
+            UNION ALL
+            SELECT clicked_at::date, 1, is_unique::int, 0, 0, 0
+            FROM clicks
+            WHERE clicked_at >= {since} AND {scope}
+            UNION ALL
+            SELECT converted_at::date, 0, 0, 1, payout, commission
+            FROM conversions
+            WHERE status = 'approved' AND converted_at >= {since} AND {scope}
+        ) f ON f.day = d::date
+        GROUP BY d
+    )
+    '''
+
+
+def series_json(series: str, role: str) -> str:
+    '''Скалярный подзапрос: JSON-массив дней по порядку с нарастающими итогами с начала периода'''
+    money, money_sql = SERIES_MONEY[role]
+    return f'''
+    (SELECT COALESCE(json_agg(json_build_object(
+                'date', s.day, 'clicks', s.clicks, 'unique_clicks', s.unique_clicks,
+                'conversions', s.conversions, '{money}', s.money::text,
+                'cumulative_clicks', s.cumulative_clicks, 'cumulative_conversions', s.cumulative_conversions,
+                'cumulative_{money}', s.cumulative_money::text) ORDER BY s.day), '[]'::json)
+     FROM (
+        SELECT day, clicks, unique_clicks, conversions, {money_sql} AS money,
+               SUM(clicks) OVER w AS cumulative_clicks,
+               SUM(conversions) OVER w AS cumulative_conversions,
+               SUM({money_sql}) OVER w AS cumulative_money
+        FROM {series}
+        WINDOW w AS (ORDER BY day)
+     ) s)
+    '''
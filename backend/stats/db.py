@@ -0,0 +1,197 @@
+'''
+Business: Пул соединений с PostgreSQL, живущий между вызовами в тёплом контейнере
+Args: DATABASE_URL и необязательные DB_POOL_* из окружения
+Returns: get_connection() - контекстный менеджер, который всегда возвращает соединение в пул
+'''
+import os
+import json
+import time
+import logging
+import threading
+from collections import deque
+from contextlib import contextmanager
+from typing import Dict, Any, Optional, Iterator, Callable, List
+import psycopg2
+import psycopg2.extensions
+from tracing import span, traced_cursor_class
+
+logger = logging.getLogger(__name__)
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class PooledConnection(psycopg2.extensions.connection):
+    '''Любой курсор соединения получает замер запросов (tracing.TracedCursorMixin), commit - свой этап'''
+    created_at: float = 0.0
+
+    def cursor(self, *args, **kwargs):
+        if len(args) < 2:
+            factory = kwargs.get('cursor_factory') or self.cursor_factory or psycopg2.extensions.cursor
+            kwargs['cursor_factory'] = traced_cursor_class(factory)
+        return super().cursor(*args, **kwargs)
+
+    def commit(self):
+        with span('commit'):
+            super().commit()
+
+
+class ConnectionPool:
+    '''Ограниченный пул соединений с проверкой живости при повторном использовании'''
+
+    def __init__(self, dsn: str, max_size: int = 4, timeout: float = 5.0,
+                 ping_after: float = 30.0, max_lifetime: float = 1800.0):
+        self.dsn = dsn
+        self.max_size = max_size
+        self.timeout = timeout
+        self.ping_after = ping_after
+        self.max_lifetime = max_lifetime
+        self.on_connect: List[Callable[[Any], None]] = []
+        self._idle: deque = deque()
+        self._size = 0
+        self._cond = threading.Condition()
+        self._stats = {'checkouts': 0, 'waits': 0, 'timeouts': 0, 'connects': 0,
+                       'reconnects': 0, 'discarded': 0}
+
+    def _connect(self):
+        conn = psycopg2.connect(self.dsn, connection_factory=PooledConnection)
+        conn.created_at = time.monotonic()
+        for hook in self.on_connect:
+            hook(conn)
+        self._stats['connects'] += 1
+        return conn
+
+    def _is_healthy(self, conn, idle_since: float) -> bool:
+        if conn.closed:
+            return False
+        status = conn.info.transaction_status
+        if status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            return False
+        now = time.monotonic()
+        if now - conn.created_at > self.max_lifetime:
+            return False
+        if now - idle_since > self.ping_after:
+            try:
+                with conn.cursor() as cursor:
+                    cursor.execute('SELECT 1')
+                conn.rollback()
+            except psycopg2.Error:
+                return False
+        return True
+
+    def _discard(self, conn) -> None:
+        self._stats['discarded'] += 1
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+    def getconn(self):
+        deadline = time.monotonic() + self.timeout
+        with self._cond:
+            waited = False
+            while not self._idle and self._size >= self.max_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._stats['timeouts'] += 1
+                    raise PoolTimeout(f'Нет свободных соединений за {self.timeout} с')
+                if not waited:
+                    self._stats['waits'] += 1
+                    waited = True
+                self._cond.wait(remaining)
+            self._stats['checkouts'] += 1
+            item = self._idle.pop() if self._idle else None
+            if item is None:
+                self._size += 1
+        if item is not None:
+            conn, idle_since = item
+            if self._is_healthy(conn, idle_since):
+                return conn
+            self._discard(conn)
+            self._stats['reconnects'] += 1
+        try:
+            return self._connect()
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+
+    def putconn(self, conn) -> None:
+        if not conn.closed:
+            try:
+                if conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except psycopg2.Error:
+                self._discard(conn)
+        with self._cond:
+            if conn.closed:
+                self._size -= 1
+            else:
+                self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self) -> Iterator[Any]:
+        with span('connect'):
+            conn = self.getconn()
+        try:
+            yield conn
+        except Exception:
+            if not conn.closed:
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    self._discard(conn)
+            raise
+        finally:
+            self.putconn(conn)
+
+    def poll_idle(self, apply: Callable[[Any], None]) -> None:
+        '''apply(conn) для каждого простаивающего соединения, не выдавая его из пула - например, разбор
+        NOTIFY, уже полученных сокетом: conn.poll() читает их без запроса к БД'''
+        with self._cond:
+            for conn, _ in self._idle:
+                try:
+                    apply(conn)
+                except psycopg2.Error:
+                    pass
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            return dict(self._stats, size=self._size, idle=len(self._idle),
+                        in_use=self._size - len(self._idle), max_size=self.max_size)
+
+    def log_stats(self) -> None:
+        logger.info('db_pool %s', json.dumps(self.stats()))
+
+    def close(self) -> None:
+        with self._cond:
+            while self._idle:
+                conn, _ = self._idle.pop()
+                self._size -= 1
+                self._discard(conn)
+
+
+_pool: Optional[ConnectionPool] = None
+_pool_lock = threading.Lock()
+
+
+def get_pool() -> ConnectionPool:
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(
+                    os.environ['DATABASE_URL'],
+                    max_size=int(os.environ.get('DB_POOL_MAX_SIZE', '4')),
+                    timeout=float(os.environ.get('DB_POOL_TIMEOUT', '5')),
+                    ping_after=float(os.environ.get('DB_POOL_PING_AFTER', '30')),
+                    max_lifetime=float(os.environ.get('DB_POOL_MAX_LIFETIME', '1800')),
+                )
+    return _pool
+
+
+def get_connection():
+    return get_pool().connection()
@@ -0,0 +1,180 @@
+'''
+Business: Потоковая выгрузка сырых кликов и конверсий в CSV или NDJSON с постоянной памятью
+Args: queryStringParameters (kind, format, offer_id, webmaster_id, date_from, date_to, after),
+      EXPORT_CHUNK_BYTES и EXPORT_ITERSIZE из окружения
+Returns: parse_export_params() - проверенные параметры, iter_export() - строки выгрузки,
+         export_chunk() - часть выгрузки не больше лимита ответа и курсор следующей части
+'''
+import io
+import os
+import csv
+import json
+import uuid
+import base64
+from datetime import datetime, timedelta
+from typing import Dict, Any, Iterator, List, Optional, Tuple
+
+# Ответ функции ограничен по размеру; выгрузка отдаётся частями, каждая часть не больше лимита
+CHUNK_BYTES = int(os.environ.get('EXPORT_CHUNK_BYTES', '3000000'))
+# Сколько строк серверный курсор передаёт за одно обращение к БД
+ITERSIZE = int(os.environ.get('EXPORT_ITERSIZE', '5000'))
+DEFAULT_PERIOD_DAYS = 30
+
+# Колонки выгрузки: (таблица, колонка времени, колонки в порядке вывода)
+EXPORT_KINDS = {
+    'clicks': ('clicks', 'clicked_at', [
+        'id', 'offer_id', 'webmaster_id', 'ip_address', 'user_agent', 'referrer',
+        'utm_source', 'utm_medium', 'utm_campaign', 'is_unique', 'clicked_at',
+    ]),
+    'conversions': ('conversions', 'converted_at', [
+        'id', 'offer_id', 'webmaster_id', 'click_id', 'transaction_id', 'status',
+        'payout', 'commission', 'converted_at',
+    ]),
+}
+# Денежные значения отдаются строкой, как и в остальной статистике
+MONEY_COLUMNS = ('payout', 'commission')
+EXPORT_FORMATS = {
+    'csv': 'text/csv; charset=utf-8',
+    'ndjson': 'application/x-ndjson; charset=utf-8',
+}
+
+
+def parse_time(value: str, name: str) -> datetime:
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        raise ValueError(f'{name} должен быть датой в формате ISO: 2024-01-31 или 2024-01-31T12:00:00')
+
+
+def encode_after(at: str, row_id: int, until: datetime) -> str:
+    '''Курсор следующей части: ключ последней отданной строки и верхняя граница, зафиксированная первой частью'''
+    raw = json.dumps([at, row_id, until.isoformat()], separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_after(token: str) -> Tuple[datetime, int, datetime]:
+    try:
+        at, row_id, until = json.loads(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)))
+        return datetime.fromisoformat(at), int(row_id), datetime.fromisoformat(until)
+    except (ValueError, TypeError):
+        raise ValueError('Неверный курсор after')
+
+
+def parse_export_params(params: Dict[str, Any], user_id: Any, role: str) -> Dict[str, Any]:
+    '''ValueError с текстом для ответа 400 при неверных параметрах'''
+    kind = params.get('kind', 'clicks')
+    if kind not in EXPORT_KINDS:
+        raise ValueError(f"kind должен быть одним из: {', '.join(EXPORT_KINDS)}")
+    fmt = params.get('format', 'csv')
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"format должен быть одним из: {', '.join(EXPORT_FORMATS)}")
+    if role not in ('advertiser', 'webmaster', 'admin'):
+        raise ValueError('Неизвестная роль')
+
+    try:
+        user_id = int(user_id)
+        offer_id = int(params['offer_id']) if params.get('offer_id') else None
+        webmaster_id = int(params['webmaster_id']) if params.get('webmaster_id') else None
+    except ValueError:
+        raise ValueError('Неверные параметры user_id, offer_id или webmaster_id')
+
+    date_to = parse_time(params['date_to'], 'date_to') if params.get('date_to') else datetime.utcnow()
+    date_from = (parse_time(params['date_from'], 'date_from') if params.get('date_from')
+                 else date_to - timedelta(days=DEFAULT_PERIOD_DAYS))
+    after_at, after_id = None, None
+    if params.get('after'):
+        # Следующие части читают ту же границу, что и первая: события, пришедшие во время выгрузки, не попадут в неё
+        after_at, after_id, date_to = decode_after(params['after'])
+    if date_from >= date_to:
+        raise ValueError('date_from должен быть раньше date_to')
+
+    return {
+        'kind': kind,
+        'format': fmt,
+        'role': role,
+        'user_id': user_id,
+        'offer_id': offer_id,
+        'webmaster_id': webmaster_id,
+        'date_from': date_from,
+        'date_to': date_to,
+        'after_at': after_at,
+        'after_id': after_id,
+    }
+
+
+def build_export_query(query: Dict[str, Any]) -> str:
+    table, time_column, columns = EXPORT_KINDS[query['kind']]
+    conditions = [f'{time_column} >= %(date_from)s', f'{time_column} < %(date_to)s']
+    if query['role'] == 'advertiser':
+        conditions.append('offer_id IN (SELECT id FROM offers WHERE advertiser_id = %(user_id)s)')
+    elif query['role'] == 'webmaster':
+        conditions.append('webmaster_id = %(user_id)s')
+    if query['offer_id'] is not None:
+        conditions.append('offer_id = %(offer_id)s')
+    if query['webmaster_id'] is not None:
+        conditions.append('webmaster_id = %(webmaster_id)s')
+    if query['after_at'] is not None:
+        # Первое условие сужает диапазон индекса по времени, второе отсекает уже отданные строки того же момента
+        conditions.append(f'{time_column} >= %(after_at)s')
+        conditions.append(f'({time_column}, id) > (%(after_at)s, %(after_id)s)')
+    # Строку выгрузки собирает БД: текст колонок для CSV или готовый JSON-объект для NDJSON, плюс ключ курсора
+    if query['format'] == 'csv':
+        payload = ', '.join(f'{name}::text' for name in columns)
+    else:
+        fields = ', '.join(f"'{name}', {name}::text" if name in MONEY_COLUMNS else f"'{name}', {name}" for name in columns)
+        payload = f'json_build_object({fields})::text'
+    return f'''
+        SELECT e.{time_column}::text, e.id, {payload}
+        FROM {table} e
+        WHERE {' AND '.join(conditions)}
+        ORDER BY e.{time_column}, e.id
+    '''
+
+
+def iter_export(conn, query: Dict[str, Any]) -> Iterator[Tuple[Optional[tuple], str]]:
+    '''
+    (ключ курсора, текст строки) в порядке (время, id); у заголовка CSV ключа нет. Серверный курсор
+    держит в памяти не больше ITERSIZE строк, поэтому объём выгрузки не ограничен памятью функции.
+    '''
+    _, _, columns = EXPORT_KINDS[query['kind']]
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+
+    def csv_line(values) -> str:
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerow(values)
+        return buffer.getvalue()
+
+    csv_format = query['format'] == 'csv'
+    if csv_format and query['after_at'] is None:
+        yield None, csv_line(columns)
+
+    cursor = conn.cursor(name=f'export_{uuid.uuid4().hex}')
+    cursor.itersize = ITERSIZE
+    try:
+        cursor.execute(build_export_query(query), query)
+        for row in cursor:
+            yield row[:2], csv_line(row[2:]) if csv_format else row[2] + '\n'
+    finally:
+        cursor.close()
+        conn.rollback()
+
+
+def export_chunk(conn, query: Dict[str, Any], max_bytes: int = CHUNK_BYTES) -> Tuple[str, int, Optional[str]]:
+    '''Текст части, число строк в ней и курсор следующей части (None - выгрузка закончена)'''
+    parts: List[str] = []
+    size, rows, last = 0, 0, None
+    lines = iter_export(conn, query)
+    try:
+        for key, line in lines:
+            line_bytes = len(line.encode('utf-8'))
+            if rows and size + line_bytes > max_bytes:
+                return ''.join(parts), rows, encode_after(*last, query['date_to'])
+            parts.append(line)
+            size += line_bytes
+            if key is not None:
+                rows, last = rows + 1, key
+    finally:
+        lines.close()
+    return ''.join(parts), rows, None
@@ -0,0 +1,38 @@
+'''
+Business: HyperLogLog по посетителям (ip, user_agent) - приблизительное число уникальных посетителей без COUNT(DISTINCT)
+Args: HLL_PRECISION - число бит хэша на номер регистра (2^p регистров, ошибка около 1.04 / sqrt(2^p))
+Returns: SQL-выражения регистра и ранга для кликов, estimate_distinct() - оценка по слитым регистрам
+'''
+import math
+from typing import Dict, Optional
+
+# Меняется только вместе с пересчётом stats_hourly_visitors
+HLL_PRECISION = 10
+HLL_REGISTERS = 1 << HLL_PRECISION
+
+# 64-битный хэш посетителя: младшие p бит - номер регистра, в старших ищется первая единица
+VISITOR_HASH_SQL = "hashtextextended(COALESCE(ip_address, '') || '|' || COALESCE(user_agent, ''), 0)"
+REGISTER_SQL = f'(({{hash}}) & {HLL_REGISTERS - 1})::smallint'
+RHO_SQL = (f"COALESCE(NULLIF(position(B'1' IN substring(({{hash}})::bit(64) FROM 1 FOR {64 - HLL_PRECISION})), 0), "
+           f"{64 - HLL_PRECISION + 1})::smallint")
+
+
+def register_sql(hash_sql: str = VISITOR_HASH_SQL) -> str:
+    return REGISTER_SQL.format(hash=hash_sql)
+
+
+def rho_sql(hash_sql: str = VISITOR_HASH_SQL) -> str:
+    return RHO_SQL.format(hash=hash_sql)
+
+
+def estimate_distinct(registers: Optional[Dict[str, int]]) -> int:
+    '''registers - {номер регистра: максимальный ранг}, отсутствующие регистры равны нулю'''
+    registers = registers or {}
+    m = HLL_REGISTERS
+    alpha = 0.7213 / (1 + 1.079 / m)
+    zeros = m - len(registers)
+    estimate = alpha * m * m / (zeros + sum(2.0 ** -rho for rho in registers.values()))
+    # Поправка для малых множеств: пока есть пустые регистры, точнее линейный подсчёт
+    if estimate <= 2.5 * m and zeros:
+        estimate = m * math.log(m / zeros)
+    return round(estimate)
@@ -1,241 +1,98 @@
 '''
 Business: Статистика по офферам, кликам и конверсиям
-Args: event - dict с httpMethod, queryStringParameters (user_id, role, period)
+Args: event - dict с httpMethod, queryStringParameters (user_id, role, period, action;
+      для action=export - заголовок X-Auth-Token и kind, format, offer_id, webmaster_id, date_from, date_to, after;
+      action=series - дневной ряд за period дней)
       context - object с request_id
 Returns: HTTP response со статистикой
 '''
-import json
 import os
 from typing import Dict, Any
-from datetime import datetime, timedelta
-import psycopg2
 from psycopg2.extras import RealDictCursor
+from db import get_connection
+from responses import http_handler, json_response, error_response, dumps
+from planner import CountingCursor, run_stats_plan, run_series_plan
+from ledger import read_balance
+from response_cache import ResponseCache
+from export import EXPORT_FORMATS, parse_export_params, export_chunk
+from daily import parse_series_days
+from auth_token import request_token, token_user
 
-def get_db_connection():
-    return psycopg2.connect(os.environ['DATABASE_URL'])
+# Дашборды опрашивают одну и ту же статистику; короткий TTL вместо инвалидации по каждому клику
+stats_cache = ResponseCache(
+    max_size=int(os.environ.get('STATS_CACHE_SIZE', '1000')),
+    ttl=float(os.environ.get('STATS_CACHE_TTL', '15')),
+)
 
+@http_handler(methods=('GET',), allow_headers='Content-Type, X-Auth-Token, If-None-Match')
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
-    method: str = event.get('httpMethod', 'GET')
+    params = event.get('queryStringParameters', {}) or {}
+    user_id = params.get('user_id')
+    role = params.get('role', 'webmaster')
     
-    if method == 'OPTIONS':
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'GET, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, X-Auth-Token',
-                'Access-Control-Max-Age': '86400'
-            },
-            'body': ''
+    if params.get('action') == 'export':
+        # Выгрузка отдаёт сырые IP и User-Agent: пользователь и роль берутся из сессии, а не из запроса
+        with get_connection() as conn:
+            with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+                user = token_user(cursor, request_token(event))
+            if not user:
+                return error_response(401, 'Требуется авторизация: заголовок X-Auth-Token')
+            try:
+                query = parse_export_params(params, user['id'], user['role'])
+            except ValueError as e:
+                return error_response(400, str(e))
+            body, rows, next_after = export_chunk(conn, query)
+        
+        # Выгрузка больше лимита ответа отдаётся частями: следующая часть - тот же запрос с after
+        headers = {
+            'Content-Type': EXPORT_FORMATS[query['format']],
+            'Content-Disposition': f"attachment; filename=\"{query['kind']}.{query['format']}\"",
+            'Access-Control-Allow-Origin': '*',
+            'Access-Control-Expose-Headers': 'X-Next-After, X-Export-Rows',
+            'X-Export-Rows': str(rows)
         }
+        if next_after:
+            headers['X-Next-After'] = next_after
+        return {'statusCode': 200, 'headers': headers, 'body': body}
     
-    if method != 'GET':
-        return {
-            'statusCode': 405,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Метод не поддерживается'})
-        }
+    if not user_id:
+        return error_response(400, 'user_id обязателен')
     
-    try:
-        params = event.get('queryStringParameters', {}) or {}
-        user_id = params.get('user_id')
-        role = params.get('role', 'webmaster')
+    if params.get('action') == 'series':
+        try:
+            period_days = parse_series_days(params)
+        except ValueError as e:
+            return error_response(400, str(e))
+    else:
         period_days = int(params.get('period', '30'))
+    
+    # Баланс и debug-запросы всегда читаются из БД
+    use_cache = params.get('action') != 'balance' and params.get('debug') != '1'
+    cache_key = ResponseCache.key({'user_id': user_id, 'role': role, 'period': period_days,
+                                   'action': params.get('action')})
+    if use_cache:
+        cached = stats_cache.get(cache_key)
+        if cached:
+            return stats_cache.respond(cached, event)
+    
+    with get_connection() as conn, conn.cursor(cursor_factory=CountingCursor) as cursor:
         
-        if not user_id:
-            return {
-                'statusCode': 400,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'error': 'user_id обязателен'})
-            }
-        
-        conn = get_db_connection()
-        cursor = conn.cursor(cursor_factory=RealDictCursor)
-        
-        start_date = datetime.utcnow() - timedelta(days=period_days)
-        
-        stats = {}
-        
-        if role == 'webmaster':
-            cursor.execute(
-                """
-                SELECT COUNT(*) as total_clicks
-                FROM clicks
-                WHERE webmaster_id = %s AND clicked_at >= %s
-                """,
-                (user_id, start_date)
-            )
-            stats['total_clicks'] = cursor.fetchone()['total_clicks']
-            
-            cursor.execute(
-                """
-                SELECT COUNT(*) as total_conversions, 
-                       COALESCE(SUM(payout), 0) as total_earnings
-                FROM conversions
-                WHERE webmaster_id = %s AND status = 'approved' AND converted_at >= %s
-                """,
-                (user_id, start_date)
-            )
-            conv_data = cursor.fetchone()
-            stats['total_conversions'] = conv_data['total_conversions']
-            stats['total_earnings'] = float(conv_data['total_earnings'])
-            
-            cursor.execute(
-                """
-                SELECT COUNT(DISTINCT offer_id) as active_offers
-                FROM clicks
-                WHERE webmaster_id = %s AND clicked_at >= %s
-                """,
-                (user_id, start_date)
-            )
-            stats['active_offers'] = cursor.fetchone()['active_offers']
+        if params.get('action') == 'balance':
+            balance = read_balance(cursor, user_id)
             
-            cursor.execute(
-                """
-                SELECT DATE(converted_at) as date, COUNT(*) as conversions
-                FROM conversions
-                WHERE webmaster_id = %s AND status = 'approved' AND converted_at >= %s
-                GROUP BY DATE(converted_at)
-                ORDER BY date
-                """,
-                (user_id, start_date)
-            )
-            stats['daily_conversions'] = [dict(row) for row in cursor.fetchall()]
+            if not balance:
+                return error_response(404, 'Пользователь не найден')
             
-            cursor.execute(
-                """
-                SELECT o.id, o.name, o.payout,
-                       COUNT(cl.id) as clicks,
-                       COUNT(cv.id) as conversions,
-                       COALESCE(SUM(cv.payout), 0) as earnings
-                FROM offers o
-                LEFT JOIN clicks cl ON o.id = cl.offer_id AND cl.webmaster_id = %s
-                LEFT JOIN conversions cv ON o.id = cv.offer_id AND cv.webmaster_id = %s AND cv.status = 'approved'
-                WHERE o.status = 'active'
-                GROUP BY o.id, o.name, o.payout
-                HAVING COUNT(cl.id) > 0
-                ORDER BY conversions DESC
-                LIMIT 10
-                """,
-                (user_id, user_id)
-            )
-            stats['top_offers'] = [dict(row) for row in cursor.fetchall()]
+            return json_response(balance)
         
-        elif role == 'advertiser':
-            cursor.execute(
-                """
-                SELECT COUNT(DISTINCT c.id) as total_clicks
-                FROM clicks c
-                JOIN offers o ON c.offer_id = o.id
-                WHERE o.advertiser_id = %s AND c.clicked_at >= %s
-                """,
-                (user_id, start_date)
-            )
-            stats['total_clicks'] = cursor.fetchone()['total_clicks']
-            
-            cursor.execute(
-                """
-                SELECT COUNT(*) as total_conversions,
-                       COALESCE(SUM(cv.payout + cv.commission), 0) as total_spent
-                FROM conversions cv
-                JOIN offers o ON cv.offer_id = o.id
-                WHERE o.advertiser_id = %s AND cv.status = 'approved' AND cv.converted_at >= %s
-                """,
-                (user_id, start_date)
-            )
-            conv_data = cursor.fetchone()
-            stats['total_conversions'] = conv_data['total_conversions']
-            stats['total_spent'] = float(conv_data['total_spent'])
-            
-            cursor.execute(
-                """
-                SELECT COUNT(*) as active_offers
-                FROM offers
-                WHERE advertiser_id = %s AND status = 'active'
-                """,
-                (user_id,)
-            )
-            stats['active_offers'] = cursor.fetchone()['active_offers']
-            
-            cursor.execute(
-                """
-                SELECT o.id, o.name, o.payout as offer_payout, o.status,
-                       (SELECT COUNT(*) FROM clicks WHERE offer_id = o.id) as clicks,
-                       (SELECT COUNT(*) FROM conversions WHERE offer_id = o.id AND status = 'approved') as conversions,
-                       (SELECT COALESCE(SUM(payout + commission), 0) FROM conversions WHERE offer_id = o.id AND status = 'approved') as spent
-                FROM offers o
-                WHERE o.advertiser_id = %s
-                ORDER BY o.created_at DESC
-                """,
-                (user_id,)
-            )
-            stats['offers'] = [dict(row) for row in cursor.fetchall()]
+        if params.get('action') == 'series':
+            stats = run_series_plan(cursor, role, user_id, period_days)
+        else:
+            stats = run_stats_plan(cursor, role, user_id, period_days)
         
-        elif role == 'admin':
-            cursor.execute("SELECT COUNT(*) as total_clicks FROM clicks WHERE clicked_at >= %s", (start_date,))
-            stats['total_clicks'] = cursor.fetchone()['total_clicks']
-            
-            cursor.execute(
-                """
-                SELECT COUNT(*) as total_conversions,
-                       COALESCE(SUM(commission), 0) as total_commission
-                FROM conversions
-                WHERE status = 'approved' AND converted_at >= %s
-                """,
-                (start_date,)
-            )
-            conv_data = cursor.fetchone()
-            stats['total_conversions'] = conv_data['total_conversions']
-            stats['total_commission'] = float(conv_data['total_commission'])
-            
-            cursor.execute("SELECT COUNT(*) as active_offers FROM offers WHERE status = 'active'")
-            stats['active_offers'] = cursor.fetchone()['active_offers']
-            
-            cursor.execute(
-                """
-                SELECT u.id, u.email,
-                       COUNT(cv.id) as conversions,
-                       COALESCE(SUM(cv.payout), 0) as earnings
-                FROM users u
-                JOIN conversions cv ON u.id = cv.webmaster_id
-                WHERE u.role = 'webmaster' AND cv.status = 'approved' AND cv.converted_at >= %s
-                GROUP BY u.id, u.email
-                ORDER BY conversions DESC
-                LIMIT 10
-                """,
-                (start_date,)
-            )
-            stats['top_webmasters'] = [dict(row) for row in cursor.fetchall()]
-            
-            cursor.execute(
-                """
-                SELECT o.id, o.name, o.payout,
-                       COUNT(DISTINCT cl.id) as clicks,
-                       COUNT(DISTINCT cv.id) as conversions,
-                       COALESCE(SUM(cv.commission), 0) as commission
-                FROM offers o
-                LEFT JOIN clicks cl ON o.id = cl.offer_id
-                LEFT JOIN conversions cv ON o.id = cv.offer_id AND cv.status = 'approved'
-                WHERE o.status = 'active'
-                GROUP BY o.id, o.name, o.payout
-                ORDER BY conversions DESC
-                LIMIT 10
-                """,
-            )
-            stats['top_offers'] = [dict(row) for row in cursor.fetchall()]
+        if use_cache:
+            return stats_cache.respond(stats_cache.put(cache_key, dumps(stats)), event)
         
-        cursor.close()
-        conn.close()
+        stats['_debug'] = {'round_trips': cursor.round_trips}
         
-        return {
-            'statusCode': 200,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps(stats, default=str)
-        }
-    
-    except Exception as e:
-        return {
-            'statusCode': 500,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': f'Ошибка сервера: {str(e)}'})
-        }
\ No newline at end of file
+        return json_response(stats)
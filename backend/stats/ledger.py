@@ -0,0 +1,87 @@
+'''
+Business: Свёртка журнала начислений balance_ledger в users.balance и чтение баланса с учётом несвёрнутых строк
+Args: LEDGER_COMPACT_BATCH из окружения
+Returns: compact_ledger() - сколько строк свёрнуто, read_balance() - баланс, дельта и итог
+'''
+import os
+from typing import Dict, Any, Optional
+
+LEDGER_LOCK_ID = 7340002
+COMPACT_BATCH = int(os.environ.get('LEDGER_COMPACT_BATCH', '10000'))
+
+# Пачка непримененных строк помечается applied_at и одной операцией прибавляется к балансам.
+# Незакоммиченные строки конкурентных конверсий не видны и попадут в следующую свёртку.
+COMPACT_SQL = '''
+    WITH batch AS (
+        SELECT id FROM balance_ledger
+        WHERE applied_at IS NULL AND (%(user_id)s::int IS NULL OR user_id = %(user_id)s::int)
+        ORDER BY id
+        LIMIT %(limit)s
+        FOR UPDATE SKIP LOCKED
+    ),
+    folded AS (
+        UPDATE balance_ledger l SET applied_at = LOCALTIMESTAMP
+        FROM batch WHERE l.id = batch.id
+        RETURNING l.user_id, l.amount
+    ),
+    credited AS (
+        UPDATE users u SET balance = u.balance + d.delta
+        FROM (SELECT user_id, SUM(amount) AS delta FROM folded GROUP BY user_id) d
+        WHERE u.id = d.user_id
+        RETURNING u.id
+    )
+    SELECT (SELECT COUNT(*) FROM folded) AS folded, (SELECT COUNT(*) FROM credited) AS users
+'''
+
+BALANCE_SQL = '''
+    SELECT u.id AS user_id,
+           COALESCE(u.balance, 0) AS balance,
+           COALESCE((SELECT SUM(amount) FROM balance_ledger
+                     WHERE user_id = u.id AND applied_at IS NULL), 0) AS pending
+    FROM users u
+    WHERE u.id = %s
+'''
+
+
+def compact_ledger(cursor, user_id: Optional[int] = None, limit: int = COMPACT_BATCH) -> int:
+    '''Сворачивает до limit строк; свёртки не пересекаются благодаря advisory-lock'''
+    conn = cursor.connection
+    cursor.execute("SELECT pg_try_advisory_xact_lock(%s) AS locked", (LEDGER_LOCK_ID,))
+    if not cursor.fetchone()['locked']:
+        conn.rollback()
+        return 0
+    cursor.execute(COMPACT_SQL, {'user_id': user_id, 'limit': limit})
+    folded = cursor.fetchone()['folded']
+    conn.commit()
+    return folded
+
+
+def catch_up_ledger(cursor) -> int:
+    total = 0
+    while True:
+        folded = compact_ledger(cursor)
+        total += folded
+        if folded < COMPACT_BATCH:
+            return total
+
+
+def read_balance(cursor, user_id: str) -> Optional[Dict[str, Any]]:
+    '''Свёрнутый баланс плюс сумма ещё не свёрнутых начислений'''
+    cursor.execute(BALANCE_SQL, (user_id,))
+    row = cursor.fetchone()
+    if not row:
+        return None
+    balance, pending = row['balance'], row['pending']
+    return {
+        'user_id': row['user_id'],
+        'balance': float(balance),
+        'pending': float(pending),
+        'total': float(balance + pending),
+    }
+
+
+if __name__ == '__main__':
+    from psycopg2.extras import RealDictCursor
+    from db import get_connection
+    with get_connection() as conn, conn.cursor(cursor_factory=RealDictCursor) as cursor:
+        print(f'balance_ledger: folded {catch_up_ledger(cursor)} rows')
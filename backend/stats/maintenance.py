@@ -0,0 +1,65 @@
+'''
+Business: Обслуживание статистики вне HTTP-запроса - догон часовых агрегатов, секции clicks/conversions
+          и свёртка журнала балансов. Основной путь - запуск по расписанию (cron): python backend/stats/maintenance.py
+Args: STATS_BACKGROUND_REFRESH (1|0), STATS_REFRESH_INTERVAL из окружения
+Returns: run_maintenance() - итог обслуживания, schedule_refresh() - фоновый догон после запроса статистики
+'''
+import os
+import time
+import logging
+import threading
+from typing import Dict, Any
+from psycopg2.extras import RealDictCursor
+from db import get_connection
+from rollup import catch_up_rollups
+from partitions import maintain_partitions
+from ledger import catch_up_ledger
+
+logger = logging.getLogger(__name__)
+
+# Запасной путь, если cron не настроен: запрос с устаревшими агрегатами будит фоновый поток,
+# но ответа он не задерживает, и не чаще раза в STATS_REFRESH_INTERVAL секунд на контейнер
+BACKGROUND_REFRESH = os.environ.get('STATS_BACKGROUND_REFRESH', '1') == '1'
+REFRESH_INTERVAL = float(os.environ.get('STATS_REFRESH_INTERVAL', '60'))
+
+_refresh_lock = threading.Lock()
+_last_refresh = 0.0
+
+
+def run_maintenance(cursor) -> Dict[str, Any]:
+    '''Догоняет агрегаты, готовит секции и сворачивает журнал; каждый шаг коммитит сам'''
+    rolled_until = catch_up_rollups(cursor)
+    partitions = maintain_partitions(cursor)
+    folded = catch_up_ledger(cursor)
+    return {'rolled_until': rolled_until.isoformat(), 'partitions': partitions, 'ledger_folded': folded}
+
+
+def _refresh() -> None:
+    try:
+        with get_connection() as conn, conn.cursor(cursor_factory=RealDictCursor) as cursor:
+            run_maintenance(cursor)
+    except Exception:
+        logger.exception('Фоновое обслуживание статистики не удалось')
+    finally:
+        _refresh_lock.release()
+
+
+def schedule_refresh() -> bool:
+    '''Запускает обслуживание в фоновом потоке, если оно ещё не идёт; True, если поток запущен'''
+    global _last_refresh
+    if not BACKGROUND_REFRESH or time.monotonic() - _last_refresh < REFRESH_INTERVAL:
+        return False
+    if not _refresh_lock.acquire(blocking=False):
+        return False
+    _last_refresh = time.monotonic()
+    try:
+        threading.Thread(target=_refresh, name='stats-maintenance', daemon=True).start()
+    except RuntimeError:
+        _refresh_lock.release()
+        return False
+    return True
+
+
+if __name__ == '__main__':
+    with get_connection() as conn, conn.cursor(cursor_factory=RealDictCursor) as cursor:
+        print(run_maintenance(cursor))
@@ -0,0 +1,57 @@
+'''
+Business: Метрики по офферам без размножения строк clicks x conversions
+Args: имя CTE с фактами (см. rollup.facts_cte), список колонок и условия роли
+Returns: offer_metrics_cte() и offer_list_json() - фрагменты SQL для планировщика статистики
+'''
+from typing import List, Optional
+
+# Денежные значения отдаются строкой, как раньше отдавался Decimal через json.dumps(default=str)
+COLUMNS = {
+    'id': 'o.id',
+    'name': 'o.name',
+    'payout': 'o.payout::text',
+    'offer_payout': 'o.payout::text',
+    'status': 'o.status',
+    'clicks': 'COALESCE(m.clicks, 0)',
+    'conversions': 'COALESCE(m.conversions, 0)',
+    'earnings': 'COALESCE(m.payout, 0)::text',
+    'commission': 'COALESCE(m.commission, 0)::text',
+    'spent': 'COALESCE(m.payout + m.commission, 0)::text',
+    'created_at': 'o.created_at',
+}
+
+
+def offer_metrics_cte(facts: str) -> str:
+    '''
+    Клики и конверсии агрегируются по offer_id раздельно (каждая строка facts - либо клики,
+    либо конверсии), и только потом присоединяются к offers - без декартова произведения.
+    '''
+    return f'''
+    offer_metrics AS (
+        SELECT offer_id,
+               SUM(clicks) AS clicks,
+               SUM(conversions) AS conversions,
+               SUM(payout) AS payout,
+               SUM(commission) AS commission
+        FROM {facts}
+        GROUP BY offer_id
+    )
+    '''
+
+
+def offer_list_json(columns: List[str], where: str, order_by: str, limit: Optional[int] = None) -> str:
+    '''Скалярный подзапрос: JSON-массив офферов с нужными колонками в порядке order_by'''
+    selected = list(columns) + [name for name in ('created_at',) if name not in columns]
+    select = ',\n               '.join(f'{COLUMNS[name]} AS {name}' for name in selected)
+    fields = ', '.join(f"'{name}', x.{name}" for name in columns)
+    return f'''
+    (SELECT COALESCE(json_agg(json_build_object({fields}) ORDER BY {order_by}), '[]'::json)
+     FROM (
+        SELECT {select}
+        FROM offers o
+        LEFT JOIN offer_metrics m ON m.offer_id = o.id
+        WHERE {where}
+        ORDER BY {order_by}
+        {f'LIMIT {int(limit)}' if limit else ''}
+     ) x)
+    '''
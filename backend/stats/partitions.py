@@ -0,0 +1,39 @@
+'''
+Business: Обслуживание помесячных секций clicks и conversions - создание будущих и отсоединение старых
+Args: PARTITION_MONTHS_AHEAD, PARTITION_RETENTION_MONTHS, PARTITION_RETENTION_ACTION из окружения
+Returns: maintain_partitions() - сколько секций создано и какие отсоединены
+'''
+import os
+from typing import Dict, Any
+
+PARTITIONED_TABLES = (('clicks', 'clicked_at'), ('conversions', 'converted_at'))
+MONTHS_AHEAD = int(os.environ.get('PARTITION_MONTHS_AHEAD', '3'))
+# 0 - хранить всю историю; иначе секции старше N полных месяцев отсоединяются
+RETENTION_MONTHS = int(os.environ.get('PARTITION_RETENTION_MONTHS', '0'))
+DROP_EXPIRED = os.environ.get('PARTITION_RETENTION_ACTION', 'detach') == 'drop'
+
+
+def maintain_partitions(cursor) -> Dict[str, Any]:
+    created = 0
+    detached = []
+    for table, key_column in PARTITIONED_TABLES:
+        cursor.execute(
+            "SELECT ensure_monthly_partitions(%s, %s, LOCALTIMESTAMP::date, %s) AS created",
+            (table, key_column, MONTHS_AHEAD)
+        )
+        created += cursor.fetchone()['created']
+        if RETENTION_MONTHS > 0:
+            cursor.execute(
+                "SELECT detach_expired_partitions(%s, %s, %s) AS name",
+                (table, RETENTION_MONTHS, DROP_EXPIRED)
+            )
+            detached.extend(row['name'] for row in cursor.fetchall())
+    cursor.connection.commit()
+    return {'created': created, 'detached': detached}
+
+
+if __name__ == '__main__':
+    from psycopg2.extras import RealDictCursor
+    from db import get_connection
+    with get_connection() as conn, conn.cursor(cursor_factory=RealDictCursor) as cursor:
+        print(maintain_partitions(cursor))
@@ -0,0 +1,157 @@
+'''
+Business: Один запрос статистики на роль вместо 4-6 последовательных round trip
+Args: cursor (RealDictCursor), role, user_id, период в днях
+Returns: run_stats_plan() - словарь статистики в прежнем JSON-формате, run_series_plan() - дневной ряд для графиков
+'''
+from datetime import datetime, timedelta
+from typing import Dict, Any
+from psycopg2.extras import RealDictCursor
+from rollup import ROLLUP_STALE_SQL, period_params, bounds_cte, facts_cte, lifetime_facts_cte, visitors_cte
+from daily import series_params, daily_series_cte, series_json
+from offer_metrics import offer_metrics_cte, offer_list_json
+from maintenance import schedule_refresh
+from hll import estimate_distinct
+
+# Офферы рекламодателя - массивом: каждая таблица читается индексом по (offer_id, время) на оффер,
+# тогда как с IN (SELECT ...) хвост после отметки планировщик читал последовательным сканом
+ROLE_SCOPES = {
+    'webmaster': 'webmaster_id = %(user_id)s',
+    'advertiser': 'offer_id = ANY(ARRAY(SELECT id FROM offers WHERE advertiser_id = %(user_id)s))',
+    'admin': 'TRUE',
+}
+
+
+class CountingCursor(RealDictCursor):
+    '''Считает запросы к БД, чтобы показать число round trip в debug-выводе'''
+
+    round_trips = 0
+
+    def execute(self, query, vars=None):
+        self.round_trips += 1
+        return super().execute(query, vars)
+
+
+def _ctes(scope: str) -> str:
+    # facts - выбранный период, lifetime_facts - вся история для списков офферов (по дневным агрегатам),
+    # series - дни периода для графика
+    return ','.join([
+        bounds_cte('bounds', 'period'),
+        facts_cte('facts', 'bounds', scope),
+        lifetime_facts_cte('lifetime_facts', scope),
+        visitors_cte('visitors', 'bounds', scope),
+        daily_series_cte('series', scope),
+        offer_metrics_cte('lifetime_facts'),
+    ])
+
+
+# Каждый день периода, включая дни без конверсий
+DAILY_CONVERSIONS_JSON = '''
+    (SELECT COALESCE(json_agg(json_build_object('date', day, 'conversions', conversions) ORDER BY day), '[]'::json)
+     FROM series)
+'''
+
+TOP_WEBMASTERS_JSON = '''
+    (SELECT COALESCE(json_agg(json_build_object('id', w.id, 'email', w.email, 'conversions', w.conversions,
+                                                'earnings', w.earnings::text)
+                              ORDER BY w.conversions DESC, w.id), '[]'::json)
+     FROM (
+        SELECT u.id, u.email, SUM(f.conversions) AS conversions, SUM(f.payout) AS earnings
+        FROM facts f
+        JOIN users u ON u.id = f.webmaster_id
+        WHERE u.role = 'webmaster' AND f.conversions > 0
+        GROUP BY u.id, u.email
+        ORDER BY conversions DESC, u.id
+        LIMIT 10
+     ) w)
+'''
+
+# Регистры HyperLogLog посетителей за период; оценку по ним считает Python (hll.estimate_distinct)
+VISITOR_REGISTERS_JSON = '(SELECT json_object_agg(register, rho) FROM visitors)'
+
+ROLE_PLANS = {
+    'webmaster': f'''
+        WITH {_ctes(ROLE_SCOPES['webmaster'])}
+        SELECT COALESCE(SUM(clicks), 0) AS total_clicks,
+               COALESCE(SUM(unique_clicks), 0) AS unique_clicks,
+               {VISITOR_REGISTERS_JSON} AS visitor_registers,
+               COALESCE(SUM(conversions), 0) AS total_conversions,
+               COALESCE(SUM(payout), 0) AS total_earnings,
+               COUNT(DISTINCT offer_id) FILTER (WHERE clicks > 0) AS active_offers,
+               {DAILY_CONVERSIONS_JSON} AS daily_conversions,
+               {offer_list_json(['id', 'name', 'payout', 'clicks', 'conversions', 'earnings'],
+                                where="o.status = 'active' AND m.clicks > 0",
+                                order_by='conversions DESC, id', limit=10)} AS top_offers,
+               {ROLLUP_STALE_SQL} AS rollup_stale
+        FROM facts
+    ''',
+    'advertiser': f'''
+        WITH {_ctes(ROLE_SCOPES['advertiser'])}
+        SELECT COALESCE(SUM(clicks), 0) AS total_clicks,
+               COALESCE(SUM(unique_clicks), 0) AS unique_clicks,
+               {VISITOR_REGISTERS_JSON} AS visitor_registers,
+               COALESCE(SUM(conversions), 0) AS total_conversions,
+               COALESCE(SUM(payout + commission), 0) AS total_spent,
+               (SELECT COUNT(*) FROM offers WHERE advertiser_id = %(user_id)s AND status = 'active') AS active_offers,
+               {offer_list_json(['id', 'name', 'offer_payout', 'status', 'clicks', 'conversions', 'spent'],
+                                where='o.advertiser_id = %(user_id)s',
+                                order_by='created_at DESC')} AS offers,
+               {ROLLUP_STALE_SQL} AS rollup_stale
+        FROM facts
+    ''',
+    'admin': f'''
+        WITH {_ctes(ROLE_SCOPES['admin'])}
+        SELECT COALESCE(SUM(clicks), 0) AS total_clicks,
+               COALESCE(SUM(unique_clicks), 0) AS unique_clicks,
+               {VISITOR_REGISTERS_JSON} AS visitor_registers,
+               COALESCE(SUM(conversions), 0) AS total_conversions,
+               COALESCE(SUM(commission), 0) AS total_commission,
+               (SELECT COUNT(*) FROM offers WHERE status = 'active') AS active_offers,
+               {TOP_WEBMASTERS_JSON} AS top_webmasters,
+               {offer_list_json(['id', 'name', 'payout', 'clicks', 'conversions', 'commission'],
+                                where="o.status = 'active'",
+                                order_by='conversions DESC, id', limit=10)} AS top_offers,
+               {ROLLUP_STALE_SQL} AS rollup_stale
+        FROM facts
+    ''',
+}
+
+# Дневной ряд отдельным запросом: один диапазон по stats_daily и хвост после отметки
+SERIES_PLANS = {
+    role: f'''
+        WITH {daily_series_cte('series', scope)}
+        SELECT {series_json('series', role)} AS days
+    '''
+    for role, scope in ROLE_SCOPES.items()
+}
+
+MONEY_FIELDS = ('total_earnings', 'total_spent', 'total_commission')
+
+
+def run_stats_plan(cursor, role: str, user_id: str, period_days: int) -> Dict[str, Any]:
+    plan = ROLE_PLANS.get(role)
+    if plan is None:
+        return {}
+    now = datetime.utcnow()
+    params = dict(period_params('period', now - timedelta(days=period_days)),
+                  **series_params(max(1, period_days), now.date()), user_id=user_id)
+    cursor.execute(plan, params)
+    stats = dict(cursor.fetchone())
+    stats['unique_visitors'] = estimate_distinct(stats.pop('visitor_registers'))
+    if stats.pop('rollup_stale'):
+        # Ответ уже посчитан по сырым строкам после отметки; агрегаты, секции и журнал балансов
+        # обслуживает cron (maintenance.py), здесь - только фоновый догон, не задерживающий ответ
+        schedule_refresh()
+    for field in MONEY_FIELDS:
+        if field in stats:
+            stats[field] = float(stats[field])
+    return stats
+
+
+def run_series_plan(cursor, role: str, user_id: str, days: int) -> Dict[str, Any]:
+    plan = SERIES_PLANS.get(role)
+    if plan is None:
+        return {}
+    params = dict(series_params(days, datetime.utcnow().date()), user_id=user_id)
+    cursor.execute(plan, params)
+    return {'from': params['series_from'].isoformat(), 'to': params['series_to'].isoformat(),
+            'days': cursor.fetchone()['days']}
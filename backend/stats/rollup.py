@@ -0,0 +1,278 @@
+'''
+Business: Инкрементальные почасовые агрегаты кликов и конверсий для статистики
+Args: STATS_ROLLUP_GRACE_MINUTES, STATS_ROLLUP_MAX_HOURS из окружения
+Returns: sync_rollups() - догоняет почасовые и дневные агрегаты по отметке,
+         bounds_cte()/facts_cte()/lifetime_facts_cte()/visitors_cte() - источник фактов для запросов
+'''
+import os
+from datetime import datetime, timedelta
+from typing import Dict, Any
+from hll import VISITOR_HASH_SQL, register_sql, rho_sql
+
+ROLLUP_NAME = 'stats_hourly'
+ROLLUP_LOCK_ID = 7340001
+GRACE_MINUTES = int(os.environ.get('STATS_ROLLUP_GRACE_MINUTES', '5'))
+MAX_HOURS_PER_RUN = int(os.environ.get('STATS_ROLLUP_MAX_HOURS', '168'))
+
+EPOCH = datetime(1970, 1, 1)
+
+# Счётчики offer_counters меняются в тех же операторах, что и агрегаты окна: вычитается то,
+# что удалено, и прибавляется то, что вставлено, поэтому пересчёт окна (rebuild) не задваивает их
+OFFER_COUNTERS_UPSERT = '''
+    INSERT INTO offer_counters (offer_id, clicks, conversions)
+    SELECT offer_id, {sign} SUM(clicks), {sign} SUM(conversions_all) FROM {source} GROUP BY offer_id
+    ON CONFLICT (offer_id) DO UPDATE SET clicks = offer_counters.clicks + EXCLUDED.clicks,
+                                         conversions = offer_counters.conversions + EXCLUDED.conversions
+'''
+
+# Дневные агрегаты меняются теми же дельтами: окно пересчёта - целые часы, день может попасть в него частично
+STATS_DAILY_UPSERT = '''
+    INSERT INTO stats_daily (day, offer_id, webmaster_id, clicks, unique_clicks, conversions, payout, commission)
+    SELECT hour::date, offer_id, webmaster_id, {sign} SUM(clicks), {sign} SUM(unique_clicks), {sign} SUM(conversions),
+           {sign} SUM(payout), {sign} SUM(commission)
+    FROM {source}
+    GROUP BY 1, 2, 3
+    ON CONFLICT (day, offer_id, webmaster_id) DO UPDATE SET clicks = stats_daily.clicks + EXCLUDED.clicks,
+        unique_clicks = stats_daily.unique_clicks + EXCLUDED.unique_clicks,
+        conversions = stats_daily.conversions + EXCLUDED.conversions,
+        payout = stats_daily.payout + EXCLUDED.payout,
+        commission = stats_daily.commission + EXCLUDED.commission
+'''
+
+ROLLUP_RETURNING = 'hour, offer_id, webmaster_id, clicks, unique_clicks, conversions, payout, commission, conversions_all'
+
+ROLLUP_DELETE_SQL = f'''
+    WITH removed AS (
+        DELETE FROM stats_hourly WHERE hour >= %(from)s AND hour < %(to)s
+        RETURNING {ROLLUP_RETURNING}
+    ),
+    counters AS ({OFFER_COUNTERS_UPSERT.format(sign='-', source='removed')})
+''' + STATS_DAILY_UPSERT.format(sign='-', source='removed')
+
+# conversions/payout/commission - только approved, conversions_all - конверсии в любом статусе
+ROLLUP_INSERT_SQL = f'''
+    WITH added AS (
+        INSERT INTO stats_hourly (hour, offer_id, webmaster_id, clicks, conversions, payout, commission,
+                                  conversions_all, unique_clicks)
+        SELECT hour, offer_id, webmaster_id, SUM(clicks), SUM(conversions), SUM(payout), SUM(commission),
+               SUM(conversions_all), SUM(unique_clicks)
+        FROM (
+            SELECT date_trunc('hour', clicked_at) AS hour, offer_id, webmaster_id,
+                   COUNT(*) AS clicks, 0 AS conversions, 0 AS payout, 0 AS commission, 0 AS conversions_all,
+                   COUNT(*) FILTER (WHERE is_unique) AS unique_clicks
+            FROM clicks
+            WHERE clicked_at >= %(from)s AND clicked_at < %(to)s
+            GROUP BY 1, 2, 3
+            UNION ALL
+            SELECT date_trunc('hour', converted_at), offer_id, webmaster_id,
+                   0, COUNT(*) FILTER (WHERE status = 'approved'),
+                   COALESCE(SUM(payout) FILTER (WHERE status = 'approved'), 0),
+                   COALESCE(SUM(commission) FILTER (WHERE status = 'approved'), 0),
+                   COUNT(*), 0
+            FROM conversions
+            WHERE converted_at >= %(from)s AND converted_at < %(to)s
+            GROUP BY 1, 2, 3
+        ) t
+        GROUP BY hour, offer_id, webmaster_id
+        RETURNING {ROLLUP_RETURNING}
+    ),
+    counters AS ({OFFER_COUNTERS_UPSERT.format(sign='', source='added')})
+''' + STATS_DAILY_UPSERT.format(sign='', source='added')
+
+# Регистры HyperLogLog посетителей за те же часы, что и stats_hourly
+VISITORS_DELETE_SQL = 'DELETE FROM stats_hourly_visitors WHERE hour >= %(from)s AND hour < %(to)s'
+
+VISITORS_INSERT_SQL = f'''
+    INSERT INTO stats_hourly_visitors (hour, offer_id, webmaster_id, register, rho)
+    SELECT date_trunc('hour', clicked_at), offer_id, webmaster_id, {register_sql('h')}, MAX({rho_sql('h')})
+    FROM (
+        SELECT clicked_at, offer_id, webmaster_id, {VISITOR_HASH_SQL} AS h
+        FROM clicks
+        WHERE clicked_at >= %(from)s AND clicked_at < %(to)s
+    ) c
+    GROUP BY 1, 2, 3, 4
+'''
+
+# Выражение для основного запроса статистики: пора ли догонять агрегаты
+ROLLUP_STALE_SQL = f'''
+    (SELECT rolled_until < date_trunc('hour', LOCALTIMESTAMP - {GRACE_MINUTES} * interval '1 minute')
+     FROM rollup_watermarks WHERE name = '{ROLLUP_NAME}')
+'''
+
+
+def sync_rollups(cursor) -> datetime:
+    '''Досчитывает закрытые часы после отметки; вызов дешёвый, если агрегаты свежие'''
+    conn = cursor.connection
+    cursor.execute(
+        """
+        SELECT rolled_until, date_trunc('hour', LOCALTIMESTAMP - %s * interval '1 minute') AS target
+        FROM rollup_watermarks WHERE name = %s
+        """,
+        (GRACE_MINUTES, ROLLUP_NAME)
+    )
+    row = cursor.fetchone()
+    rolled_until, target = row['rolled_until'], row['target']
+    if rolled_until >= target:
+        return rolled_until
+
+    cursor.execute("SELECT pg_try_advisory_xact_lock(%s) AS locked", (ROLLUP_LOCK_ID,))
+    if not cursor.fetchone()['locked']:
+        conn.rollback()
+        return rolled_until
+
+    cursor.execute(
+        "SELECT rolled_until FROM rollup_watermarks WHERE name = %s FOR UPDATE",
+        (ROLLUP_NAME,)
+    )
+    rolled_until = cursor.fetchone()['rolled_until']
+    until = min(target, rolled_until + timedelta(hours=MAX_HOURS_PER_RUN))
+    if rolled_until >= until:
+        conn.rollback()
+        return rolled_until
+
+    bounds = {'from': rolled_until, 'to': until}
+    cursor.execute(ROLLUP_DELETE_SQL, bounds)
+    cursor.execute(ROLLUP_INSERT_SQL, bounds)
+    cursor.execute(VISITORS_DELETE_SQL, bounds)
+    cursor.execute(VISITORS_INSERT_SQL, bounds)
+    cursor.execute(
+        "UPDATE rollup_watermarks SET rolled_until = %s, updated_at = LOCALTIMESTAMP WHERE name = %s",
+        (until, ROLLUP_NAME)
+    )
+    conn.commit()
+    return until
+
+
+def catch_up_rollups(cursor) -> datetime:
+    previous, watermark = None, sync_rollups(cursor)
+    while watermark != previous:
+        previous, watermark = watermark, sync_rollups(cursor)
+    return watermark
+
+
+def rebuild_rollups(cursor, since: datetime) -> datetime:
+    '''Откатывает отметку назад, чтобы пересчитать часы с опоздавшими событиями'''
+    cursor.execute(
+        "UPDATE rollup_watermarks SET rolled_until = LEAST(rolled_until, date_trunc('hour', %s::timestamp)) WHERE name = %s",
+        (since, ROLLUP_NAME)
+    )
+    cursor.connection.commit()
+    return catch_up_rollups(cursor)
+
+
+def period_params(prefix: str, start: datetime) -> Dict[str, Any]:
+    '''Начало периода и первый полный час после него - параметры для bounds_cte'''
+    start_hour = start.replace(minute=0, second=0, microsecond=0)
+    if start_hour < start:
+        start_hour += timedelta(hours=1)
+    return {f'{prefix}_start': start, f'{prefix}_start_hour': start_hour}
+
+
+def bounds_cte(name: str, prefix: str) -> str:
+    '''
+    Границы периода: полные часы от start_hour до отметки берутся из агрегатов,
+    край [start, start_hour) и всё после отметки - из сырых таблиц.
+    '''
+    start, start_hour = f'%({prefix}_start)s::timestamp', f'%({prefix}_start_hour)s::timestamp'
+    return f'''
+    {name} AS (
+        SELECT {start} AS start,
+               CASE WHEN w.rolled_until > {start_hour} THEN {start_hour} ELSE {start} END AS rollup_from,
+               CASE WHEN w.rolled_until > {start_hour} THEN w.rolled_until ELSE {start} END AS rollup_to
+        FROM rollup_watermarks w
+        WHERE w.name = '{ROLLUP_NAME}'
+    )
+    '''
+
+
+def facts_cte(name: str, bounds: str, scope: str) -> str:
+    '''
+    CTE name(hour, offer_id, webmaster_id, clicks, conversions, payout, commission, unique_clicks)
+    за период bounds. scope - условие по offer_id/webmaster_id, одинаковое для всех трёх таблиц.
+    '''
+    start = f'(SELECT start FROM {bounds})'
+    rollup_from = f'(SELECT rollup_from FROM {bounds})'
+    rollup_to = f'(SELECT rollup_to FROM {bounds})'
+    return f'''
+    {name} AS (
+        SELECT hour, offer_id, webmaster_id, clicks, conversions, payout, commission, unique_clicks
+        FROM stats_hourly
+        WHERE hour >= {rollup_from} AND hour < {rollup_to} AND {scope}
+        UNION ALL
+        SELECT date_trunc('hour', clicked_at), offer_id, webmaster_id, 1, 0, 0, 0, is_unique::int
+        FROM clicks
+        WHERE clicked_at >= {start} AND clicked_at < {rollup_from} AND {scope}
+        UNION ALL
+        SELECT date_trunc('hour', clicked_at), offer_id, webmaster_id, 1, 0, 0, 0, is_unique::int
+        FROM clicks
+        WHERE clicked_at >= {rollup_to} AND {scope}
+        UNION ALL
+        SELECT date_trunc('hour', converted_at), offer_id, webmaster_id, 0, 1, payout, commission, 0
+        FROM conversions
+        WHERE status = 'approved' AND converted_at >= {start} AND converted_at < {rollup_from} AND {scope}
+        UNION ALL
+        SELECT date_trunc('hour', converted_at), offer_id, webmaster_id, 0, 1, payout, commission, 0
+        FROM conversions
+        WHERE status = 'approved' AND converted_at >= {rollup_to} AND {scope}
+    )
+    '''
+
+
+def lifetime_facts_cte(name: str, scope: str) -> str:
+    '''
+    CTE name(offer_id, webmaster_id, clicks, conversions, payout, commission, unique_clicks) за всю историю:
+    stats_daily покрывает ровно часы до отметки, после неё - сырые таблицы. Строк в 24 раза меньше,
+    чем в stats_hourly за тот же срок.
+    '''
+    rolled_until = f"(SELECT rolled_until FROM rollup_watermarks WHERE name = '{ROLLUP_NAME}')"
+    return f'''
+    {name} AS (
+        SELECT offer_id, webmaster_id, clicks, conversions, payout, commission, unique_clicks
+        FROM stats_daily
+        WHERE {scope}
+        UNION ALL
+        SELECT offer_id, webmaster_id, 1, 0, 0, 0, is_unique::int
+        FROM clicks
+        WHERE clicked_at >= {rolled_until} AND {scope}
+        UNION ALL
+        SELECT offer_id, webmaster_id, 0, 1, payout, commission, 0
+        FROM conversions
+        WHERE status = 'approved' AND converted_at >= {rolled_until} AND {scope}
+    )
+    '''
+
+
+def visitors_cte(name: str, bounds: str, scope: str) -> str:
+    '''
+    CTE name(register, rho): слитый HyperLogLog посетителей за период bounds - регистры из
+    stats_hourly_visitors для агрегированных часов и из сырых кликов на краях периода.
+    '''
+    start = f'(SELECT start FROM {bounds})'
+    rollup_from = f'(SELECT rollup_from FROM {bounds})'
+    rollup_to = f'(SELECT rollup_to FROM {bounds})'
+    return f'''
+    {name} AS (
+        SELECT register, MAX(rho) AS rho
+        FROM (
+            SELECT register, rho
+            FROM stats_hourly_visitors
+            WHERE hour >= {rollup_from} AND hour < {rollup_to} AND {scope}
+            UNION ALL
+            SELECT {register_sql()}, {rho_sql()}
+            FROM clicks
+            WHERE clicked_at >= {start} AND clicked_at < {rollup_from} AND {scope}
+            UNION ALL
+            SELECT {register_sql()}, {rho_sql()}
+            FROM clicks
+            WHERE clicked_at >= {rollup_to} AND {scope}
+        ) v
+        GROUP BY register
+    )
+    '''
+
+
+if __name__ == '__main__':
+    from psycopg2.extras import RealDictCursor
+    from db import get_connection
+    with get_connection() as conn, conn.cursor(cursor_factory=RealDictCursor) as cursor:
+        print(f'{ROLLUP_NAME} rolled until {catch_up_rollups(cursor)}')
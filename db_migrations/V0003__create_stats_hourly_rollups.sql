@@ -0,0 +1,28 @@
+-- Почасовые агрегаты по (оффер, вебмастер) для дашбордов статистики
+CREATE TABLE stats_hourly (
+    hour TIMESTAMP NOT NULL,
+    offer_id INTEGER NOT NULL REFERENCES offers(id),
+    webmaster_id INTEGER NOT NULL REFERENCES users(id),
+    clicks INTEGER NOT NULL DEFAULT 0,
+    conversions INTEGER NOT NULL DEFAULT 0,
+    payout DECIMAL(14, 2) NOT NULL DEFAULT 0,
+    commission DECIMAL(14, 2) NOT NULL DEFAULT 0,
+    PRIMARY KEY (hour, offer_id, webmaster_id)
+);
+
+-- conversions/payout/commission считаются только по конверсиям со статусом approved
+CREATE INDEX idx_stats_hourly_webmaster ON stats_hourly(webmaster_id, hour);
+CREATE INDEX idx_stats_hourly_offer ON stats_hourly(offer_id, hour);
+
+-- Отметка, до какого часа (не включительно) агрегаты уже посчитаны
+CREATE TABLE rollup_watermarks (
+    name VARCHAR(50) PRIMARY KEY,
+    rolled_until TIMESTAMP NOT NULL,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+INSERT INTO rollup_watermarks (name, rolled_until)
+SELECT 'stats_hourly', date_trunc('hour', COALESCE(
+    LEAST((SELECT MIN(clicked_at) FROM clicks), (SELECT MIN(converted_at) FROM conversions)),
+    LOCALTIMESTAMP
+));
@@ -0,0 +1,139 @@
+-- Помесячное секционирование clicks и conversions с BIGINT-ключами.
+-- Первичный ключ секционированной таблицы обязан включать ключ секционирования,
+-- поэтому conversions.click_id больше не ссылается на clicks(id) внешним ключом.
+
+-- Создаёт секции parent_YYYY_MM от месяца from_month до текущего месяца + months_ahead.
+-- Строки, уже попавшие в parent_default за этот месяц, переносятся в новую секцию.
+CREATE OR REPLACE FUNCTION ensure_monthly_partitions(parent TEXT, key_column TEXT, from_month DATE, months_ahead INTEGER)
+RETURNS INTEGER AS $$
+DECLARE
+    month_start DATE := date_trunc('month', from_month)::date;
+    last_month DATE := (date_trunc('month', LOCALTIMESTAMP) + make_interval(months => months_ahead))::date;
+    next_month DATE;
+    partition_name TEXT;
+    created INTEGER := 0;
+BEGIN
+    WHILE month_start <= last_month LOOP
+        next_month := (month_start + interval '1 month')::date;
+        partition_name := format('%s_%s', parent, to_char(month_start, 'YYYY_MM'));
+        IF to_regclass(partition_name) IS NULL THEN
+            EXECUTE format('CREATE TABLE %I (LIKE %I INCLUDING DEFAULTS INCLUDING CONSTRAINTS)', partition_name, parent);
+            EXECUTE format(
+                'WITH moved AS (DELETE FROM %I WHERE %I >= %L AND %I < %L RETURNING *) INSERT INTO %I SELECT * FROM moved',
+                parent || '_default', key_column, month_start, key_column, next_month, partition_name
+            );
+            EXECUTE format('ALTER TABLE %I ATTACH PARTITION %I FOR VALUES FROM (%L) TO (%L)',
+                           parent, partition_name, month_start, next_month);
+            created := created + 1;
+        END IF;
+        month_start := next_month;
+    END LOOP;
+    RETURN created;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Отсоединяет (или удаляет) секции parent_YYYY_MM старше keep_months полных месяцев.
+-- Отсоединённые таблицы остаются в схеме как архив.
+CREATE OR REPLACE FUNCTION detach_expired_partitions(parent TEXT, keep_months INTEGER, drop_detached BOOLEAN DEFAULT false)
+RETURNS SETOF TEXT AS $$
+DECLARE
+    cutoff DATE := (date_trunc('month', LOCALTIMESTAMP) - make_interval(months => keep_months))::date;
+    partition_name TEXT;
+BEGIN
+    FOR partition_name IN
+        SELECT c.relname
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = parent::regclass
+          AND c.relname ~ ('^' || parent || '_\d{4}_\d{2}$')
+          AND to_date(right(c.relname, 7), 'YYYY_MM') < cutoff
+        ORDER BY c.relname
+    LOOP
+        EXECUTE format('ALTER TABLE %I DETACH PARTITION %I', parent, partition_name);
+        IF drop_detached THEN
+            EXECUTE format('DROP TABLE %I', partition_name);
+        END IF;
+        RETURN NEXT partition_name;
+    END LOOP;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Клики
+ALTER TABLE clicks RENAME TO clicks_legacy;
+ALTER TABLE clicks_legacy RENAME CONSTRAINT clicks_pkey TO clicks_legacy_pkey;
+ALTER TABLE clicks_legacy RENAME CONSTRAINT clicks_offer_id_fkey TO clicks_legacy_offer_id_fkey;
+ALTER TABLE clicks_legacy RENAME CONSTRAINT clicks_webmaster_id_fkey TO clicks_legacy_webmaster_id_fkey;
+ALTER SEQUENCE clicks_id_seq AS BIGINT;
+ALTER SEQUENCE clicks_id_seq OWNED BY NONE;
+
+CREATE TABLE clicks (
+    id BIGINT NOT NULL DEFAULT nextval('clicks_id_seq'),
+    offer_id INTEGER NOT NULL REFERENCES offers(id),
+    webmaster_id INTEGER NOT NULL REFERENCES users(id),
+    ip_address VARCHAR(45),
+    user_agent TEXT,
+    referrer TEXT,
+    utm_source VARCHAR(100),
+    utm_medium VARCHAR(100),
+    utm_campaign VARCHAR(100),
+    clicked_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (id, clicked_at)
+) PARTITION BY RANGE (clicked_at);
+
+CREATE TABLE clicks_default PARTITION OF clicks DEFAULT;
+
+-- Конверсии
+ALTER TABLE conversions RENAME TO conversions_legacy;
+ALTER TABLE conversions_legacy RENAME CONSTRAINT conversions_pkey TO conversions_legacy_pkey;
+ALTER TABLE conversions_legacy RENAME CONSTRAINT conversions_offer_id_fkey TO conversions_legacy_offer_id_fkey;
+ALTER TABLE conversions_legacy RENAME CONSTRAINT conversions_webmaster_id_fkey TO conversions_legacy_webmaster_id_fkey;
+ALTER TABLE conversions_legacy RENAME CONSTRAINT conversions_status_check TO conversions_legacy_status_check;
+ALTER SEQUENCE conversions_id_seq AS BIGINT;
+ALTER SEQUENCE conversions_id_seq OWNED BY NONE;
+
+CREATE TABLE conversions (
+    id BIGINT NOT NULL DEFAULT nextval('conversions_id_seq'),
+    offer_id INTEGER NOT NULL REFERENCES offers(id),
+    webmaster_id INTEGER NOT NULL REFERENCES users(id),
+    click_id BIGINT,
+    payout DECIMAL(10, 2) NOT NULL,
+    commission DECIMAL(10, 2) NOT NULL,
+    status VARCHAR(20) DEFAULT 'pending' CHECK (status IN ('pending', 'approved', 'rejected')),
+    ip_address VARCHAR(45),
+    converted_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (id, converted_at)
+) PARTITION BY RANGE (converted_at);
+
+CREATE TABLE conversions_default PARTITION OF conversions DEFAULT;
+
+-- Перенос истории: секции создаются заранее, чтобы строки не оседали в default
+SELECT ensure_monthly_partitions('clicks', 'clicked_at',
+    COALESCE((SELECT MIN(clicked_at) FROM clicks_legacy), LOCALTIMESTAMP)::date, 3);
+SELECT ensure_monthly_partitions('conversions', 'converted_at',
+    COALESCE((SELECT MIN(converted_at) FROM conversions_legacy), LOCALTIMESTAMP)::date, 3);
+
+INSERT INTO clicks (id, offer_id, webmaster_id, ip_address, user_agent, referrer,
+                    utm_source, utm_medium, utm_campaign, clicked_at)
+SELECT id, offer_id, webmaster_id, ip_address, user_agent, referrer,
+       utm_source, utm_medium, utm_campaign, COALESCE(clicked_at, LOCALTIMESTAMP)
+FROM clicks_legacy;
+
+INSERT INTO conversions (id, offer_id, webmaster_id, click_id, payout, commission,
+                         status, ip_address, converted_at)
+SELECT id, offer_id, webmaster_id, click_id, payout, commission,
+       status, ip_address, COALESCE(converted_at, LOCALTIMESTAMP)
+FROM conversions_legacy;
+
+DROP TABLE conversions_legacy;
+DROP TABLE clicks_legacy;
+
+ALTER SEQUENCE clicks_id_seq OWNED BY clicks.id;
+ALTER SEQUENCE conversions_id_seq OWNED BY conversions.id;
+
+-- Индексы создаются на родительской таблице и наследуются всеми секциями
+CREATE INDEX idx_clicks_offer ON clicks(offer_id);
+CREATE INDEX idx_clicks_webmaster ON clicks(webmaster_id);
+CREATE INDEX idx_clicks_created ON clicks(clicked_at);
+CREATE INDEX idx_conversions_offer ON conversions(offer_id);
+CREATE INDEX idx_conversions_webmaster ON conversions(webmaster_id);
+CREATE INDEX idx_conversions_status ON conversions(status);
@@ -0,0 +1,24 @@
+-- Составные, частичные и покрывающие индексы под горячие запросы пикселя и статистики.
+-- Индексы на секционированных таблицах создаются на родителе и наследуются секциями.
+
+-- Атрибуция конверсии: WHERE offer_id AND webmaster_id ORDER BY clicked_at DESC LIMIT 1 (index-only)
+CREATE INDEX idx_clicks_attribution ON clicks(offer_id, webmaster_id, clicked_at DESC) INCLUDE (id);
+
+-- Статистика вебмастера: WHERE webmaster_id AND clicked_at >= ... (покрывает offer_id для факт-таблицы)
+CREATE INDEX idx_clicks_webmaster_time ON clicks(webmaster_id, clicked_at) INCLUDE (offer_id);
+
+-- Одобренные конверсии вебмастера и по офферу за период: частичные покрывающие индексы
+CREATE INDEX idx_conversions_webmaster_approved ON conversions(webmaster_id, converted_at)
+    INCLUDE (offer_id, payout, commission) WHERE status = 'approved';
+CREATE INDEX idx_conversions_offer_approved ON conversions(offer_id, converted_at)
+    INCLUDE (webmaster_id, payout, commission) WHERE status = 'approved';
+CREATE INDEX idx_conversions_approved_time ON conversions(converted_at)
+    INCLUDE (offer_id, webmaster_id, payout, commission) WHERE status = 'approved';
+
+-- Одиночные индексы, ставшие префиксами составных, и малоселективный индекс по статусу
+DROP INDEX idx_clicks_offer;
+DROP INDEX idx_clicks_webmaster;
+DROP INDEX idx_conversions_status;
+
+-- token уже уникален, отдельный индекс дублирует ограничение UNIQUE
+DROP INDEX idx_sessions_token;
@@ -0,0 +1,15 @@
+-- Журнал начислений на баланс: конверсия только добавляет строку и не блокирует строку users.
+-- Периодическая свёртка переносит суммы непримененных строк в users.balance и помечает их applied_at.
+CREATE TABLE balance_ledger (
+    id BIGSERIAL PRIMARY KEY,
+    user_id INTEGER NOT NULL,
+    amount DECIMAL(10, 2) NOT NULL,
+    reason VARCHAR(20) NOT NULL DEFAULT 'conversion',
+    conversion_id BIGINT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    applied_at TIMESTAMP
+);
+
+-- Очередь на свёртку и «висящая» дельта пользователя для чтения баланса
+CREATE INDEX idx_balance_ledger_pending ON balance_ledger(user_id, id) INCLUDE (amount) WHERE applied_at IS NULL;
+CREATE INDEX idx_balance_ledger_user ON balance_ledger(user_id, created_at);
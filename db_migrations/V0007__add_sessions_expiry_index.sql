@@ -0,0 +1,2 @@
+-- Очистка истёкших сессий пачками (backend/auth/sessions.py) выбирает строки по expires_at
+CREATE INDEX idx_sessions_expires ON sessions(expires_at);
@@ -0,0 +1,35 @@
+-- Счётчики кликов и конверсий по офферу для списка офферов вместо COUNT(*) по clicks/conversions.
+-- Ведутся вместе с почасовыми агрегатами (backend/stats/rollup.py) до отметки rolled_until;
+-- события после отметки список офферов досчитывает по сырым таблицам.
+
+-- Все конверсии независимо от статуса: список офферов всегда считал их так
+ALTER TABLE stats_hourly ADD COLUMN conversions_all INTEGER NOT NULL DEFAULT 0;
+
+INSERT INTO stats_hourly (hour, offer_id, webmaster_id, conversions_all)
+SELECT date_trunc('hour', converted_at), offer_id, webmaster_id, COUNT(*)
+FROM conversions
+WHERE converted_at < (SELECT rolled_until FROM rollup_watermarks WHERE name = 'stats_hourly')
+GROUP BY 1, 2, 3
+ON CONFLICT (hour, offer_id, webmaster_id) DO UPDATE SET conversions_all = EXCLUDED.conversions_all;
+
+CREATE TABLE offer_counters (
+    offer_id INTEGER PRIMARY KEY REFERENCES offers(id),
+    clicks BIGINT NOT NULL DEFAULT 0,
+    conversions BIGINT NOT NULL DEFAULT 0
+);
+
+INSERT INTO offer_counters (offer_id, clicks, conversions)
+SELECT offer_id, SUM(clicks), SUM(conversions_all)
+FROM stats_hourly
+GROUP BY offer_id;
+
+-- Досчёт событий оффера после отметки - диапазон по времени внутри оффера;
+-- индекс по conversions заменяет одиночный idx_conversions_offer
+CREATE INDEX idx_clicks_offer_time ON clicks(offer_id, clicked_at);
+CREATE INDEX idx_conversions_offer_time ON conversions(offer_id, converted_at);
+DROP INDEX idx_conversions_offer;
+
+-- Список офферов: фильтр по статусу и категории, keyset-пагинация по (created_at, id)
+CREATE INDEX idx_offers_status_created ON offers(status, created_at DESC, id DESC);
+CREATE INDEX idx_offers_status_category_created ON offers(status, category, created_at DESC, id DESC);
+CREATE INDEX idx_offers_status_payout ON offers(status, payout);
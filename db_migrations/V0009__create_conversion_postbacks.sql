@@ -0,0 +1,12 @@
+-- Идемпотентность S2S-постбэков: ключ (offer_id, transaction_id) от рекламодателя.
+-- conversions секционирована по converted_at, и уникальный индекс на ней обязан включать
+-- converted_at, поэтому ключи живут в отдельной несекционированной таблице.
+
+ALTER TABLE conversions ADD COLUMN transaction_id VARCHAR(128);
+
+CREATE TABLE conversion_postbacks (
+    offer_id INTEGER NOT NULL REFERENCES offers(id),
+    transaction_id VARCHAR(128) NOT NULL,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (offer_id, transaction_id)
+);
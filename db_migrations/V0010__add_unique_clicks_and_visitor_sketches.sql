@@ -0,0 +1,33 @@
+-- Уникальность клика определяет пиксель при приёме (повтор ip + user_agent + оффер + вебмастер в окне).
+-- Для старых кликов она неизвестна, они считаются уникальными.
+ALTER TABLE clicks ADD COLUMN is_unique BOOLEAN NOT NULL DEFAULT TRUE;
+
+ALTER TABLE stats_hourly ADD COLUMN unique_clicks INTEGER NOT NULL DEFAULT 0;
+UPDATE stats_hourly SET unique_clicks = clicks;
+
+-- Разреженный HyperLogLog посетителей (ip, user_agent) по (час, оффер, вебмастер): строка на
+-- непустой регистр с максимальным рангом. Слияние за период - MAX(rho) по регистру,
+-- оценку считает backend/stats/hll.py; выражения регистра и ранга совпадают с hll.py (p = 10).
+CREATE TABLE stats_hourly_visitors (
+    hour TIMESTAMP NOT NULL,
+    offer_id INTEGER NOT NULL REFERENCES offers(id),
+    webmaster_id INTEGER NOT NULL REFERENCES users(id),
+    register SMALLINT NOT NULL,
+    rho SMALLINT NOT NULL,
+    PRIMARY KEY (hour, offer_id, webmaster_id, register)
+);
+
+CREATE INDEX idx_stats_hourly_visitors_webmaster ON stats_hourly_visitors(webmaster_id, hour);
+CREATE INDEX idx_stats_hourly_visitors_offer ON stats_hourly_visitors(offer_id, hour);
+
+INSERT INTO stats_hourly_visitors (hour, offer_id, webmaster_id, register, rho)
+SELECT date_trunc('hour', clicked_at), offer_id, webmaster_id,
+       (h & 1023)::smallint,
+       MAX(COALESCE(NULLIF(position(B'1' IN substring(h::bit(64) FROM 1 FOR 54)), 0), 55))::smallint
+FROM (
+    SELECT clicked_at, offer_id, webmaster_id,
+           hashtextextended(COALESCE(ip_address, '') || '|' || COALESCE(user_agent, ''), 0) AS h
+    FROM clicks
+    WHERE clicked_at < (SELECT rolled_until FROM rollup_watermarks WHERE name = 'stats_hourly')
+) c
+GROUP BY 1, 2, 3, 4;
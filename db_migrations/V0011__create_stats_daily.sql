@@ -0,0 +1,22 @@
+-- Дневные агрегаты по (день, оффер, вебмастер) для графиков дашборда и сумм за всю историю.
+-- Ведутся вместе с почасовыми агрегатами (backend/stats/rollup.py): каждая строка stats_hourly
+-- до отметки rolled_until входит ровно в одну строку stats_daily, день отметки - частично.
+CREATE TABLE stats_daily (
+    day DATE NOT NULL,
+    offer_id INTEGER NOT NULL REFERENCES offers(id),
+    webmaster_id INTEGER NOT NULL REFERENCES users(id),
+    clicks BIGINT NOT NULL DEFAULT 0,
+    unique_clicks BIGINT NOT NULL DEFAULT 0,
+    conversions BIGINT NOT NULL DEFAULT 0,
+    payout DECIMAL(16, 2) NOT NULL DEFAULT 0,
+    commission DECIMAL(16, 2) NOT NULL DEFAULT 0,
+    PRIMARY KEY (day, offer_id, webmaster_id)
+);
+
+CREATE INDEX idx_stats_daily_webmaster ON stats_daily(webmaster_id, day);
+CREATE INDEX idx_stats_daily_offer ON stats_daily(offer_id, day) INCLUDE (webmaster_id, clicks, unique_clicks, conversions, payout, commission);
+
+INSERT INTO stats_daily (day, offer_id, webmaster_id, clicks, unique_clicks, conversions, payout, commission)
+SELECT hour::date, offer_id, webmaster_id, SUM(clicks), SUM(unique_clicks), SUM(conversions), SUM(payout), SUM(commission)
+FROM stats_hourly
+GROUP BY 1, 2, 3;
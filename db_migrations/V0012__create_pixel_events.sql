@@ -0,0 +1,10 @@
+-- Обработанные события очереди пикселя (backend/pixel/pipeline.py) для записи ровно один раз.
+-- Ключ занимается в той же транзакции, что и конверсия с начислением, поэтому повторный разбор
+-- сегмента после сбоя не создаёт дублей. Клики ключей не занимают: их id выделен заранее
+-- из clicks_id_seq, и повтор отсекает первичный ключ clicks.
+CREATE TABLE pixel_events (
+    event_id VARCHAR(160) PRIMARY KEY,
+    processed_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX idx_pixel_events_processed_at ON pixel_events(processed_at);
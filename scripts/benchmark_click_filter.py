@@ -0,0 +1,62 @@
+'''
+Business: Замер накладных расходов фильтра ботов на один клик, по этапам и целиком
+Args: --events - число кликов, --ips - число разных IP, --offers - число офферов, --bots - доля ботовых User-Agent
+Returns: таблица мкс на событие для блок-листа, User-Agent, счётчиков частоты и полного check()
+'''
+import os
+import sys
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'backend', 'pixel'))
+
+from click_filter import Blocklist, ClickFilter  # noqa: E402
+
+BROWSER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0 Safari/537.36'
+BOT_AGENT = 'Mozilla/5.0 (compatible; Googlebot/2.1; +http://www.google.com/bot.html)'
+
+
+def make_events(count: int, ips: int, offers: int, bots: float):
+    rng = random.Random(42)
+    return [(f'10.{rng.randrange(ips) // 65536}.{rng.randrange(ips) // 256 % 256}.{rng.randrange(256)}',
+             BOT_AGENT if rng.random() < bots else BROWSER_AGENT,
+             str(rng.randrange(1, offers + 1)))
+            for _ in range(count)]
+
+
+def measure(label: str, events, step) -> None:
+    started = time.perf_counter()
+    for ip, user_agent, offer_id in events:
+        step(ip, user_agent, offer_id)
+    elapsed = time.perf_counter() - started
+    print(f'{label:<28} {1e6 * elapsed / len(events):>10.2f} {len(events) / elapsed:>14.0f}')
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--events', type=int, default=200000)
+    parser.add_argument('--ips', type=int, default=50000)
+    parser.add_argument('--offers', type=int, default=100)
+    parser.add_argument('--bots', type=float, default=0.1)
+    args = parser.parse_args()
+
+    events = make_events(args.events, args.ips, args.offers, args.bots)
+    blocklist = Blocklist(['192.0.2.0/24', '198.51.100.7', '2001:db8::/32'])
+    click_filter = ClickFilter(blocklist=blocklist)
+
+    print(f"{'stage':<28} {'us/event':>10} {'events/sec':>14}")
+    measure('blocklist', events, lambda ip, user_agent, offer_id: ip in blocklist)
+    measure('user agent regex', events, lambda ip, user_agent, offer_id: click_filter.bot_agents.search(user_agent))
+    measure('user agent (cached)', events, lambda ip, user_agent, offer_id: click_filter.is_bot_agent(user_agent))
+    measure('rate counters (ip, offer)', events, lambda ip, user_agent, offer_id: (
+        click_filter.ip_counts.add(ip, time.time()),
+        click_filter.ip_offer_counts.add(f'{ip}|{offer_id}', time.time()),
+    ))
+    click_filter = ClickFilter(blocklist=blocklist)
+    measure('check() total', events, click_filter.check)
+    print(click_filter.stats())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+'''
+Business: Замер скорости KDF паролей на текущем железе для выбора стоимости под бюджет задержки логина
+Args: --kdf scrypt|pbkdf2|all, --seconds - длительность замера на настройку, --threads - параллельные хэши
+Returns: таблица hashes/sec и мс на хэш для каждой настройки стоимости
+'''
+import os
+import sys
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'backend', 'auth'))
+
+from passwords import hash_password_sync  # noqa: E402
+
+SETTINGS = {
+    'scrypt': [{'kdf': 'scrypt', 'n': n, 'r': 8, 'p': 1} for n in (2 ** 13, 2 ** 14, 2 ** 15, 2 ** 16)],
+    'pbkdf2': [{'kdf': 'pbkdf2_sha256', 'iterations': i} for i in (100000, 300000, 600000, 1000000)],
+}
+
+
+def measure(params, seconds: float, threads: int) -> float:
+    deadline = time.perf_counter() + seconds
+
+    def worker() -> int:
+        count = 0
+        while time.perf_counter() < deadline:
+            hash_password_sync('benchmark-password', params)
+            count += 1
+        return count
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        total = sum(pool.map(lambda _: worker(), range(threads)))
+    return total / (time.perf_counter() - started)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--kdf', choices=['scrypt', 'pbkdf2', 'all'], default='all')
+    parser.add_argument('--seconds', type=float, default=2.0)
+    parser.add_argument('--threads', type=int, default=1)
+    args = parser.parse_args()
+
+    print(f"{'setting':<40} {'hashes/sec':>12} {'ms/hash':>10}")
+    for kdf in (['scrypt', 'pbkdf2'] if args.kdf == 'all' else [args.kdf]):
+        for params in SETTINGS[kdf]:
+            rate = measure(params, args.seconds, args.threads)
+            label = ' '.join(f'{name}={value}' for name, value in params.items())
+            print(f'{label:<40} {rate:>12.1f} {1000 * args.threads / rate:>10.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+'''
+Business: Замер процессорного времени на сборку ответа до и после общего модуля responses.py
+Args: --requests - число повторов каждого сценария, --offers - офферов на странице списка;
+      DATABASE_URL - если задан, дополнительно сравниваются RealDictCursor и JsonRowCursor на странице офферов
+Returns: таблица мкс CPU на запрос для прежнего и нового варианта каждого сценария
+'''
+import os
+import sys
+import json
+import time
+import argparse
+from decimal import Decimal
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'backend', 'offers'))
+
+from responses import dumps, json_response, error_response, gif_response, JsonRowCursor  # noqa: E402
+
+
+def legacy_error(message: str):
+    return {
+        'statusCode': 400,
+        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+        'body': json.dumps({'error': message})
+    }
+
+
+def legacy_click_gif(click_id: str):
+    headers = {'Content-Type': 'image/gif', 'Access-Control-Allow-Origin': '*'}
+    headers.update({'Access-Control-Expose-Headers': 'X-Click-Id', 'X-Click-Id': click_id})
+    return {
+        'statusCode': 200,
+        'headers': headers,
+        'body': 'R0lGODlhAQABAIAAAAAAAP///yH5BAEAAAAALAAAAAABAAEAAAIBRAA7',
+        'isBase64Encoded': True
+    }
+
+
+def legacy_batch(results):
+    return {
+        'statusCode': 200,
+        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+        'body': json.dumps({'accepted': len(results), 'duplicates': 0, 'results': results}, separators=(',', ':'))
+    }
+
+
+def make_offer_rows(count: int):
+    '''Строки страницы офферов, как их отдают RealDictCursor (Decimal/datetime) и JsonRowCursor (текст)'''
+    started = datetime(2024, 1, 1, 12, 0, 0, 123450)
+    typed = [{'id': i, 'name': f'Оффер {i}', 'description': 'Описание оффера ' * 4, 'payout': Decimal(f'{500 + i}.00'),
+              'category': 'finance', 'status': 'active', 'created_at': started + timedelta(minutes=i),
+              'clicks': 1000 + i, 'conversions': 10 + i} for i in range(count)]
+    columns = list(typed[0])
+    text = [tuple(str(row[name]) if name in ('payout', 'created_at') else row[name] for name in columns)
+            for row in typed]
+    return typed, columns, text
+
+
+def measure(label: str, requests: int, legacy, current, rounds: int = 5) -> None:
+    '''Варианты чередуются по раундам, берётся лучший раунд - меньше шума от прогрева и соседей'''
+    results = [float('inf'), float('inf')]
+    for _ in range(rounds):
+        for index, build in enumerate((legacy, current)):
+            started = time.process_time()
+            for _ in range(requests):
+                build()
+            results[index] = min(results[index], 1e6 * (time.process_time() - started) / requests)
+    print(f'{label:<32} {results[0]:>10.2f} {results[1]:>10.2f} {results[0] / max(results[1], 1e-9):>8.2f}x')
+
+
+def measure_database(requests: int, offers: int) -> None:
+    import psycopg2
+    from psycopg2.extras import RealDictCursor
+
+    query = f'''
+        SELECT g AS id, 'Оффер ' || g AS name, repeat('Описание оффера ', 4) AS description,
+               (500 + g)::numeric(10, 2) AS payout, 'finance' AS category, 'active' AS status,
+               TIMESTAMP '2024-01-01 12:00:00.12345' + g * interval '1 minute' AS created_at,
+               1000 + g AS clicks, 10 + g AS conversions
+        FROM generate_series(1, {int(offers)}) g
+    '''
+    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+
+    def legacy():
+        with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+            cursor.execute(query)
+            return json.dumps([dict(row) for row in cursor.fetchall()], default=str)
+
+    def current():
+        with conn.cursor(cursor_factory=JsonRowCursor) as cursor:
+            cursor.execute(query)
+            names = cursor.column_names()
+            return dumps([dict(zip(names, row)) for row in cursor.fetchall()])
+
+    assert legacy() == current(), 'тела ответов различаются'
+    measure(f'offers page from db ({offers})', requests, legacy, current)
+    conn.rollback()
+    conn.close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=20000)
+    parser.add_argument('--offers', type=int, default=100)
+    args = parser.parse_args()
+
+    typed, columns, text = make_offer_rows(args.offers)
+    text_dicts = [dict(zip(columns, row)) for row in text]
+    assert json.dumps(typed, default=str) == dumps(text_dicts), 'тела ответов различаются'
+    results = [[200, '17']] * 50
+
+    print(f"{'scenario':<32} {'before us':>10} {'after us':>10} {'speedup':>9}")
+    measure('error response', args.requests,
+            lambda: legacy_error('offer_id обязателен'), lambda: error_response(400, 'offer_id обязателен'))
+    measure('click gif response', args.requests,
+            lambda: legacy_click_gif('abc.def'),
+            lambda: gif_response(headers={'Access-Control-Expose-Headers': 'X-Click-Id', 'X-Click-Id': 'abc.def'}))
+    measure('batch response (50)', args.requests, lambda: legacy_batch(results),
+            lambda: json_response({'accepted': len(results), 'duplicates': 0, 'results': results}, compact=True))
+    measure(f'offers page encode ({args.offers})', max(1, args.requests // 20),
+            lambda: json.dumps(typed, default=str), lambda: dumps(text_dicts))
+    if os.environ.get('DATABASE_URL'):
+        measure_database(max(1, args.requests // 20), args.offers)
+
+
+if __name__ == '__main__':
+    main()
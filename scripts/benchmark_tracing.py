@@ -0,0 +1,61 @@
+'''
+Business: Накладные расходы трассировки на запрос - без трассировки, полная и выборочная (TRACE_SAMPLE_RATE)
+Args: --requests - число запросов, --queries - SQL на запрос, --sample-rate - доля для выборочного режима
+Returns: таблица мкс CPU на запрос; строки лога трассировки пишутся в /dev/null
+'''
+import os
+import sys
+import time
+import logging
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'backend', 'pixel'))
+
+import tracing  # noqa: E402
+
+QUERY = "SELECT id, payout FROM offers WHERE id = %s AND status = 'active'"
+EVENT = {'httpMethod': 'GET', 'queryStringParameters': {'action': 'click'}}
+
+
+class Context:
+    request_id = 'benchmark'
+
+
+def simulate(requests: int, queries: int) -> float:
+    '''Запрос: соединение, queries запросов, commit и сериализация - только вызовы трассировки, без БД'''
+    started = time.process_time()
+    for _ in range(requests):
+        trace = tracing.start_trace(Context(), 'pixel')
+        with tracing.span('connect'):
+            pass
+        for _ in range(queries):
+            tracing.record_query(QUERY, 0.0005, 1)
+        with tracing.span('commit'):
+            pass
+        with tracing.span('encode'):
+            pass
+        tracing.finish_trace(trace, EVENT, {'statusCode': 200, 'headers': {}})
+    return 1e6 * (time.process_time() - started) / requests
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=20000)
+    parser.add_argument('--queries', type=int, default=3)
+    parser.add_argument('--sample-rate', type=float, default=0.01)
+    args = parser.parse_args()
+
+    for handler in tracing.logger.handlers:
+        if isinstance(handler, logging.StreamHandler):
+            handler.setStream(open(os.devnull, 'w'))
+
+    print(f"{'mode':<24} {'us/request':>12}")
+    modes = [('off (no trace)', 0.0), ('sampled', args.sample_rate), ('full', 1.0)]
+    for label, rate in modes:
+        tracing.SAMPLE_RATE = rate
+        best = min(simulate(args.requests, args.queries) for _ in range(3))
+        print(f'{label:<24} {best:>12.2f}')
+
+
+if __name__ == '__main__':
+    main()
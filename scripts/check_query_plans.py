@@ -0,0 +1,268 @@
+'''
+Business: Проверка планов горячих запросов пикселя, статистики и авторизации через EXPLAIN
+Args: DATABASE_URL - база с применёнными db_migrations; --clicks N - объём синтетических данных
+Returns: код выхода 0, если каждый запрос читает clicks/conversions/stats_hourly/stats_daily/sessions индексом,
+         а метрики офферов из статистики совпадают с прямыми COUNT/SUM и считаются за один round trip
+
+Данные сидируются внутри транзакции, которая в конце откатывается, так что запуск
+на рабочей копии базы ничего не оставляет после себя.
+'''
+import os
+import sys
+import json
+import argparse
+from decimal import Decimal
+from datetime import datetime, timedelta
+from typing import Dict, Any, List, Tuple
+import psycopg2
+from psycopg2.extras import RealDictCursor
+
+# Сид откатывается, поэтому фоновому догону агрегатов из run_stats_plan здесь делать нечего
+os.environ.setdefault('STATS_BACKGROUND_REFRESH', '0')
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'backend', 'stats'))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'backend', 'offers'))
+
+from planner import ROLE_PLANS, SERIES_PLANS, CountingCursor, run_stats_plan  # noqa: E402
+from listing import build_list_query, parse_list_params  # noqa: E402
+from rollup import period_params  # noqa: E402
+from daily import series_params  # noqa: E402
+from hll import register_sql, rho_sql  # noqa: E402
+
+CHECKED_TABLES = ('clicks', 'conversions', 'stats_hourly', 'stats_daily', 'sessions')
+INDEX_SCANS = ('Index Scan', 'Index Only Scan', 'Bitmap Heap Scan')
+
+SEED_SQL = f'''
+    SELECT ensure_monthly_partitions('clicks', 'clicked_at', (LOCALTIMESTAMP - %(days)s * interval '1 day')::date, 0);
+    SELECT ensure_monthly_partitions('conversions', 'converted_at', (LOCALTIMESTAMP - %(days)s * interval '1 day')::date, 0);
+
+    INSERT INTO users (email, password_hash, role)
+    SELECT 'plan-wm-' || g || '@example.com', 'x', 'webmaster' FROM generate_series(1, %(webmasters)s) g;
+
+    INSERT INTO users (email, password_hash, role)
+    SELECT 'plan-adv-' || g || '@example.com', 'x', 'advertiser' FROM generate_series(1, %(advertisers)s) g;
+
+    INSERT INTO offers (advertiser_id, name, payout, category, status)
+    SELECT (SELECT id FROM users WHERE email = 'plan-adv-' || (1 + g %% %(advertisers)s) || '@example.com'),
+           'plan offer ' || g, 500 + g, 'plan', 'active'
+    FROM generate_series(1, %(offers)s) g;
+
+    CREATE TEMP TABLE plan_offers ON COMMIT DROP AS
+        SELECT id, row_number() OVER (ORDER BY id) AS n FROM offers WHERE name LIKE 'plan offer %%';
+    CREATE TEMP TABLE plan_webmasters ON COMMIT DROP AS
+        SELECT id, row_number() OVER (ORDER BY id) AS n FROM users WHERE email LIKE 'plan-wm-%%';
+
+    INSERT INTO clicks (offer_id, webmaster_id, ip_address, user_agent, clicked_at)
+    SELECT o.id, w.id, '10.0.' || (g %% 250) || '.' || (g %% 200), 'Mozilla/5.0',
+           LOCALTIMESTAMP - (g::bigint * 86400 * %(days)s / %(clicks)s) * interval '1 second'
+    FROM generate_series(1, %(clicks)s) g
+    JOIN plan_offers o ON o.n = 1 + g %% %(offers)s
+    JOIN plan_webmasters w ON w.n = 1 + (g / 7) %% %(webmasters)s;
+
+    INSERT INTO conversions (offer_id, webmaster_id, click_id, payout, commission, status, converted_at)
+    SELECT offer_id, webmaster_id, id, 400, 100, 'approved', clicked_at + interval '10 minutes'
+    FROM clicks WHERE id %% 10 = 0 AND offer_id IN (SELECT id FROM plan_offers);
+
+    INSERT INTO sessions (user_id, token, expires_at)
+    SELECT id, 'plan-token-' || id, LOCALTIMESTAMP + interval '30 days' FROM plan_webmasters;
+
+    UPDATE rollup_watermarks SET rolled_until = date_trunc('hour', LOCALTIMESTAMP) - interval '1 hour'
+    WHERE name = 'stats_hourly';
+
+    -- Агрегаты только до отметки и со всеми суммами: сверка метрик ниже сравнивает их с сырыми строками
+    INSERT INTO stats_hourly (hour, offer_id, webmaster_id, clicks, unique_clicks, conversions, payout, commission)
+    SELECT hour, offer_id, webmaster_id, SUM(clicks), SUM(clicks), SUM(conversions), SUM(payout), SUM(commission)
+    FROM (
+        SELECT date_trunc('hour', clicked_at) AS hour, offer_id, webmaster_id,
+               1 AS clicks, 0 AS conversions, 0 AS payout, 0 AS commission
+        FROM clicks WHERE offer_id IN (SELECT id FROM plan_offers)
+        UNION ALL
+        SELECT date_trunc('hour', converted_at), offer_id, webmaster_id, 0, 1, payout, commission
+        FROM conversions WHERE status = 'approved' AND offer_id IN (SELECT id FROM plan_offers)
+    ) f
+    WHERE hour < (SELECT rolled_until FROM rollup_watermarks WHERE name = 'stats_hourly')
+    GROUP BY 1, 2, 3
+    ON CONFLICT DO NOTHING;
+
+    INSERT INTO stats_daily (day, offer_id, webmaster_id, clicks, unique_clicks, conversions, payout, commission)
+    SELECT hour::date, offer_id, webmaster_id, SUM(clicks), SUM(unique_clicks), SUM(conversions), SUM(payout), SUM(commission)
+    FROM stats_hourly WHERE offer_id IN (SELECT id FROM plan_offers)
+    GROUP BY 1, 2, 3
+    ON CONFLICT DO NOTHING;
+
+    INSERT INTO stats_hourly_visitors (hour, offer_id, webmaster_id, register, rho)
+    SELECT date_trunc('hour', clicked_at), offer_id, webmaster_id, {register_sql()}, MAX({rho_sql()})
+    FROM clicks WHERE offer_id IN (SELECT id FROM plan_offers)
+    GROUP BY 1, 2, 3, 4
+    ON CONFLICT DO NOTHING;
+
+    ANALYZE users;
+    ANALYZE offers;
+    ANALYZE clicks;
+    ANALYZE conversions;
+    ANALYZE sessions;
+    ANALYZE stats_hourly;
+    ANALYZE stats_hourly_visitors;
+    ANALYZE stats_daily;
+    ANALYZE rollup_watermarks;
+'''
+
+
+def handler_queries(cursor) -> List[Tuple[str, str, Dict[str, Any]]]:
+    cursor.execute("SELECT id FROM users WHERE email LIKE 'plan-wm-%%' ORDER BY id LIMIT 1")
+    wm_id = cursor.fetchone()['id']
+    cursor.execute("SELECT id, advertiser_id FROM offers WHERE name LIKE 'plan offer %%' ORDER BY id LIMIT 1")
+    offer = cursor.fetchone()
+    start = datetime.utcnow() - timedelta(days=30)
+    offers_page = parse_list_params({'category': 'plan', 'limit': '50', 'after': str(offer['id'])})
+    stats_params = dict(period_params('period', start), **series_params(30, datetime.utcnow().date()))
+    series = series_params(90, datetime.utcnow().date())
+    return [
+        ('pixel: click attribution',
+         '''SELECT id FROM clicks
+            WHERE offer_id = %(offer_id)s AND webmaster_id = %(wm_id)s
+            ORDER BY clicked_at DESC LIMIT 1''',
+         {'offer_id': offer['id'], 'wm_id': wm_id}),
+        ('pixel: queued conversion attribution',
+         '''SELECT id FROM clicks
+            WHERE offer_id = %(offer_id)s AND webmaster_id = %(wm_id)s AND clicked_at <= %(converted_at)s
+            ORDER BY clicked_at DESC LIMIT 1''',
+         {'offer_id': offer['id'], 'wm_id': wm_id, 'converted_at': datetime.utcnow()}),
+        ('offers: list page',
+         build_list_query(offers_page), offers_page),
+        ('auth: verify',
+         '''SELECT u.id, u.email, u.role
+            FROM sessions s JOIN users u ON s.user_id = u.id
+            WHERE s.token = %(token)s AND s.expires_at > NOW()''',
+         {'token': f'plan-token-{wm_id}'}),
+        ('stats: webmaster', ROLE_PLANS['webmaster'], dict(stats_params, user_id=wm_id)),
+        ('stats: advertiser', ROLE_PLANS['advertiser'], dict(stats_params, user_id=offer['advertiser_id'])),
+        ('stats: webmaster series', SERIES_PLANS['webmaster'], dict(series, user_id=wm_id)),
+        ('stats: advertiser series', SERIES_PLANS['advertiser'], dict(series, user_id=offer['advertiser_id'])),
+    ]
+
+
+# Метрики офферов за всю историю прямыми подзапросами к сырым таблицам - эталон для offer_metrics_cte
+DIRECT_OFFER_METRICS_SQL = '''
+    SELECT o.id,
+           (SELECT COUNT(*) FROM clicks c WHERE c.offer_id = o.id AND {scope}) AS clicks,
+           (SELECT COUNT(*) FROM conversions c WHERE c.offer_id = o.id AND c.status = 'approved' AND {scope}) AS conversions,
+           (SELECT COALESCE(SUM(payout), 0) FROM conversions c
+            WHERE c.offer_id = o.id AND c.status = 'approved' AND {scope}) AS payout,
+           (SELECT COALESCE(SUM(commission), 0) FROM conversions c
+            WHERE c.offer_id = o.id AND c.status = 'approved' AND {scope}) AS commission
+    FROM offers o
+    WHERE {where}
+'''
+
+# (роль, поле списка, денежная колонка, условие на офферы, только офферы с кликами, первые N)
+METRIC_CHECKS = (
+    ('webmaster', 'top_offers', 'earnings', "o.status = 'active'", True, 10),
+    ('advertiser', 'offers', 'spent', 'o.advertiser_id = %(user_id)s', False, None),
+    ('admin', 'top_offers', 'commission', "o.status = 'active'", False, 10),
+)
+
+
+def direct_offer_metrics(cursor, role: str, user_id: int, where: str, with_clicks: bool,
+                         limit: Any) -> List[Tuple[int, int, int, Decimal]]:
+    '''Ожидаемый список (id, clicks, conversions, деньги) в порядке, в котором его отдаёт статистика'''
+    scope = {'webmaster': 'c.webmaster_id = %(user_id)s', 'advertiser': 'TRUE', 'admin': 'TRUE'}[role]
+    cursor.execute(DIRECT_OFFER_METRICS_SQL.format(scope=scope, where=where), {'user_id': user_id})
+    rows = [row for row in cursor.fetchall() if row['clicks'] > 0 or not with_clicks]
+    money = {'webmaster': lambda r: r['payout'], 'advertiser': lambda r: r['payout'] + r['commission'],
+             'admin': lambda r: r['commission']}[role]
+    expected = [(row['id'], row['clicks'], row['conversions'], Decimal(money(row))) for row in rows]
+    if limit:
+        expected = sorted(expected, key=lambda item: (-item[2], item[0]))[:limit]
+    return expected
+
+
+def check_offer_metrics(conn, users: Dict[str, int]) -> List[Tuple[str, List[str]]]:
+    '''Сверка метрик офферов из run_stats_plan с прямыми COUNT/SUM и бюджет в один round trip на роль'''
+    results = []
+    for role, field, money, where, with_clicks, limit in METRIC_CHECKS:
+        problems = []
+        with conn.cursor(cursor_factory=CountingCursor) as cursor:
+            stats = run_stats_plan(cursor, role, users[role], 30)
+            if cursor.round_trips != 1:
+                problems.append(f'round trips: {cursor.round_trips}, ожидался 1')
+            actual = [(item['id'], item['clicks'], item['conversions'], Decimal(item[money]))
+                      for item in stats[field]]
+            expected = direct_offer_metrics(cursor, role, users[role], where, with_clicks, limit)
+        if not limit:
+            actual, expected = sorted(actual), sorted(expected)
+        for got, want in zip(actual, expected):
+            if got != want:
+                problems.append(f'offer {want[0]}: статистика {got[1:]}, напрямую {want[1:]}')
+        if len(actual) != len(expected):
+            problems.append(f'офферов в {field}: {len(actual)}, напрямую {len(expected)}')
+        results.append((f'stats: {role} offer metrics', problems))
+    return results
+
+
+def empty_relations(cursor) -> set:
+    '''Пустые секции после ANALYZE: последовательное чтение пустой кучи ничего не стоит'''
+    cursor.execute("SELECT relname FROM pg_class WHERE relkind = 'r' AND reltuples <= 0")
+    return {row['relname'] for row in cursor.fetchall()}
+
+
+def plan_scans(node: Dict[str, Any]) -> List[Tuple[str, str, str]]:
+    scans = []
+    relation = node.get('Relation Name')
+    if relation:
+        scans.append((relation, node['Node Type'], node.get('Index Name', '')))
+    for child in node.get('Plans', []):
+        scans.extend(plan_scans(child))
+    return scans
+
+
+def is_checked(relation: str) -> bool:
+    return any(relation == table or relation.startswith(table + '_') for table in CHECKED_TABLES)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--clicks', type=int, default=200000)
+    parser.add_argument('--offers', type=int, default=200)
+    parser.add_argument('--webmasters', type=int, default=500)
+    parser.add_argument('--advertisers', type=int, default=50)
+    parser.add_argument('--days', type=int, default=60)
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    failures = 0
+    try:
+        with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+            cursor.execute(SEED_SQL, vars(args))
+            skipped = empty_relations(cursor)
+            for name, sql, params in handler_queries(cursor):
+                cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+                plan = cursor.fetchone()['QUERY PLAN'][0]['Plan']
+                scans = [scan for scan in plan_scans(plan) if is_checked(scan[0]) and scan[0] not in skipped]
+                bad = [scan for scan in scans if scan[1] not in INDEX_SCANS]
+                failures += bool(bad)
+                print(f"{'FAIL' if bad else 'ok  '} {name}")
+                for relation, node_type, index in scans if (bad or args.verbose) else []:
+                    mark = '!' if node_type not in INDEX_SCANS else ' '
+                    print(f'    {mark} {relation}: {node_type} {index}')
+                if bad and args.verbose:
+                    print(json.dumps(plan, indent=2))
+            cursor.execute("""
+                SELECT (SELECT id FROM users WHERE email LIKE 'plan-wm-%%' ORDER BY id LIMIT 1) AS webmaster,
+                       (SELECT advertiser_id FROM offers WHERE name LIKE 'plan offer %%' ORDER BY id LIMIT 1) AS advertiser,
+                       (SELECT id FROM users WHERE email LIKE 'plan-wm-%%' ORDER BY id LIMIT 1) AS admin
+            """)
+            users = dict(cursor.fetchone())
+        for name, problems in check_offer_metrics(conn, users):
+            failures += bool(problems)
+            print(f"{'FAIL' if problems else 'ok  '} {name}")
+            for problem in problems:
+                print(f'    ! {problem}')
+    finally:
+        conn.rollback()
+        conn.close()
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,66 @@
+'''
+Business: Полная выгрузка кликов или конверсий в файл напрямую из БД, без лимита размера ответа функции
+Args: DATABASE_URL; --kind, --format, --role, --user-id, --offer-id, --webmaster-id, --date-from, --date-to,
+      --after - курсор X-Next-After, чтобы продолжить прерванную выгрузку; --output - файл (по умолчанию stdout)
+Returns: файл выгрузки; число строк, пиковая память процесса и курсор последней строки - в stderr
+'''
+import os
+import sys
+import time
+import argparse
+import resource
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'backend', 'stats'))
+
+import psycopg2  # noqa: E402
+from export import EXPORT_KINDS, EXPORT_FORMATS, encode_after, iter_export, parse_export_params  # noqa: E402
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--kind', choices=list(EXPORT_KINDS), default='clicks')
+    parser.add_argument('--format', choices=list(EXPORT_FORMATS), default='csv')
+    parser.add_argument('--role', choices=['advertiser', 'webmaster', 'admin'], default='admin')
+    parser.add_argument('--user-id', default='0')
+    parser.add_argument('--offer-id')
+    parser.add_argument('--webmaster-id')
+    parser.add_argument('--date-from')
+    parser.add_argument('--date-to')
+    parser.add_argument('--after')
+    parser.add_argument('--output')
+    args = parser.parse_args()
+
+    params = {name: value for name, value in (
+        ('kind', args.kind), ('format', args.format), ('offer_id', args.offer_id),
+        ('webmaster_id', args.webmaster_id), ('date_from', args.date_from),
+        ('date_to', args.date_to), ('after', args.after),
+    ) if value}
+    try:
+        query = parse_export_params(params, args.user_id, args.role)
+    except ValueError as e:
+        print(str(e), file=sys.stderr)
+        return 2
+
+    output = open(args.output, 'w', encoding='utf-8', newline='') if args.output else sys.stdout
+    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    started, rows, last = time.perf_counter(), 0, None
+    try:
+        for key, line in iter_export(conn, query):
+            output.write(line)
+            if key is not None:
+                rows, last = rows + 1, key
+    finally:
+        conn.close()
+        if output is not sys.stdout:
+            output.close()
+        elapsed = time.perf_counter() - started
+        peak_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        print(f'rows {rows}, {elapsed:.1f} s, {rows / max(elapsed, 1e-9):.0f} rows/s, peak RSS {peak_mb:.0f} MB',
+              file=sys.stderr)
+        if last is not None:
+            print(f'after {encode_after(*last, query["date_to"])}', file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
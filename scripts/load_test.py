@@ -0,0 +1,577 @@
+'''
+Business: Нагрузочный прогон функций в одном процессе - клики, конверсии, статистика, проверка токена -
+          на одноразовой базе из db_migrations с синтетическими данными заданного объёма
+Args: DATABASE_URL - сервер, на котором создаётся и после прогона удаляется временная база;
+      без него - временный кластер через initdb/pg_ctl (--pg-bin или PATH);
+      --offers, --webmasters, --clicks (млн) - объём данных, --mix - веса сценариев,
+      --concurrency, --duration - нагрузка, --output - файл с результатами, --diff OLD NEW - сравнить два файла
+Returns: таблица p50/p95/p99, запросов в секунду и обращений к БД по каждому сценарию;
+         с --output тот же результат в JSON для сравнения между коммитами
+
+Каждый handler импортируется из своей папки backend/<функция> со своими db.py/responses.py/tracing.py,
+как в отдельном контейнере. Обращения к БД считаются по заголовку Server-Timing
+(db;desc="N queries"), который добавляет tracing.finish_trace, - без правок в самих функциях.
+'''
+import os
+import re
+import sys
+import json
+import time
+import glob
+import random
+import shutil
+import logging
+import argparse
+import tempfile
+import threading
+import subprocess
+import importlib.util
+from collections import deque
+from contextlib import contextmanager, nullcontext
+from urllib.parse import parse_qsl, urlsplit, urlunsplit
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, List, Optional, Tuple, Callable, Iterator
+import psycopg2
+from psycopg2.extras import RealDictCursor
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+BACKEND = os.path.join(ROOT, 'backend')
+FUNCTIONS = ('auth', 'offers', 'pixel', 'stats')
+DEFAULT_MIX = 'click=60,convert=10,stats=10,verify=15,offers=5'
+BASELINE_VERSION = 1
+
+_QUERIES = re.compile(r'db;dur=([\d.]+);desc="(\d+) queries"')
+
+SEED_SQL = '''
+    SELECT ensure_monthly_partitions('clicks', 'clicked_at', (LOCALTIMESTAMP - %(days)s * interval '1 day')::date, 0);
+    SELECT ensure_monthly_partitions('conversions', 'converted_at', (LOCALTIMESTAMP - %(days)s * interval '1 day')::date, 0);
+
+    INSERT INTO users (email, password_hash, role)
+    SELECT 'load-wm-' || g || '@example.com', 'x', 'webmaster' FROM generate_series(1, %(webmasters)s) g;
+
+    INSERT INTO users (email, password_hash, role)
+    SELECT 'load-adv-' || g || '@example.com', 'x', 'advertiser' FROM generate_series(1, %(advertisers)s) g;
+
+    CREATE TEMP TABLE load_webmasters AS
+        SELECT id, row_number() OVER (ORDER BY id) AS n FROM users WHERE email LIKE 'load-wm-%%';
+    CREATE TEMP TABLE load_advertisers AS
+        SELECT id, row_number() OVER (ORDER BY id) AS n FROM users WHERE email LIKE 'load-adv-%%';
+
+    INSERT INTO offers (advertiser_id, name, description, payout, category, status)
+    SELECT a.id, 'Нагрузочный оффер ' || g, 'Описание оффера ' || g, 500 + g %% 50 * 100, 'load',
+           CASE WHEN g %% 10 = 0 THEN 'paused' ELSE 'active' END
+    FROM generate_series(1, %(offers)s) g
+    JOIN load_advertisers a ON a.n = 1 + g %% %(advertisers)s;
+
+    CREATE TEMP TABLE load_offers AS
+        SELECT id, row_number() OVER (ORDER BY id) AS n FROM offers WHERE category = 'load';
+
+    INSERT INTO clicks (offer_id, webmaster_id, ip_address, user_agent, referrer, utm_source, utm_medium,
+                        is_unique, clicked_at)
+    SELECT o.id, w.id, '10.' || (g %% 200) || '.' || (g / 200 %% 250) || '.' || (g %% 7 + 1),
+           'Mozilla/5.0 (Windows NT 10.0; Win64; x64) Chrome/120.0', '', 'cpasibo_pro', 'cpl', g %% 3 <> 0,
+           LOCALTIMESTAMP - (g::bigint * 86400 * %(days)s / %(clicks)s) * interval '1 second'
+    FROM generate_series(1, %(clicks)s) g
+    JOIN load_offers o ON o.n = 1 + g %% %(offers)s
+    JOIN load_webmasters w ON w.n = 1 + (g / 7) %% %(webmasters)s;
+
+    INSERT INTO conversions (offer_id, webmaster_id, click_id, payout, commission, ip_address, status,
+                             converted_at)
+    SELECT offer_id, webmaster_id, id, 400, 100, ip_address, 'approved', clicked_at + interval '10 minutes'
+    FROM clicks WHERE id %% %(conversion_every)s = 0 AND offer_id IN (SELECT id FROM load_offers);
+
+    INSERT INTO sessions (user_id, token, expires_at)
+    SELECT id, 'load-token-' || id, LOCALTIMESTAMP + interval '30 days'
+    FROM users WHERE email LIKE 'load-%%';
+
+    -- История старше отметки, поставленной миграцией V0003: агрегаты досчитываются заново
+    UPDATE rollup_watermarks SET rolled_until = date_trunc('hour', (SELECT MIN(clicked_at) FROM clicks))
+    WHERE name = 'stats_hourly';
+
+    ANALYZE;
+'''
+
+
+class Context:
+    def __init__(self, request_id: str):
+        self.request_id = request_id
+
+
+def log(message: str) -> None:
+    print(message, file=sys.stderr, flush=True)
+
+
+@contextmanager
+def temporary_cluster(pg_bin: Optional[str]) -> Iterator[str]:
+    '''Кластер в временном каталоге: сокет там же, без TCP и fsync; удаляется целиком'''
+    def binary(name: str) -> str:
+        path = os.path.join(pg_bin, name) if pg_bin else shutil.which(name)
+        if not path or not os.path.exists(path):
+            raise SystemExit(f'{name} не найден: задайте DATABASE_URL или --pg-bin')
+        return path
+
+    directory = tempfile.mkdtemp(prefix='cpa-load-')
+    data = os.path.join(directory, 'data')
+    options = f"-k {directory} -c listen_addresses='' -c fsync=off -c synchronous_commit=off -c max_connections=200"
+    started = False
+    try:
+        subprocess.run([binary('initdb'), '-D', data, '-U', 'postgres', '--auth=trust', '-E', 'UTF8'],
+                       check=True, stdout=subprocess.DEVNULL)
+        subprocess.run([binary('pg_ctl'), '-D', data, '-o', options, '-l', os.path.join(directory, 'postgres.log'),
+                        '-w', 'start'], check=True, stdout=subprocess.DEVNULL)
+        started = True
+        yield f'postgresql://postgres@/postgres?host={directory}'
+    finally:
+        if started:
+            subprocess.run([binary('pg_ctl'), '-D', data, '-m', 'immediate', 'stop'], stdout=subprocess.DEVNULL)
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+@contextmanager
+def temporary_database(server_url: str, keep: bool) -> Iterator[str]:
+    '''База cpa_load_<pid> на сервере из server_url; после прогона соединения обрываются и база удаляется'''
+    name = f'cpa_load_{os.getpid()}'
+    admin = psycopg2.connect(server_url)
+    admin.autocommit = True
+    with admin.cursor() as cursor:
+        cursor.execute(f'CREATE DATABASE {name}')
+    parts = urlsplit(server_url)
+    url = urlunsplit((parts.scheme, parts.netloc, '/' + name, parts.query, parts.fragment))
+    try:
+        yield url
+    finally:
+        if keep:
+            log(f'база оставлена: {url}')
+        else:
+            with admin.cursor() as cursor:
+                cursor.execute(
+                    "SELECT pg_terminate_backend(pid) FROM pg_stat_activity WHERE datname = %s AND pid <> pg_backend_pid()",
+                    (name,)
+                )
+                cursor.execute(f'DROP DATABASE IF EXISTS {name}')
+        admin.close()
+
+
+def migration_files() -> List[str]:
+    def version(path: str) -> int:
+        return int(re.match(r'V(\d+)__', os.path.basename(path)).group(1))
+    return sorted(glob.glob(os.path.join(ROOT, 'db_migrations', 'V*.sql')), key=version)
+
+
+def prepare_database(url: str, args: argparse.Namespace) -> Dict[str, Any]:
+    '''Миграции по порядку, затем синтетические данные одним проходом generate_series'''
+    started = time.perf_counter()
+    conn = psycopg2.connect(url)
+    conn.autocommit = True
+    with conn.cursor() as cursor:
+        for path in migration_files():
+            with open(path, encoding='utf-8') as f:
+                cursor.execute(f.read())
+    migrated = time.perf_counter()
+
+    clicks = max(1, int(args.clicks * 1_000_000))
+    params = {
+        'offers': args.offers,
+        'webmasters': args.webmasters,
+        'advertisers': max(1, args.offers // 10),
+        'clicks': clicks,
+        'days': args.days,
+        'conversion_every': max(1, round(1 / args.conversion_rate)) if args.conversion_rate > 0 else clicks + 1,
+    }
+    conn.autocommit = False
+    with conn.cursor() as cursor:
+        cursor.execute(SEED_SQL, params)
+        conn.commit()
+        cursor.execute("SELECT (SELECT COUNT(*) FROM clicks), (SELECT COUNT(*) FROM conversions)")
+        total_clicks, total_conversions = cursor.fetchone()
+    conn.close()
+    return {
+        'offers': args.offers,
+        'webmasters': args.webmasters,
+        'clicks': total_clicks,
+        'conversions': total_conversions,
+        'days': args.days,
+        'migrate_seconds': round(migrated - started, 2),
+        'seed_seconds': round(time.perf_counter() - migrated, 2),
+    }
+
+
+def _purge_backend_modules() -> None:
+    for key, module in list(sys.modules.items()):
+        if (getattr(module, '__file__', None) or '').startswith(BACKEND + os.sep):
+            del sys.modules[key]
+
+
+def load_module(function: str, module: str = 'index'):
+    '''Модуль из backend/<function> со своими соседями: db.py и прочие копии не смешиваются между функциями'''
+    directory = os.path.join(BACKEND, function)
+    _purge_backend_modules()
+    sys.path.insert(0, directory)
+    try:
+        spec = importlib.util.spec_from_file_location(f'load_{function}_{module}',
+                                                      os.path.join(directory, f'{module}.py'))
+        loaded = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(loaded)
+    finally:
+        sys.path.remove(directory)
+        _purge_backend_modules()
+    return loaded
+
+
+def catch_up_rollups(url: str) -> float:
+    '''Агрегаты за весь период досчитываются до прогона, иначе первые запросы статистики мерят свёртку'''
+    rollup = load_module('stats', 'rollup')
+    started = time.perf_counter()
+    conn = psycopg2.connect(url)
+    with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+        rollup.catch_up_rollups(cursor)
+    conn.close()
+    return round(time.perf_counter() - started, 2)
+
+
+def fetch_ids(url: str) -> Dict[str, List[Any]]:
+    conn = psycopg2.connect(url)
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT id FROM offers WHERE category = 'load' AND status = 'active' ORDER BY id")
+        offers = [row[0] for row in cursor.fetchall()]
+        cursor.execute("SELECT id FROM users WHERE email LIKE 'load-wm-%' ORDER BY id")
+        webmasters = [row[0] for row in cursor.fetchall()]
+        cursor.execute("SELECT id FROM users WHERE email LIKE 'load-adv-%' ORDER BY id")
+        advertisers = [row[0] for row in cursor.fetchall()]
+        cursor.execute("SELECT token FROM sessions WHERE token LIKE 'load-token-%'")
+        tokens = [row[0] for row in cursor.fetchall()]
+    conn.close()
+    return {'offers': offers, 'webmasters': webmasters, 'advertisers': advertisers, 'tokens': tokens}
+
+
+def request_event(method: str, params: Optional[Dict[str, str]] = None, body: Any = None,
+                  ip: str = '127.0.0.1', user_agent: str = 'load-test') -> Dict[str, Any]:
+    event = {
+        'httpMethod': method,
+        'headers': {},
+        'queryStringParameters': params or {},
+        'requestContext': {'identity': {'sourceIp': ip, 'userAgent': user_agent}},
+        'isBase64Encoded': False,
+    }
+    if body is not None:
+        event['body'] = body if isinstance(body, str) else json.dumps(body)
+    return event
+
+
+class Workload:
+    '''Генераторы запросов по сценариям; click_id из ответов кликов идут в конверсии, как у пиксель-скрипта'''
+
+    def __init__(self, handlers: Dict[str, Callable], ids: Dict[str, List[Any]]):
+        self.handlers = handlers
+        self.ids = ids
+        self.click_ids: deque = deque(maxlen=10000)
+
+    def click(self, rng: random.Random) -> Tuple[str, Dict[str, Any]]:
+        params = {'action': 'click', 'offer_id': str(rng.choice(self.ids['offers'])),
+                  'wm_id': str(rng.choice(self.ids['webmasters']))}
+        ip = f'10.{rng.randrange(256)}.{rng.randrange(256)}.{rng.randrange(1, 255)}'
+        return 'pixel', request_event('GET', params, ip=ip,
+                                      user_agent='Mozilla/5.0 (X11; Linux x86_64) Firefox/121.0')
+
+    def convert(self, rng: random.Random) -> Tuple[str, Dict[str, Any]]:
+        try:
+            offer_id, click_id = self.click_ids[rng.randrange(len(self.click_ids))]
+            params = {'action': 'convert', 'offer_id': offer_id, 'click_id': click_id}
+        except (IndexError, ValueError):
+            params = {'action': 'convert', 'offer_id': str(rng.choice(self.ids['offers'])),
+                      'wm_id': str(rng.choice(self.ids['webmasters']))}
+        return 'pixel', request_event('GET', params)
+
+    def stats(self, rng: random.Random) -> Tuple[str, Dict[str, Any]]:
+        if rng.random() < 0.7:
+            params = {'user_id': str(rng.choice(self.ids['webmasters'])), 'role': 'webmaster'}
+        else:
+            params = {'user_id': str(rng.choice(self.ids['advertisers'])), 'role': 'advertiser'}
+        params['period'] = rng.choice(('1', '7', '30'))
+        return 'stats', request_event('GET', params)
+
+    def verify(self, rng: random.Random) -> Tuple[str, Dict[str, Any]]:
+        return 'auth', request_event('POST', body={'action': 'verify', 'token': rng.choice(self.ids['tokens'])})
+
+    def offers(self, rng: random.Random) -> Tuple[str, Dict[str, Any]]:
+        params = {'status': 'active', 'limit': rng.choice(('20', '50'))}
+        return 'offers', request_event('GET', params)
+
+    def observe(self, scenario: str, event: Dict[str, Any], response: Dict[str, Any]) -> None:
+        click_id = (response.get('headers') or {}).get('X-Click-Id')
+        if scenario == 'click' and click_id:
+            self.click_ids.append((event['queryStringParameters']['offer_id'], click_id))
+
+
+class Recorder:
+    '''Замеры по сценарию; список.append под GIL не требует блокировки'''
+
+    def __init__(self):
+        self.samples: Dict[str, List[Tuple[float, int, int, float]]] = {}
+        self.errors: Dict[str, List[str]] = {}
+
+    def add(self, scenario: str, seconds: float, status: int, queries: int, db_ms: float) -> None:
+        self.samples.setdefault(scenario, []).append((seconds, status, queries, db_ms))
+
+    def error(self, scenario: str, message: str) -> None:
+        self.errors.setdefault(scenario, []).append(message)
+
+
+def call(handler: Callable, event: Dict[str, Any], request_id: str) -> Tuple[Dict[str, Any], float, int, float]:
+    started = time.perf_counter()
+    response = handler(event, Context(request_id))
+    seconds = time.perf_counter() - started
+    match = _QUERIES.search((response.get('headers') or {}).get('Server-Timing', ''))
+    queries, db_ms = (int(match.group(2)), float(match.group(1))) if match else (0, 0.0)
+    return response, seconds, queries, db_ms
+
+
+def parse_mix(text: str) -> List[Tuple[str, float]]:
+    mix = []
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        if not hasattr(Workload, name.strip()) or name.strip() == 'observe':
+            raise SystemExit(f'неизвестный сценарий: {name}')
+        if float(weight or 1) > 0:
+            mix.append((name.strip(), float(weight or 1)))
+    return mix
+
+
+def run_load(workload: Workload, mix: List[Tuple[str, float]], concurrency: int, duration: float,
+             seed: int, recorder: Optional[Recorder]) -> float:
+    '''concurrency потоков гоняют взвешенную смесь сценариев duration секунд; возвращает фактическое время'''
+    names = [name for name, _ in mix]
+    weights = [weight for _, weight in mix]
+    deadline = time.perf_counter() + duration
+    counter = iter(range(10 ** 12))
+    lock = threading.Lock()
+
+    def worker(index: int) -> None:
+        rng = random.Random(seed * 1000 + index)
+        while time.perf_counter() < deadline:
+            scenario = rng.choices(names, weights)[0]
+            function, event = getattr(workload, scenario)(rng)
+            with lock:
+                number = next(counter)
+            try:
+                response, seconds, queries, db_ms = call(workload.handlers[function], event, f'load-{number}')
+            except Exception as e:
+                if recorder is not None:
+                    recorder.error(scenario, f'{type(e).__name__}: {e}')
+                continue
+            workload.observe(scenario, event, response)
+            if recorder is not None:
+                recorder.add(scenario, seconds, response.get('statusCode', 0), queries, db_ms)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for future in [executor.submit(worker, index) for index in range(concurrency)]:
+            future.result()
+    return time.perf_counter() - started
+
+
+def percentile(sorted_values: List[float], fraction: float) -> float:
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values))) - 1))]
+
+
+def summarize(samples: List[Tuple[float, int, int, float]], errors: List[str], elapsed: float) -> Dict[str, Any]:
+    latencies = sorted(sample[0] * 1000 for sample in samples)
+    queries = [sample[2] for sample in samples]
+    statuses: Dict[str, int] = {}
+    for sample in samples:
+        statuses[str(sample[1])] = statuses.get(str(sample[1]), 0) + 1
+    count = len(samples)
+    return {
+        'requests': count,
+        'errors': len(errors) + sum(n for status, n in statuses.items() if status.startswith('5')),
+        'status': dict(sorted(statuses.items())),
+        'throughput_rps': round(count / elapsed, 1) if elapsed else 0.0,
+        'latency_ms': {
+            'p50': round(percentile(latencies, 0.50), 3),
+            'p95': round(percentile(latencies, 0.95), 3),
+            'p99': round(percentile(latencies, 0.99), 3),
+            'max': round(latencies[-1], 3) if latencies else 0.0,
+            'mean': round(sum(latencies) / count, 3) if count else 0.0,
+        },
+        'db_round_trips': {
+            'mean': round(sum(queries) / count, 2) if count else 0.0,
+            'max': max(queries) if queries else 0,
+        },
+        'db_ms_mean': round(sum(sample[3] for sample in samples) / count, 3) if count else 0.0,
+    }
+
+
+def replay_tests(handlers: Dict[str, Callable]) -> List[Dict[str, Any]]:
+    '''Кейсы tests.json каждой функции по одному разу: статус против expectedStatus и время'''
+    results = []
+    for function in FUNCTIONS:
+        with open(os.path.join(BACKEND, function, 'tests.json'), encoding='utf-8') as f:
+            cases = json.load(f)['tests']
+        for case in cases:
+            path = urlsplit(case.get('path', '/'))
+            event = request_event(case.get('method', 'GET'), dict(parse_qsl(path.query)), case.get('body'))
+            event['headers'] = case.get('headers', {})
+            try:
+                response, seconds, queries, _ = call(handlers[function], event, f'tests-{function}')
+                status = response.get('statusCode')
+            except Exception as e:
+                seconds, queries, status = 0.0, 0, f'{type(e).__name__}: {e}'
+            results.append({
+                'function': function,
+                'name': case.get('name'),
+                'status': status,
+                'expected': case.get('expectedStatus'),
+                'ok': status == case.get('expectedStatus'),
+                'ms': round(seconds * 1000, 3),
+                'db_round_trips': queries,
+            })
+    return results
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_report(result: Dict[str, Any]) -> None:
+    print(f"{'scenario':<10} {'requests':>9} {'rps':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} "
+          f"{'db trips':>9} {'errors':>7}")
+    rows = list(result['endpoints'].items()) + [('total', result['total'])]
+    for name, row in rows:
+        latency = row['latency_ms']
+        print(f"{name:<10} {row['requests']:>9} {row['throughput_rps']:>9.1f} {latency['p50']:>9.2f} "
+              f"{latency['p95']:>9.2f} {latency['p99']:>9.2f} {row['db_round_trips']['mean']:>9.2f} "
+              f"{row['errors']:>7}")
+    failed = [test for test in result.get('tests', []) if not test['ok']]
+    if failed:
+        print(f"tests.json: {len(failed)} из {len(result['tests'])} кейсов вернули не тот статус")
+        for test in failed:
+            print(f"  {test['function']}: {test['name']} - {test['status']} вместо {test['expected']}")
+
+
+def print_diff(old: Dict[str, Any], new: Dict[str, Any], fail_over: Optional[float]) -> int:
+    '''Изменения метрик по сценариям; код 1, если p95 какого-то сценария вырос больше чем на fail_over %'''
+    print(f"base {old.get('revision')} -> {new.get('revision')}")
+    print(f"{'scenario':<10} {'metric':<14} {'old':>10} {'new':>10} {'change':>9}")
+    regressed = []
+    names = [name for name in new['endpoints'] if name in old['endpoints']] + ['total']
+    for name in names:
+        before = old['total'] if name == 'total' else old['endpoints'][name]
+        after = new['total'] if name == 'total' else new['endpoints'][name]
+        metrics = [
+            ('p50 ms', before['latency_ms']['p50'], after['latency_ms']['p50']),
+            ('p95 ms', before['latency_ms']['p95'], after['latency_ms']['p95']),
+            ('p99 ms', before['latency_ms']['p99'], after['latency_ms']['p99']),
+            ('rps', before['throughput_rps'], after['throughput_rps']),
+            ('db trips', before['db_round_trips']['mean'], after['db_round_trips']['mean']),
+        ]
+        for metric, old_value, new_value in metrics:
+            change = (new_value - old_value) / old_value * 100 if old_value else 0.0
+            print(f'{name:<10} {metric:<14} {old_value:>10.2f} {new_value:>10.2f} {change:>+8.1f}%')
+            if metric == 'p95 ms' and fail_over is not None and change > fail_over:
+                regressed.append(name)
+    if regressed:
+        print(f"p95 вырос больше чем на {fail_over}%: {', '.join(regressed)}")
+        return 1
+    return 0
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--offers', type=int, default=50)
+    parser.add_argument('--webmasters', type=int, default=200)
+    parser.add_argument('--clicks', type=float, default=0.2, help='миллионов кликов в истории')
+    parser.add_argument('--conversion-rate', type=float, default=0.05)
+    parser.add_argument('--days', type=int, default=30)
+    parser.add_argument('--mix', default=DEFAULT_MIX, help='сценарий=вес через запятую: click, convert, stats, '
+                                                          'verify, offers')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=30.0)
+    parser.add_argument('--warmup', type=float, default=3.0)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--skip-tests', action='store_true', help='не прогонять кейсы tests.json')
+    parser.add_argument('--pg-bin', help='каталог с initdb/pg_ctl для временного кластера')
+    parser.add_argument('--keep', action='store_true', help='не удалять временную базу')
+    parser.add_argument('--output', help='записать результат в JSON')
+    parser.add_argument('--compare', help='сравнить результат с ранее записанным файлом')
+    parser.add_argument('--diff', nargs=2, metavar=('OLD', 'NEW'), help='только сравнить два файла результатов')
+    parser.add_argument('--fail-over', type=float, help='код выхода 1, если p95 вырос больше чем на N %%')
+    args = parser.parse_args()
+
+    if args.diff:
+        with open(args.diff[0], encoding='utf-8') as f_old, open(args.diff[1], encoding='utf-8') as f_new:
+            sys.exit(print_diff(json.load(f_old), json.load(f_new), args.fail_over))
+
+    mix = parse_mix(args.mix)
+    # Каждый запрос трассируется ради счётчика запросов в Server-Timing; строки лога не нужны
+    os.environ['TRACE_SAMPLE_RATE'] = '1'
+    os.environ['TRACE_SERVER_TIMING'] = '1'
+    os.environ.setdefault('DB_POOL_MAX_SIZE', str(max(4, args.concurrency)))
+    # Конверсии сценария convert несут подписанный click_id из ответов кликов
+    os.environ.setdefault('CLICK_ID_SECRET', 'load-test-click-id-secret')
+    logging.getLogger('trace').disabled = True
+
+    server = os.environ.get('DATABASE_URL')
+    cluster = temporary_cluster(args.pg_bin) if not server else None
+    with (cluster or nullcontext(server)) as server_url, temporary_database(server_url, args.keep) as url:
+        os.environ['DATABASE_URL'] = url
+        log(f'миграции и данные: {args.offers} офферов, {args.webmasters} вебмастеров, {args.clicks} млн кликов')
+        dataset = prepare_database(url, args)
+        dataset['rollup_seconds'] = catch_up_rollups(url)
+        ids = fetch_ids(url)
+
+        modules = {function: load_module(function) for function in FUNCTIONS}
+        handlers = {function: module.handler for function, module in modules.items()}
+        tests = [] if args.skip_tests else replay_tests(handlers)
+
+        workload = Workload(handlers, ids)
+        if args.warmup > 0:
+            log(f'прогрев {args.warmup} с')
+            run_load(workload, mix, args.concurrency, args.warmup, args.seed + 1, None)
+        log(f'нагрузка {args.duration} с, {args.concurrency} потоков, смесь {args.mix}')
+        recorder = Recorder()
+        elapsed = run_load(workload, mix, args.concurrency, args.duration, args.seed, recorder)
+
+        # Буфер и очередь событий дописываются в базу до её удаления
+        click_buffer = getattr(modules['pixel'], 'click_buffer', None)
+        if click_buffer is not None:
+            click_buffer.shutdown()
+        pipeline_worker = getattr(modules['pixel'], 'pipeline_worker', None)
+        if pipeline_worker is not None:
+            pipeline_worker.shutdown()
+        for module in modules.values():
+            if hasattr(module, 'get_pool'):
+                module.get_pool().close()
+
+    result = {
+        'version': BASELINE_VERSION,
+        'revision': git_revision(),
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': sys.version.split()[0],
+        'config': {'mix': args.mix, 'concurrency': args.concurrency, 'duration': args.duration,
+                   'warmup': args.warmup, 'seed': args.seed},
+        'dataset': dataset,
+        'elapsed_seconds': round(elapsed, 2),
+        'endpoints': {name: summarize(recorder.samples.get(name, []), recorder.errors.get(name, []), elapsed)
+                      for name, _ in mix},
+        'total': summarize([s for samples in recorder.samples.values() for s in samples],
+                           [e for errors in recorder.errors.values() for e in errors], elapsed),
+        'tests': tests,
+    }
+    print_report(result)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+            f.write('\n')
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            sys.exit(print_diff(json.load(f), result, args.fail_over))
+
+
+if __name__ == '__main__':
+    main()